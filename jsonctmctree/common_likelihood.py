@@ -16,18 +16,85 @@ from numpy.testing import assert_equal
 from .node_ordering import get_node_evaluation_order
 
 __all__ = [
+        'ObservationEncoding',
         'create_indicator_array',
         'get_conditional_likelihoods',
+        'get_site_patterns',
         'get_subtree_likelihoods',
+        'get_unobserved_subtrees',
+        'rescale_columns',
         ]
 
 
+def rescale_columns(arr):
+    """
+    Divide each column of the array by its largest absolute value.
+
+    The array is modified in place.
+    Columns of zeros are not changed.
+
+    Returns
+    -------
+    log_scale : 1d ndarray
+        The double precision logarithm of the scaling factor of each column,
+        or zero for columns of zeros.
+
+    """
+    if not arr.shape[0]:
+        return np.zeros(arr.shape[1])
+    scale = np.abs(arr).max(axis=0)
+    scale[scale == 0] = 1
+    arr /= scale
+    return np.log(scale, dtype=np.float64)
+
+
+def get_site_patterns(iid_observations):
+    """
+    Find the distinct rows of the array of iid observations.
+
+    Sites with identical observations have identical likelihood arrays,
+    so the arrays need to be computed only once per distinct pattern.
+
+    Parameters
+    ----------
+    iid_observations : 2d ndarray of shape (nsites, nobservables)
+        Observed component states, with -1 for missing observations.
+
+    Returns
+    -------
+    patterns : 2d ndarray of shape (npatterns, nobservables)
+        The distinct rows of the observation array.
+    site_to_pattern : 1d ndarray of shape (nsites, )
+        The index of the pattern of each site.
+    pattern_counts : 1d ndarray of shape (npatterns, )
+        The number of sites with each pattern.
+
+    """
+    iid_observations = np.asarray(iid_observations)
+    nsites, nobservables = iid_observations.shape
+    if not nsites or not nobservables:
+        site_to_pattern = np.zeros(nsites, dtype=int)
+        patterns = iid_observations[:1]
+    else:
+        # Sort the rows lexicographically and mark the first row of each run.
+        order = np.lexsort(iid_observations.T[::-1])
+        sorted_rows = iid_observations[order]
+        is_new = np.ones(nsites, dtype=bool)
+        is_new[1:] = np.any(sorted_rows[1:] != sorted_rows[:-1], axis=1)
+        site_to_pattern = np.empty(nsites, dtype=int)
+        site_to_pattern[order] = np.cumsum(is_new) - 1
+        patterns = sorted_rows[is_new]
+    pattern_counts = np.bincount(site_to_pattern, minlength=len(patterns))
+    return patterns, site_to_pattern, pattern_counts
+
+
 def create_indicator_array(
         node,
         state_space_shape,
         observable_nodes,
         observable_axes,
-        iid_observations):
+        iid_observations,
+        dtype=float):
     """
     Create the initial array indicating observations.
 
@@ -49,6 +116,8 @@ def create_indicator_array(
         x
     iid_observations : x
         x
+    dtype : dtype, optional
+        Floating point type of the observation indicator array.
 
     Returns
     -------
@@ -65,7 +134,7 @@ def create_indicator_array(
     # This array is large; for data with many iid sites,
     # such active arrays dominate the memory usage of the program.
     obs_shape = (nsites, ) + tuple(state_space_shape)
-    obs = np.ones(obs_shape, dtype=float)
+    obs = np.ones(obs_shape, dtype=dtype)
 
     # For each observable associated with the node under consideration,
     # apply the observation mask across all iid sites.
@@ -76,7 +145,7 @@ def create_indicator_array(
         k = state_space_shape[axis]
         projection_shape = [k if i == axis else 1 for i in state_space_axes]
         mask_shape = (nsites, ) + tuple(projection_shape)
-        indicator_arrays = np.zeros((k+1, k), dtype=int)
+        indicator_arrays = np.zeros((k+1, k), dtype=dtype)
         np.fill_diagonal(indicator_arrays, 1)
         indicator_arrays[-1, :] = 1
         obs *= np.take(indicator_arrays, states, axis=0).reshape(mask_shape)
@@ -92,6 +161,219 @@ def create_indicator_array(
     return obs
 
 
+class ObservationEncoding(object):
+    """
+    A compact encoding of the observations, compiled once per scene.
+
+    For each node, the encoding keeps the observed state of each of its
+    observables at each site, and -1 marks a missing observation.
+    Observables that are missing at every site are dropped,
+    so that nodes without observations are skipped entirely.
+    The observations are applied to a likelihood array in place,
+    by a row gather if every variable of the node is observed at each site
+    and by a boolean mask otherwise,
+    without allocating a dense indicator array.
+
+    """
+    def __init__(
+            self,
+            state_space_shape,
+            observable_nodes,
+            observable_axes,
+            iid_observations):
+        self.state_space_shape = tuple(state_space_shape)
+        self.nstates = int(np.prod(state_space_shape))
+        self.nsites = iid_observations.shape[0]
+
+        # The coordinate of each state along each axis of the state space.
+        self._state_coords = np.unravel_index(
+                np.arange(self.nstates), self.state_space_shape)
+
+        # Map each observed node to the axis and states of its observables.
+        self._node_to_observations = {}
+        for idx, node in enumerate(observable_nodes):
+            states = np.asarray(iid_observations[:, idx])
+            if np.all(states < 0):
+                continue
+            pair = (observable_axes[idx], states)
+            self._node_to_observations.setdefault(node, []).append(pair)
+
+    def is_observed(self, node):
+        """
+        Return True if the node has an observation at some site.
+
+        """
+        return node in self._node_to_observations
+
+    def _get_states(self, observations):
+        # Return the state of each column if every variable is observed,
+        # otherwise return None.
+        axes = sorted(axis for axis, states in observations)
+        if axes != list(range(len(self.state_space_shape))):
+            return None
+        if any(np.any(states < 0) for axis, states in observations):
+            return None
+        coords = [None] * len(axes)
+        for axis, states in observations:
+            coords[axis] = states
+        return np.ravel_multi_index(coords, self.state_space_shape)
+
+    def apply(self, node, arr, sites=None):
+        """
+        Multiply an array by the observation indicator of a node.
+
+        Parameters
+        ----------
+        node : integer
+            The node whose observations are applied.
+        arr : 2d ndarray of shape (nstates, ncolumns)
+            The array, which is modified in place.
+        sites : 1d ndarray of shape (ncolumns, ), optional
+            The site of each column of the array.
+            By default the array has one column per site.
+
+        Returns
+        -------
+        arr : 2d ndarray
+            The same array, for convenience.
+
+        """
+        observations = self._node_to_observations.get(node)
+        if not observations:
+            return arr
+        if sites is not None:
+            observations = [(axis, states[sites])
+                    for axis, states in observations]
+        states = self._get_states(observations)
+        if states is not None:
+            columns = np.arange(arr.shape[1])
+            values = arr[states, columns]
+            arr[...] = 0
+            arr[states, columns] = values
+        else:
+            mask = None
+            for axis, states in observations:
+                coords = self._state_coords[axis][:, np.newaxis]
+                local_mask = (coords == states) | (states < 0)
+                if mask is None:
+                    mask = local_mask
+                else:
+                    mask &= local_mask
+            arr *= mask
+        return arr
+
+    def create_array(self, node, sites=None, dtype=float):
+        """
+        Create the observation indicator array of a node.
+
+        This is equivalent to create_indicator_array,
+        restricted to the given sites if any.
+
+        """
+        ncols = self.nsites if sites is None else len(sites)
+        arr = np.ones((self.nstates, ncols), dtype=dtype)
+        return self.apply(node, arr, sites)
+
+
+def _get_subtree_columns(
+        node, child_maps, observable_nodes, iid_observations):
+    """
+    Find the distinct columns of the likelihood array of a subtree.
+
+    A column of the array depends only on the observations in the subtree,
+    so sites that agree at the observables of the node and that map to
+    the same distinct columns of each child array share a column.
+
+    Parameters
+    ----------
+    node : integer
+        The node at the root of the subtree.
+    child_maps : sequence of 1d ndarrays
+        For each child, the index of the distinct column of each site.
+    observable_nodes : 1d ndarray
+        The node of each observable.
+    iid_observations : 2d ndarray of shape (nsites, nobservables)
+        Observed component states.
+
+    Returns
+    -------
+    site_to_column : 1d ndarray of shape (nsites, )
+        The index of the distinct column of each site.
+    column_to_site : 1d ndarray of shape (ncolumns, )
+        A representative site of each distinct column.
+
+    """
+    local_observables = np.flatnonzero(observable_nodes == node)
+    keys = [m[:, np.newaxis] for m in child_maps]
+    keys.append(iid_observations[:, local_observables])
+    info = get_site_patterns(np.hstack(keys))
+    patterns, site_to_column, column_counts = info
+    column_to_site = np.unique(site_to_column, return_index=True)[1]
+    return site_to_column, column_to_site
+
+
+def get_unobserved_subtrees(T, root, encoding):
+    """
+    Find the nodes whose subtrees have no observations.
+
+    The likelihood array of such a subtree is all ones,
+    and so is its product with a transition matrix,
+    because the rows of a transition matrix sum to one.
+
+    Parameters
+    ----------
+    T : directed networkx graph
+        The rooted tree.
+    root : integer
+        The root of the tree.
+    encoding : ObservationEncoding
+        The compiled observations.
+
+    Returns
+    -------
+    unobserved : set
+        The nodes whose subtrees have no observations.
+
+    """
+    unobserved = set()
+    for node in get_node_evaluation_order(T, root):
+        if encoding.is_observed(node):
+            continue
+        if all(child in unobserved for child in T.successors(node)):
+            unobserved.add(node)
+    return unobserved
+
+
+def _expand_columns(
+        T, root, store_all, unobserved, all_ones,
+        node_to_array, node_to_map, node_to_scale, node_to_log_scale):
+    # Return the map from node to array, with one column per site.
+    # The arrays of unobserved subtrees are the shared read-only array
+    # of ones, and their log scaling factors are zero.
+    d = dict((node, arr[:, node_to_map[node]])
+            for node, arr in node_to_array.items())
+    if node_to_log_scale is not None:
+        for node in node_to_array:
+            node_to_log_scale[node] = node_to_scale[node][node_to_map[node]]
+    for node in unobserved:
+        if store_all or node == root:
+            d[node] = all_ones
+            if node_to_log_scale is not None:
+                node_to_log_scale[node] = np.zeros(all_ones.shape[1])
+
+    # If we had been deleting arrays as they become unnecessary for
+    # the log likelihood calculation, then we would have only
+    # a single active array remaining at this point, corresponding to the root.
+    # But if we are saving the arrays for gradient calculations,
+    # then we have more left.
+    if store_all:
+        desired_keys = set(T)
+    else:
+        desired_keys = {root}
+    assert_equal(set(d), desired_keys)
+    return d
+
+
 def get_subtree_likelihoods(
         f,
         store_all,
@@ -100,6 +382,10 @@ def get_subtree_likelihoods(
         observable_nodes,
         observable_axes,
         iid_observations,
+        dtype=float,
+        edge_products=None,
+        node_to_log_scale=None,
+        encoding=None,
         ):
     """
     Compute likelihood arrays associated with nodes.
@@ -107,62 +393,105 @@ def get_subtree_likelihoods(
     Unlike get_conditional_likelihoods, this function
     does not look at the upstream edge of the node.
 
-    The shape of each output array is (nstates, nsites).
+    The shape of each output array is (nstates, nsites),
+    and its floating point type is given by dtype.
+    If edge_products is provided, for example as an EdgeProductCache,
+    then the product of the transition matrix of each edge
+    with the subtree likelihood array of its tail node
+    is added to it for reuse by later passes.
+
+    If node_to_log_scale is provided as a dict, then the columns of the
+    array of each node are rescaled to avoid underflow,
+    and the dict maps each node of the output to the log of the factor
+    by which each column of its array has been divided.
+
+    The observations are applied through an ObservationEncoding,
+    which is compiled from the observation arrays if it is not provided.
+    Subtrees without observations are not evaluated,
+    and their arrays are a shared read-only array of ones.
+    No transition matrix is applied along edges with zero rate.
 
     """
     nstates = np.prod(state_space_shape)
+    nsites = iid_observations.shape[0]
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
+    unobserved = get_unobserved_subtrees(T, root, encoding)
+    all_ones = np.broadcast_to(
+            np.ones((nstates, 1), dtype=dtype), (nstates, nsites))
 
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
 
     # For the few nodes that are active at a given point in the traversal,
-    # we track a 2d array of shape (nstates, nsites).
+    # we track a 2d array with one column per distinct column of the
+    # subtree, and a map from sites to those columns.
     node_to_array = {}
+    node_to_map = {}
+    node_to_scale = {}
     for node in get_node_evaluation_order(T, root):
+        if node in unobserved:
+            continue
 
-        # When a node is activated, its associated array
-        # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        # The products along the edges to unobserved subtrees are ones.
+        children = []
+        for child in T.successors(node):
+            if child not in unobserved:
+                children.append(child)
+            elif edge_products is not None:
+                edge_products.add_product((node, child), all_ones)
+        child_maps = [node_to_map[child] for child in children]
+        site_to_column, column_to_site = _get_subtree_columns(
+                node, child_maps, observable_nodes, iid_observations)
+
+        # The array of a node starts from the product for its first child,
+        # to which its observations are applied in place.
+        # A node without children starts from its indicator array.
+        arr = None
+        log_scale = np.zeros(len(column_to_site))
 
         # Multiplicatively accumulate over outgoing edges.
-        for child in T.successors(node):
+        # The transition matrix acts only on the distinct child columns.
+        for child, child_map in zip(children, child_maps):
             edge = (node, child)
             edge_rate = edge_to_rate[edge]
             edge_process = edge_to_process[edge]
             child_arr = node_to_array[child]
 
-            child_edge_arr = f[edge_process].expm_mul(edge_rate, child_arr)
-            
-            #TODO check this
-            #P = f[edge_process].expm_mul(edge_rate, np.identity(nstates))
-            #child_edge_arr = child_arr.T.dot(P).T
-
-            arr *= child_edge_arr
+            if edge_rate:
+                child_edge_arr = f[edge_process].expm_mul(edge_rate, child_arr)
+            else:
+                child_edge_arr = child_arr
+            if edge_products is not None:
+                edge_products.add_product(edge, child_edge_arr[:, child_map])
+
+            # Rescale the columns after each product if requested,
+            # so that nodes with many children do not underflow.
+            columns = child_map[column_to_site]
+            if arr is None:
+                arr = child_edge_arr[:, columns].astype(dtype, copy=False)
+                encoding.apply(node, arr, column_to_site)
+            else:
+                arr *= child_edge_arr[:, columns]
+            log_scale += node_to_scale[child][columns]
+            if node_to_log_scale is not None:
+                log_scale += rescale_columns(arr)
             if not store_all:
                 del node_to_array[child]
+                del node_to_map[child]
+                del node_to_scale[child]
+        if arr is None:
+            arr = encoding.create_array(node, column_to_site, dtype)
 
         # Associate the array with the current node.
         node_to_array[node] = arr
+        node_to_map[node] = site_to_column
+        node_to_scale[node] = log_scale
 
-    # If we had been deleting arrays as they become unnecessary for
-    # the log likelihood calculation, then we would have only
-    # a single active array remaining at this point, corresponding to the root.
-    # But if we are saving the arrays for gradient calculations,
-    # then we have more left.
-    actual_keys = set(node_to_array)
-    if store_all:
-        desired_keys = set(T)
-    else:
-        desired_keys = {root}
-    assert_equal(actual_keys, desired_keys)
-
-    # Return the map from node to array.
-    return node_to_array
+    return _expand_columns(
+            T, root, store_all, unobserved, all_ones,
+            node_to_array, node_to_map, node_to_scale, node_to_log_scale)
 
 
 def get_conditional_likelihoods(
@@ -173,6 +502,9 @@ def get_conditional_likelihoods(
         observable_nodes,
         observable_axes,
         iid_observations,
+        dtype=float,
+        node_to_log_scale=None,
+        encoding=None,
         ):
     """
     Recursively compute conditional likelihoods at the root.
@@ -189,6 +521,18 @@ def get_conditional_likelihoods(
         These functions compute expm_mul and rate_mul.
     store_all : bool
         Indicates whether all edge arrays should be stored.
+    dtype : dtype, optional
+        Floating point type of the node arrays.
+    node_to_log_scale : dict, optional
+        If provided, the columns of the arrays are rescaled
+        to avoid underflow, and this dict is filled with the log of the
+        factor by which each column of the array of each node
+        of the output has been divided.
+    encoding : ObservationEncoding, optional
+        The compiled observations,
+        which are compiled from the observation arrays by default.
+        Subtrees without observations are not evaluated,
+        and their arrays are a shared read-only array of ones.
 
     Returns
     -------
@@ -207,24 +551,39 @@ def get_conditional_likelihoods(
     """
     nstates = np.prod(state_space_shape)
     nsites, nobservables = iid_observations.shape
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
+    unobserved = get_unobserved_subtrees(T, root, encoding)
+    all_ones = np.broadcast_to(
+            np.ones((nstates, 1), dtype=dtype), (nstates, nsites))
 
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
 
     # For the few nodes that are active at a given point in the traversal,
-    # we track a 2d array of shape (nsites, nstates).
+    # we track a 2d array with one column per distinct column of the
+    # subtree, and a map from sites to those columns.
     node_to_array = {}
+    node_to_map = {}
+    node_to_scale = {}
     for node in get_node_evaluation_order(T, root):
+        if node in unobserved:
+            continue
 
-        # When a node is activated, its associated array
-        # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        # The arrays of unobserved subtrees are ones,
+        # so they do not contribute to the product.
+        children = [c for c in T.successors(node) if c not in unobserved]
+        child_maps = [node_to_map[child] for child in children]
+        site_to_column, column_to_site = _get_subtree_columns(
+                node, child_maps, observable_nodes, iid_observations)
+
+        # The array of a node starts from the product for its first child,
+        # to which its observations are applied in place.
+        # A node without children starts from its indicator array.
+        arr = None
+        log_scale = np.zeros(len(column_to_site))
 
         # When an internal node is activated,
         # this newly activated observational array is elementwise multiplied
@@ -236,39 +595,48 @@ def get_conditional_likelihoods(
         # then we could inactivate the child nodes and delete
         # their associated arrays, but because we want to re-use the
         # per-node arrays for edge length gradients, we keep them.
-        for child in T.successors(node):
-            arr *= node_to_array[child]
+        for child, child_map in zip(children, child_maps):
+            # Rescale the columns after each product if requested,
+            # so that nodes with many children do not underflow.
+            columns = child_map[column_to_site]
+            child_arr = node_to_array[child][:, columns]
+            if arr is None:
+                arr = child_arr.astype(dtype, copy=False)
+                encoding.apply(node, arr, column_to_site)
+            else:
+                arr *= child_arr
+            log_scale += node_to_scale[child][columns]
+            if node_to_log_scale is not None:
+                log_scale += rescale_columns(arr)
             if not store_all:
                 del node_to_array[child]
+                del node_to_map[child]
+                del node_to_scale[child]
+        if arr is None:
+            arr = encoding.create_array(node, column_to_site, dtype)
 
         # When any node that is not the root is activated,
         # the matrix product P.dot(A) replaces A,
         # where A is the active array and P is the matrix exponential
         # associated with the parent edge.
+        # The product is computed only for the distinct columns,
+        # and it is skipped for edges with zero rate.
         if node != root:
             edge = child_to_edge[node]
             edge_rate = edge_to_rate[edge]
             edge_process = edge_to_process[edge]
-            arr = expm_objects[edge_process].expm_mul(edge_rate, arr)
+            if edge_rate:
+                arr = expm_objects[edge_process].expm_mul(edge_rate, arr)
 
         # Associate the array with the current node.
-        assert_equal(arr.shape, (nstates, nsites))
+        assert_equal(arr.shape, (nstates, len(column_to_site)))
         node_to_array[node] = arr
+        node_to_map[node] = site_to_column
+        node_to_scale[node] = log_scale
 
-    # If we had been deleting arrays as they become unnecessary for
-    # the log likelihood calculation, then we would have only
-    # a single active array remaining at this point, corresponding to the root.
-    # But if we are saving the arrays for gradient calculations,
-    # then we have more left.
-    actual_keys = set(node_to_array)
-    if store_all:
-        desired_keys = set(T)
-    else:
-        desired_keys = {root}
-    assert_equal(actual_keys, desired_keys)
-
-    # Return the map from node to array.
-    return node_to_array
+    return _expand_columns(
+            T, root, store_all, unobserved, all_ones,
+            node_to_array, node_to_map, node_to_scale, node_to_log_scale)
 
 def get_preorder_conditional_likelihoods(
         expm_objects,
@@ -280,6 +648,8 @@ def get_preorder_conditional_likelihoods(
         iid_observations,
         prior_distn,
         node_to_postorder_partials,
+        node_to_log_scale=None,
+        node_to_postorder_log_scale=None,
         ):
 
     """
@@ -296,6 +666,14 @@ def get_preorder_conditional_likelihoods(
         These functions compute expm_mul and rate_mul.
     store_all : bool
         Indicates whether all edge arrays should be stored.
+    node_to_log_scale : dict, optional
+        If provided, the columns of the arrays are rescaled
+        to avoid underflow, and this dict is filled with the log of the
+        factor by which each column of the array of each node
+        has been divided.
+    node_to_postorder_log_scale : dict, optional
+        The log scaling factors of the postorder partials,
+        required if the postorder partials have been rescaled.
 
     Returns
     -------
@@ -317,32 +695,45 @@ def get_preorder_conditional_likelihoods(
     # For the few nodes that are active at a given point in the traversal,
     # we track a 2d array of shape (nsites, nstates).
     node_to_preorder_partials = {}
+    node_to_scale = {}
     for node in list(get_node_evaluation_order(T, root))[::-1]:  # reverse the post-order traversal to get a preorder traversal
 
         # When a node is activated, its associated array
         # is initialized to its observational likelihood array.
         arr = np.ones((nstates, nsites), dtype=float)
+        log_scale = np.zeros(nsites)
 
         if node == root:
             arr *= np.transpose([prior_distn])
             node_to_preorder_partials[node] = arr
+            node_to_scale[node] = log_scale
             continue
 
         parent_node = list(T.predecessors(node))[0]
+        # Rescale the columns after each product if requested.
         for child in T.successors(parent_node):
             if child != node:
                 arr *= node_to_postorder_partials[child]
+                if node_to_postorder_log_scale is not None:
+                    log_scale += node_to_postorder_log_scale[child]
+                if node_to_log_scale is not None:
+                    log_scale += rescale_columns(arr)
 
         arr *= node_to_preorder_partials[parent_node]
+        log_scale += node_to_scale[parent_node]
+        if node_to_log_scale is not None:
+            log_scale += rescale_columns(arr)
 
         edge = child_to_edge[node]
         edge_rate = edge_to_rate[edge]
         edge_process = edge_to_process[edge]
-        arr = expm_objects[edge_process].expm_tmul(edge_rate, arr)
+        if edge_rate:
+            arr = expm_objects[edge_process].expm_tmul(edge_rate, arr)
 
         # Associate the array with the current node.
         assert_equal(arr.shape, (nstates, nsites))
         node_to_preorder_partials[node] = arr
+        node_to_scale[node] = log_scale
 
     # If we had been deleting arrays as they become unnecessary for
     # the log likelihood calculation, then we would have only
@@ -357,4 +748,6 @@ def get_preorder_conditional_likelihoods(
     assert_equal(actual_keys, desired_keys)
 
     # Return the map from node to array.
+    if node_to_log_scale is not None:
+        node_to_log_scale.update(node_to_scale)
     return node_to_preorder_partials
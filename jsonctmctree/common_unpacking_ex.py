@@ -12,6 +12,8 @@ import re
 import numpy as np
 import networkx as nx
 
+from .expm_helpers import get_expm_backend_names
+
 __all__ = [
         'UnpackingError',
         'TopLevel',
@@ -30,6 +32,7 @@ request_regex = '|'.join((
     '[dsw][dsw]ntran',
     '[dsw]n[dw]root',
     '[dsw]n[dw]node',
+    '[dsw][dw][dw]grid',
     'ddnance'))
 
 
@@ -87,6 +90,15 @@ def _unpack(obj, d, f, name):
         raise ContentError(msg)
     return setattr(obj, name, value_out)
 
+def _unpack_optional(obj, d, f, name, default=None):
+    """
+    Set an attribute of an object, using a default if the key is missing.
+
+    """
+    if name in d:
+        return _unpack(obj, d, f, name)
+    return setattr(obj, name, default)
+
 def _unpack_object_array(obj, d, f, name):
     try:
         arr_in = d[name]
@@ -102,6 +114,11 @@ def _unpack_object_array(obj, d, f, name):
         arr_out.append(value)
     return setattr(obj, name, arr_out)
 
+def _unpack_optional_object_array(obj, d, f, name, default=None):
+    if name in d:
+        return _unpack_object_array(obj, d, f, name)
+    return setattr(obj, name, default)
+
 def _check_ndim(x, desired_ndim=None):
     if desired_ndim is not None:
         actual_ndim = len(x.shape)
@@ -112,6 +129,21 @@ def _check_ndim(x, desired_ndim=None):
 def _str_lower(x):
     return str(x).lower()
 
+def _expm_backend_name(x):
+    name = _str_lower(x)
+    if name not in get_expm_backend_names():
+        raise ContentError('unrecognized matrix exponential backend "%s"; '
+                'available backends: %s' % (
+                    name, ', '.join(get_expm_backend_names())))
+    return name
+
+def _expm_tolerance(x):
+    value = float(x)
+    if not (0 < value < 1):
+        raise ContentError('expected the matrix exponential tolerance '
+                'to be between 0 and 1')
+    return value
+
 def _np_array(x, dtype=None, ndim=None):
     value = np.array(x, dtype=dtype)
     _check_ndim(value, ndim)
@@ -126,6 +158,15 @@ def _np_array_int_2d(x):
 def _np_array_float_1d(x):
     return _np_array(x, dtype=float, ndim=1)
 
+def _time_grid(x):
+    value = _np_array_float_1d(x)
+    if not value.shape[0]:
+        raise ContentError('expected at least one time grid point')
+    if np.any(value < 0) or np.any(value > 1):
+        raise ContentError('expected each time grid point '
+                'to be a proportion of the edge between 0 and 1')
+    return value
+
 
 class TopLevel(object):
     def __init__(self, d):
@@ -142,6 +183,13 @@ class Scene(object):
         _unpack_object_array(self, d, ProcessDefinition, 'process_definitions')
         _unpack(self, d, Tree, 'tree')
         _unpack(self, d, ObservedData, 'observed_data')
+        _unpack_optional(self, d, _expm_tolerance, 'expm_tolerance')
+        for i, p in enumerate(self.process_definitions):
+            try:
+                p.expand_axis_processes(self.state_space_shape)
+            except UnpackingError as e:
+                raise ContentError('error interpreting entry %d '
+                        'of process_definitions: %s' % (i, str(e)))
 
 class RootPrior(object):
     def __init__(self, d):
@@ -153,10 +201,41 @@ class RootPrior(object):
                     'that of the probabilities array')
 
 class ProcessDefinition(object):
+    """
+    A process is defined either by its transitions or by a Kronecker sum.
+
+    In the Kronecker sum form, each component of the multivariate state
+    has its own univariate process acting independently of the other
+    components, and the optional row_states, column_states,
+    and transition_rates members define an additional coupling
+    between the components.
+    The explicit transitions of the full process are expanded after
+    the state space shape is known, while the axis processes and the
+    coupling are kept for the linear operators that can use them.
+
+    """
     def __init__(self, d):
-        _unpack(self, d, _np_array_int_2d, 'row_states')
-        _unpack(self, d, _np_array_int_2d, 'column_states')
-        _unpack(self, d, _np_array_float_1d, 'transition_rates')
+        _unpack_optional(self, d, _expm_backend_name, 'expm_backend', 'auto')
+        _unpack_optional_object_array(self, d, AxisProcess, 'axis_processes')
+        names = ('row_states', 'column_states', 'transition_rates')
+        if self.axis_processes is None:
+            _unpack(self, d, _np_array_int_2d, 'row_states')
+            _unpack(self, d, _np_array_int_2d, 'column_states')
+            _unpack(self, d, _np_array_float_1d, 'transition_rates')
+        else:
+            _unpack_optional(self, d, _np_array_int_2d, 'row_states')
+            _unpack_optional(self, d, _np_array_int_2d, 'column_states')
+            _unpack_optional(self, d, _np_array_float_1d, 'transition_rates')
+            present = [getattr(self, name) is not None for name in names]
+            if any(present) and not all(present):
+                raise ContentError('in the process definition section '
+                        'of the scene, the coupling of axis processes '
+                        'requires all of %s' % ', '.join(names))
+        self.coupling_row_states = None
+        self.coupling_column_states = None
+        self.coupling_transition_rates = None
+        if self.row_states is None:
+            return
         if self.row_states.shape != self.column_states.shape:
             raise ShapeError('in the process definition section of the scene, '
                     'the shape of the column_states array does not match '
@@ -166,6 +245,68 @@ class ProcessDefinition(object):
                     'the lengths of the states arrays do not match '
                     'that of the transition_rates array')
 
+    def expand_axis_processes(self, state_space_shape):
+        """
+        Expand the Kronecker sum form into explicit transitions.
+
+        Transitions that appear more than once have their rates added.
+
+        """
+        if self.axis_processes is None:
+            return
+        ndim = len(state_space_shape)
+        if len(self.axis_processes) != ndim:
+            raise ShapeError('expected one axis process '
+                    'for each of the %d components of the state space, '
+                    'but found %d' % (ndim, len(self.axis_processes)))
+        if self.row_states is None:
+            self.row_states = np.empty((0, ndim), dtype=int)
+            self.column_states = np.empty((0, ndim), dtype=int)
+            self.transition_rates = np.empty(0, dtype=float)
+        if self.row_states.shape[1] != ndim:
+            raise ShapeError('expected coupling states with %d components' % (
+                ndim))
+        self.coupling_row_states = self.row_states
+        self.coupling_column_states = self.column_states
+        self.coupling_transition_rates = self.transition_rates
+        row_arrays = [self.row_states]
+        col_arrays = [self.column_states]
+        rate_arrays = [self.transition_rates]
+        for axis, a in enumerate(self.axis_processes):
+            n = state_space_shape[axis]
+            for states in a.row_states, a.column_states:
+                if np.any(states < 0) or np.any(states >= n):
+                    raise ContentError('expected the states of axis process '
+                            '%d to be in the range [0, %d)' % (axis, n))
+            other_shape = list(state_space_shape)
+            other_shape[axis] = 1
+            other = np.indices(other_shape).reshape(ndim, -1).T
+            nother = other.shape[0]
+            row = np.repeat(other[np.newaxis, :, :], a.row_states.size, 0)
+            col = row.copy()
+            row[:, :, axis] = a.row_states[:, np.newaxis]
+            col[:, :, axis] = a.column_states[:, np.newaxis]
+            row_arrays.append(row.reshape(-1, ndim))
+            col_arrays.append(col.reshape(-1, ndim))
+            rate_arrays.append(np.repeat(a.transition_rates, nother))
+        self.row_states = np.concatenate(row_arrays)
+        self.column_states = np.concatenate(col_arrays)
+        self.transition_rates = np.concatenate(rate_arrays)
+
+class AxisProcess(object):
+    def __init__(self, d):
+        _unpack(self, d, _np_array_int_1d, 'row_states')
+        _unpack(self, d, _np_array_int_1d, 'column_states')
+        _unpack(self, d, _np_array_float_1d, 'transition_rates')
+        if self.row_states.shape != self.column_states.shape:
+            raise ShapeError('in an axis process definition, '
+                    'the shape of the column_states array does not match '
+                    'that of the row_states array')
+        if self.row_states.shape != self.transition_rates.shape:
+            raise ShapeError('in an axis process definition, '
+                    'the shapes of the states arrays do not match '
+                    'that of the transition_rates array')
+
 class Tree(object):
     def __init__(self, d):
         _unpack(self, d, _np_array_int_1d, 'row_nodes')
@@ -236,6 +377,9 @@ class Request(object):
                 key = name + '_reduction'
                 desired_keys.add(key)
                 _unpack(self, d, reduction, key)
+        if suffix == 'grid':
+            desired_keys.add('time_grid')
+            _unpack(self, d, _time_grid, 'time_grid')
         if actual_keys != desired_keys:
             raise ContentError('The members of a request object do not '
                     'correspond to those expected '
@@ -17,7 +17,7 @@ import numpy as np
 from numpy.testing import assert_equal
 
 from .expm_helpers import (
-        PadeExpm, EigenExpm, ActionExpm,
+        PadeExpm, EigenExpm, ActionExpm, get_expm_backend,
         ImplicitTransitionExpmFrechet,
         ImplicitDwellExpmFrechet)
 
@@ -25,6 +25,8 @@ from .expm_helpers import create_dense_rate_matrix
 
 from .node_ordering import get_node_evaluation_order
 
+from .pyexp.caching import EdgeProductCache
+
 from .common_unpacking import (
         SimpleError,
         SimpleShapeError,
@@ -64,9 +66,13 @@ def get_node_to_marginal_distn(
         observable_nodes,
         observable_axes,
         iid_observations,
-        debug=False):
+        debug=False,
+        edge_products=None):
     """
 
+    The optional edge_products holds the products of transition matrices
+    with subtree likelihood arrays computed by the subtree likelihood pass.
+
     Returns
     -------
     node_to_marginal_distn : dict
@@ -121,8 +127,9 @@ def get_node_to_marginal_distn(
 
             # This vectorized implementation was worked out in
             # one of the test files in this module.
-            A = head_marginal_distn * pseudo_reciprocal(
-                    f[edge_process].expm_mul(edge_rate, subtree_array))
+            A = head_marginal_distn * pseudo_reciprocal(get_edge_product(
+                    f, edge_products, edge, edge_rate, edge_process,
+                    subtree_array))
             B = f[edge_process].expm_rmul(edge_rate, A.T)
             next_distn = B.T * subtree_array
 
@@ -132,6 +139,60 @@ def get_node_to_marginal_distn(
     return node_to_marginal_distn
 
 
+def get_edge_time_grid_distns(
+        f, node_to_subtree_array, node_to_marginal_distn,
+        edge, edge_rate, edge_process, time_grid, edge_products=None):
+    """
+    Compute posterior state distributions at points along an edge.
+
+    Each point of the time grid is a proportion of the edge,
+    from 0 at the head node to 1 at the tail node.
+    The distribution at a point is the elementwise product of the
+    subtree likelihoods propagated back from the tail node
+    and the ratio of the head marginal distribution to the
+    subtree likelihoods propagated to the head node,
+    propagated forward to the point.
+    Backends that provide expm_multi_mul and expm_multi_tmul
+    compute all points of the grid together.
+
+    Returns
+    -------
+    distns : ndarray
+        An array of shape (nstates, nsites, npoints).
+
+    """
+    head_node, tail_node = edge
+    obj = f[edge_process]
+    head_marginal_distn = node_to_marginal_distn[head_node]
+    subtree_array = node_to_subtree_array[tail_node]
+    A = head_marginal_distn * pseudo_reciprocal(get_edge_product(
+            f, edge_products, edge, edge_rate, edge_process, subtree_array))
+    time_grid = np.asarray(time_grid, dtype=float)
+    remaining = edge_rate * (1 - time_grid)
+    elapsed = edge_rate * time_grid
+    if hasattr(obj, 'expm_multi_mul') and hasattr(obj, 'expm_multi_tmul'):
+        below = obj.expm_multi_mul(remaining, subtree_array)
+        above = obj.expm_multi_tmul(elapsed, A)
+    else:
+        below = [obj.expm_mul(r, subtree_array) for r in remaining]
+        above = [obj.expm_tmul(r, A) for r in elapsed]
+    return np.stack([b * a for b, a in zip(below, above)], axis=-1)
+
+
+def get_edge_product(
+        f, edge_products, edge, edge_rate, edge_process, subtree_array):
+    """
+    Return the product of the transition matrix and the subtree array.
+
+    The product is taken from edge_products if it is available there.
+
+    """
+    factory = lambda: f[edge_process].expm_mul(edge_rate, subtree_array)
+    if edge_products is None:
+        return factory()
+    return edge_products.get_product(edge, factory)
+
+
 def pseudo_reciprocal(A):
     """
     Elementwise function 0->0, x->1/x
@@ -150,9 +211,14 @@ def get_edge_to_site_expectations(
         observable_nodes,
         observable_axes,
         iid_observations,
-        debug=False):
+        debug=False,
+        edge_products=None):
     """
 
+    If edge_products is provided then the transition matrix products
+    are taken from it, and only the Frechet part of the block action
+    is computed for each edge.
+
     """
     # Precompute some stuff.
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
@@ -186,14 +252,19 @@ def get_edge_to_site_expectations(
 
         # Use a clever implicit scheme for the exponential integration.
         obj = expm_frechet_objects[edge_process]
-        PR, KR = obj.get_expm_frechet_product(edge_rate, subtree_array)
+        if edge_products is None:
+            PR, KR = obj.get_expm_frechet_product(edge_rate, subtree_array)
+        else:
+            PR = get_edge_product(f, edge_products,
+                    edge, edge_rate, edge_process, subtree_array)
+            KR = obj.get_frechet_product(edge_rate, subtree_array)
         A = head_marginal_distn * pseudo_reciprocal(PR)
         edge_to_site_expectations[edge] = (A * KR).sum(axis=0)
 
     return edge_to_site_expectations
 
 
-def process_json_in(j_in, debug=False):
+def process_json_in(j_in, debug=False, expm_backend='auto'):
 
     if debug:
         print('unpacking json input...', file=sys.stderr)
@@ -242,9 +313,8 @@ def process_json_in(j_in, debug=False):
     # For each process, precompute the objects that are capable
     # of computing expm_mul and rate_mul for log likelihoods
     # and for its derivative with respect to edge-specific rates.
-    #expm_klass = EigenExpm # TODO soft-code this
-    #expm_klass = PadeExpm # TODO soft-code this
-    expm_klass = ActionExpm # TODO soft-code this
+    # The backend may be any name registered in expm_helpers.
+    expm_klass = get_expm_backend(expm_backend)
     f = []
     expm_frechet_objects = []
     for edge_process in range(nprocesses):
@@ -279,8 +349,10 @@ def process_json_in(j_in, debug=False):
     store_all_likelihood_arrays = True
 
     # Precompute conditional likelihood arrays per node.
+    # The transition matrix products along edges are kept for later passes.
     if debug:
         print('computing subtree likelihoods...', file=sys.stderr)
+    edge_products = EdgeProductCache()
     node_to_subtree_array = get_subtree_likelihoods(
             f,
             store_all_likelihood_arrays,
@@ -289,6 +361,7 @@ def process_json_in(j_in, debug=False):
             observable_nodes,
             observable_axes,
             iid_observations,
+            edge_products=edge_products,
             )
 
     # Check the shape of the array.
@@ -323,7 +396,8 @@ def process_json_in(j_in, debug=False):
             observable_nodes,
             observable_axes,
             iid_observations,
-            debug=debug)
+            debug=debug,
+            edge_products=edge_products)
 
     # Check the shape of the array.
     # Avoid copying a lot of huge arrays.
@@ -342,7 +416,8 @@ def process_json_in(j_in, debug=False):
             observable_nodes,
             observable_axes,
             iid_observations,
-            debug=debug)
+            debug=debug,
+            edge_products=edge_products)
 
     # Map expectations back to edge indices.
     # Note that this is per site per edge.
@@ -368,7 +443,8 @@ def process_json_in(j_in, debug=False):
                 observable_nodes,
                 observable_axes,
                 iid_observations,
-                debug=debug)
+                debug=debug,
+                edge_products=edge_products)
 
         # These dwell times will be scaled by the edge-specific scaling factor.
         # We want to remove that effect.
@@ -18,11 +18,16 @@ from scipy.sparse import coo_matrix
 from .pyexp import expm_multiply
 from .pyexp.ctmc_ops import (
         Propagator, SmarterPropagator, ExplicitPropagator,
-        MatrixExponential, RdOperator)
+        MatrixExponential, RdOperator, RdcOperator, RdCOperator,
+        as_canonical_csr, get_multi_matmat, get_adjoint_multi_matmat)
 from .pyexp.linear_system import LinearSystem
+from .pyexp.caching import TransitionMatrixCache
+from .pyexp.cost_model import get_cost_model
 
 
 __all__ = [
+        'register_expm_backend', 'get_expm_backend', 'get_expm_backend_names',
+        'create_expm_object',
         'PadeExpm', 'EigenExpm', 'ActionExpm',
         'ExplicitExpmFrechet',
         'ImplicitDwellExpmFrechet',
@@ -60,6 +65,25 @@ def create_sparse_pre_rate_matrix(state_space_shape, row, col, rate):
     return coo_matrix((rate, (mrow, mcol)), (nstates, nstates))
 
 
+def create_axis_rate_matrices(state_space_shape, axis_rates):
+    """
+    Create a dense pre-rate matrix for each component of the state space.
+
+    Parameters
+    ----------
+    state_space_shape : sequence of integers
+        The number of states of each component of the multivariate process.
+    axis_rates : sequence of (row, col, rate) triples of 1d arrays
+        The univariate transitions and their rates, for each component.
+
+    """
+    assert_equal(len(axis_rates), len(state_space_shape))
+    matrices = []
+    for n, (row, col, rate) in zip(state_space_shape, axis_rates):
+        matrices.append(coo_matrix((rate, (row, col)), (n, n)).A)
+    return matrices
+
+
 def create_sparse_rate_matrix(state_space_shape, row, col, rate):
     """
     Create the rate matrix.
@@ -94,6 +118,10 @@ def create_dense_rate_matrix(state_space_shape, row, col, rate):
     return create_sparse_rate_matrix(state_space_shape, row, col, rate).A
 
 
+def _gradient_red(Q, rate_scaling_factor, left_vector, right_vector):
+    return np.sum(Q.dot(left_vector) * right_vector, axis = 0) * rate_scaling_factor
+
+
 class PadeExpm(object):
     """
     This requires lower memory than EigenExpm.
@@ -103,12 +131,29 @@ class PadeExpm(object):
     def __init__(self, state_space_shape, row, col, rate):
         self.Q = create_sparse_rate_matrix(state_space_shape, row, col, rate)
 
+    def _expm(self, rate_scaling_factor):
+        return scipy.linalg.expm(self.Q.A * rate_scaling_factor)
+
+    def expm_rmul(self, rate_scaling_factor, A):
+        """
+        Compute A * exp(Q * r).
+
+        """
+        return A.dot(self._expm(rate_scaling_factor))
+
     def expm_mul(self, rate_scaling_factor, A):
         """
         Compute exp(Q * r) * A.
 
         """
-        return scipy.linalg.expm(self.Q.A * rate_scaling_factor).dot(A)
+        return self._expm(rate_scaling_factor).dot(A)
+
+    def expm_tmul(self, rate_scaling_factor, A):
+        """
+        Compute exp(Q * r)' * A.
+
+        """
+        return self._expm(rate_scaling_factor).T.dot(A)
 
     def rate_mul(self, rate_scaling_factor, PA):
         """
@@ -118,15 +163,33 @@ class PadeExpm(object):
         """
         return rate_scaling_factor * self.Q.dot(PA)
 
+    def gradient_red(self, rate_scaling_factor, left_vector, right_vector):
+        """
+        Compute r * (p' * Q' * q).
+        This is for gradient calculation.
+
+        """
+        return _gradient_red(self.Q, rate_scaling_factor,
+                left_vector, right_vector)
+
 
-#TODO more carefully treat matrices that can be permuted to block diagonal
-#     with zeros on one of the diagonals.
+# Matrices that can be permuted to block triangular form
+# are treated by the 'block' style of the LinearSystem used by ActionExpm.
 class EigenExpm(object):
     def __init__(self, state_space_shape, row, col, rate):
         self.Q = create_dense_rate_matrix(state_space_shape, row, col, rate)
         self.w, self.U = scipy.linalg.eig(self.Q)
         self.V = scipy.linalg.inv(self.U)
 
+    def expm_rmul(self, rate_scaling_factor, A):
+        """
+        Compute A * exp(Q * r).
+
+        """
+        w_exp = np.exp(self.w * rate_scaling_factor)
+        AU = A.dot(self.U)
+        return (AU * w_exp).dot(self.V).real
+
     def expm_mul(self, rate_scaling_factor, A):
         """
         Compute exp(Q * r) * A.
@@ -136,6 +199,13 @@ class EigenExpm(object):
         VA = self.V.dot(A)
         return (self.U * w_exp).dot(VA).real
 
+    def expm_tmul(self, rate_scaling_factor, A):
+        """
+        Compute exp(Q * r)' * A.
+
+        """
+        return self.expm_rmul(rate_scaling_factor, A.T).T
+
     def rate_mul(self, rate_scaling_factor, PA):
         """
         Compute Q * r * PA.
@@ -144,6 +214,15 @@ class EigenExpm(object):
         """
         return rate_scaling_factor * self.Q.dot(PA)
 
+    def gradient_red(self, rate_scaling_factor, left_vector, right_vector):
+        """
+        Compute r * (p' * Q' * q).
+        This is for gradient calculation.
+
+        """
+        return _gradient_red(self.Q, rate_scaling_factor,
+                left_vector, right_vector)
+
 
 class ActionExpm(object):
     """
@@ -152,11 +231,100 @@ class ActionExpm(object):
     Check some predicted costs and decide whether to use
     the abstract linear operator approach or the explicit matrix
     exponential approach.
+    For small state spaces the linear system is explicit anyway.
+    Otherwise the decision is made per call by a calibrated cost model,
+    using the number of columns, the number of nonzero rates,
+    and the predicted Taylor iteration counts.
+
+    When the explicit approach is used, the transition matrices
+    are memoized in a cache keyed by (process, rate scaling factor).
+    The cache may be shared across the processes of a scene,
+    in which case each process should have a distinct process key.
+
+    If axis rates are provided, then the process is the Kronecker sum
+    of the univariate axis processes, and the row, col, and rate arrays
+    define only the coupling between the axes.
+
+    The optional stationary distribution is a candidate with respect to
+    which the process may satisfy detailed balance,
+    for example the prior distribution at the root.
+
+    The style is passed to the LinearSystem.
+
+    If the dtype is single precision then the matrix exponential products
+    are returned in single precision, and the explicit transition matrices
+    are cached in single precision.
+
+    The optional nthreads is the number of threads that share
+    the columns of each product computed without explicit transition
+    matrices, defaulting to the JSONCTMCTREE_NUM_THREADS environment variable.
+
+    The optional tol is a requested accuracy of the products computed
+    without explicit transition matrices.
+    The largest error estimate reported by the propagator since the object
+    was created is available as the max_error_estimate attribute,
+    which is None if no estimate has been reported.
 
     """
-    def __init__(self, state_space_shape, row, col, rate, debug=False):
+    def __init__(self, state_space_shape, row, col, rate, debug=False,
+            cache=None, process=None, axis_rates=None, stationary_distn=None,
+            cost_model=None, style='auto', dtype=None, tol=None,
+            nthreads=None):
         R = create_sparse_pre_rate_matrix(state_space_shape, row, col, rate)
-        self._L = LinearSystem(R)
+        axis_matrices = None
+        if axis_rates is not None:
+            axis_matrices = create_axis_rate_matrices(
+                    state_space_shape, axis_rates)
+        self._dtype = None if dtype is None else np.dtype(dtype)
+        self._L = LinearSystem(R, style=style, axis_matrices=axis_matrices,
+                stationary_distn=stationary_distn, dtype=self._dtype, tol=tol,
+                nthreads=nthreads)
+        self.max_error_estimate = None
+        self._explicit = hasattr(self._L.propagator, '_parameterized_expm')
+        if cache is None:
+            cache = TransitionMatrixCache()
+        self._cache = cache
+        self._process = process
+        self._cost_model = cost_model
+
+    def _use_explicit(self, rate_scaling_factor, ncols):
+        # Decide whether to multiply by an explicit transition matrix.
+        # This is per call, because it depends on the number of columns
+        # and on whether the transition matrix is already cached.
+        if self._explicit:
+            return True
+        P = self._L.propagator
+        if not hasattr(P, 'predict_iterations'):
+            return False
+        if self._cost_model is None:
+            self._cost_model = get_cost_model()
+        t = rate_scaling_factor
+        m, s = P.predict_iterations(t, ncols)
+        cached = self._cache.has_transition_matrix(self._process, t)
+        return self._cost_model.prefer_explicit(
+                self._L.shape[0], self._L.nnz, ncols, m, s, cached)
+
+    def _get_transition_matrix(self, rate_scaling_factor):
+        P = self._L.get_explicit_propagator()
+        t = rate_scaling_factor
+        def factory():
+            return self._astype(P._parameterized_expm(t))
+        return self._cache.get_transition_matrix(self._process, t, factory)
+
+    def _note_error_estimate(self):
+        # Track the largest error estimate of the propagator, if any.
+        err = getattr(self._L.propagator, 'error_estimate', None)
+        if err is not None:
+            if self.max_error_estimate is None:
+                self.max_error_estimate = err
+            else:
+                self.max_error_estimate = max(self.max_error_estimate, err)
+
+    def _astype(self, A):
+        # Convert the array to the working precision, if any.
+        if self._dtype is None:
+            return A
+        return A.astype(self._dtype, copy=False)
 
     def expm_rmul(self, rate_scaling_factor, A):
         """
@@ -165,24 +333,66 @@ class ActionExpm(object):
         This uses the fact that exp(X.T) = exp(X).T.
 
         """
+        A = self._astype(A)
+        ncols = A.shape[0] if A.ndim > 1 else 1
+        if self._use_explicit(rate_scaling_factor, ncols):
+            return A.dot(self._get_transition_matrix(rate_scaling_factor))
         P = MatrixExponential(self._L.propagator, rate_scaling_factor)
-        return P.T.dot(A.T).T
+        PA = P.T.dot(A.T).T
+        self._note_error_estimate()
+        return self._astype(PA)
 
     def expm_mul(self, rate_scaling_factor, A):
         """
         Compute exp(Q * r) * A.
 
         """
+        A = self._astype(A)
+        ncols = A.shape[1] if A.ndim > 1 else 1
+        if self._use_explicit(rate_scaling_factor, ncols):
+            return self._get_transition_matrix(rate_scaling_factor).dot(A)
         P = MatrixExponential(self._L.propagator, rate_scaling_factor)
-        return P.dot(A)
+        PA = P.dot(A)
+        self._note_error_estimate()
+        return self._astype(PA)
 
     def expm_tmul(self, rate_scaling_factor, A):
         """
         Compute exp(Q * r)' * A.
 
         """
+        A = self._astype(A)
+        ncols = A.shape[1] if A.ndim > 1 else 1
+        if self._use_explicit(rate_scaling_factor, ncols):
+            return self._get_transition_matrix(rate_scaling_factor).T.dot(A)
         P = MatrixExponential(self._L.propagator, rate_scaling_factor)
-        return P.T.dot(A)
+        PA = P.T.dot(A)
+        self._note_error_estimate()
+        return self._astype(PA)
+
+    def expm_multi_mul(self, rate_scaling_factors, A):
+        """
+        Compute exp(Q * r) * A for each r in a sequence.
+
+        The transition matrices are not cached,
+        because the scaling factors are typically not reused.
+
+        """
+        A = self._astype(A)
+        out = get_multi_matmat(self._L.propagator, rate_scaling_factors, A)
+        self._note_error_estimate()
+        return [self._astype(PA) for PA in out]
+
+    def expm_multi_tmul(self, rate_scaling_factors, A):
+        """
+        Compute exp(Q * r)' * A for each r in a sequence.
+
+        """
+        A = self._astype(A)
+        out = get_adjoint_multi_matmat(
+                self._L.propagator, rate_scaling_factors, A)
+        self._note_error_estimate()
+        return [self._astype(PA) for PA in out]
 
     def rate_mul(self, rate_scaling_factor, PA):
         """
@@ -200,7 +410,7 @@ class ActionExpm(object):
 
         """
         Q = self._L.instantaneous_operator
-        return np.sum(Q.dot(left_vector) * right_vector, axis = 0) * rate_scaling_factor
+        return _gradient_red(Q, rate_scaling_factor, left_vector, right_vector)
 
 
 class ActionExpmOld(object):
@@ -233,6 +443,14 @@ class ActionExpmOld(object):
         return self._wrapped_expm_multiply(
                 rate_scaling_factor * self.Q, A)
 
+    def expm_tmul(self, rate_scaling_factor, A):
+        """
+        Compute exp(Q * r)' * A.
+
+        """
+        return self._wrapped_expm_multiply(
+                rate_scaling_factor * self.Q.T, A)
+
     def rate_mul(self, rate_scaling_factor, PA):
         """
         Compute Q * r * PA.
@@ -241,6 +459,15 @@ class ActionExpmOld(object):
         """
         return rate_scaling_factor * self.Q.dot(PA)
 
+    def gradient_red(self, rate_scaling_factor, left_vector, right_vector):
+        """
+        Compute r * (p' * Q' * q).
+        This is for gradient calculation.
+
+        """
+        return _gradient_red(self.Q, rate_scaling_factor,
+                left_vector, right_vector)
+
 
 class ExplicitExpmFrechet(object):
     """
@@ -268,6 +495,35 @@ class ExplicitExpmFrechet(object):
 
 
 class ImplicitExpmFrechetBase(object):
+    """
+    The block upper triangular matrix is represented by a structured operator.
+
+    The upper-left and lower-right blocks share one sparse rate operator
+    and the upper-right block is either a diagonal or a sparse matrix,
+    so the 2n x 2n matrix is never assembled.
+    The propagator of the structured operator caches its norm estimates,
+    so they are computed once for the process and reduction
+    rather than once per edge.
+
+    """
+    def _init_propagator(self, R, C):
+        # R is the sparse pre-rate matrix of the process.
+        # C is either a 1d array representing the diagonal upper-right block
+        # or a sparse matrix representing the full upper-right block.
+        R = as_canonical_csr(R)
+        nstates = R.shape[0]
+        exit_rates = R.sum(axis=1).A.ravel()
+        assert_equal(exit_rates.shape, (nstates, ))
+        d = -exit_rates
+        mu = np.mean(d) if nstates else 0
+        Rd = RdOperator(R, d - mu)
+        if C.ndim == 1:
+            op = RdcOperator(Rd, C)
+        else:
+            op = RdCOperator(Rd, as_canonical_csr(C))
+        self.nstates = nstates
+        self._propagator = Propagator(op, mu)
+
     def get_expm_frechet_product(self, rate_scaling_factor, A):
         """
         expm([[R - D, R o E],    A0
@@ -282,12 +538,35 @@ class ImplicitExpmFrechetBase(object):
         K dot A
 
         """
-        AA = np.vstack((A, A))
-        BB = expm_multiply(self.F * rate_scaling_factor, AA)
-        PA = BB[self.nstates:]
-        KA = BB[:self.nstates] - PA
+        n = self.nstates
+        AA = np.empty((2*n, A.shape[1]), dtype=np.result_type(A, float))
+        AA[:n] = A
+        AA[n:] = A
+        BB = self._propagator._parameterized_matmat(rate_scaling_factor, AA)
+        PA = BB[n:]
+        KA = BB[:n]
+        KA -= PA
         return PA, KA
 
+    def get_frechet_product(self, rate_scaling_factor, A):
+        """
+        expm([[R - D, R o E],    0
+              [  0,   R - D]])   A
+
+        This is for callers that already have P dot A.
+        The upper block of the action is K dot A without a subtraction.
+
+        Returns
+        -------
+        K dot A
+
+        """
+        n = self.nstates
+        AA = np.zeros((2*n, A.shape[1]), dtype=np.result_type(A, float))
+        AA[n:] = A
+        BB = self._propagator._parameterized_matmat(rate_scaling_factor, AA)
+        return BB[:n]
+
 
 #####################################################
 # implicit expm frechet to compute dwell expectations
@@ -300,7 +579,7 @@ class ImplicitDwellExpmFrechet(ImplicitExpmFrechetBase):
     """
     def __init__(self, state_space_shape, row, col, rate, s_state, s_weight):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define a structured operator with shape (2n, 2n) where n is nstates.
 
         [[R - D,   E  ],
          [  0,   R - D]]
@@ -312,38 +591,19 @@ class ImplicitDwellExpmFrechet(ImplicitExpmFrechetBase):
 
         """
         nstates = np.prod(state_space_shape)
-        self.nstates = nstates
 
         # Initialize the upper-left sparse matrix.
-        Q00 = create_sparse_pre_rate_matrix(
+        R = create_sparse_pre_rate_matrix(
                 state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
-
-        # Initialize the upper-right sparse diagonal matrix.
-        Q01 = create_sparse_pre_rate_matrix(
-                state_space_shape, s_state, s_state, s_weight)
-        Q01.col += nstates
 
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
+        # Initialize the upper-right diagonal matrix.
+        # Repeated states have their weights added together.
+        E = np.zeros(nstates)
+        if len(s_weight):
+            states = np.ravel_multi_index(s_state.T, state_space_shape)
+            np.add.at(E, states, s_weight)
 
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
-
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        self._init_propagator(R, E)
 
 
 ##########################################################
@@ -367,7 +627,7 @@ class ImplicitTransitionExpmFrechet(ImplicitExpmFrechetBase):
     """
     def __init__(self, state_space_shape, row, col, rate, expect):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define a structured operator with shape (2n, 2n) where n is nstates.
 
         [[R - D, R o E],
          [  0,   R - D]]
@@ -378,39 +638,15 @@ class ImplicitTransitionExpmFrechet(ImplicitExpmFrechetBase):
         an algorithm by Al-Mohy et al.
 
         """
-        nstates = np.prod(state_space_shape)
-        self.nstates = nstates
-
         # Initialize the upper-left sparse matrix.
-        Q00 = create_sparse_pre_rate_matrix(
+        R = create_sparse_pre_rate_matrix(
                 state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
 
         # Initialize the upper-right sparse matrix.
-        Q01 = create_sparse_pre_rate_matrix(
+        E = create_sparse_pre_rate_matrix(
                 state_space_shape, row, col, rate * expect)
-        Q01.col += nstates
-
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
-
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
 
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        self._init_propagator(R, E)
 
 
 class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
@@ -422,7 +658,7 @@ class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
             row, col, rate,
             expect_row, expect_col, expect_rate):
         """
-        Define a sparse rate matrix with shape (2n, 2n) where n is nstates.
+        Define a structured operator with shape (2n, 2n) where n is nstates.
 
         [[R - D, R o E],
          [  0,   R - D]]
@@ -443,39 +679,93 @@ class ImplicitTransitionExpmFrechetEx(ImplicitExpmFrechetBase):
             a sequence of floating point rates
 
         """
-        nstates = np.prod(state_space_shape)
-        self.nstates = nstates
-
         # Initialize the upper-left sparse matrix.
-        Q00 = create_sparse_pre_rate_matrix(
-                state_space_shape, row, col, rate)
-        exit_rates = Q00.sum(axis=1).A.flatten()
-        assert_equal(exit_rates.shape, (nstates, ))
+        R = as_canonical_csr(create_sparse_pre_rate_matrix(
+                state_space_shape, row, col, rate))
 
         # Initialize the upper-right sparse matrix.
         # Use sparse matrix elementwise multiplication.
-        R = create_sparse_pre_rate_matrix(
+        E = create_sparse_pre_rate_matrix(
                 state_space_shape, expect_row, expect_col, expect_rate)
-        Q01 = Q00.multiply(R).tocoo()
-        Q01.col += nstates
-        Q01.has_canonical_format = False
-
-        # Define the diagonal entries of the upper-left sparse matrix.
-        Q00.row = np.concatenate((Q00.row, np.arange(nstates)))
-        Q00.col = np.concatenate((Q00.col, np.arange(nstates)))
-        Q00.data = np.concatenate((Q00.data, -exit_rates))
-        Q00.has_canonical_format = False
-
-        # Initialize the lower-right sparse matrix.
-        Q11 = Q00.copy()
-        Q11.row += nstates
-        Q11.col += nstates
-
-        # Define the full matrix to be exponentiated.
-        F_row = np.concatenate([Q00.row, Q01.row, Q11.row])
-        F_col = np.concatenate([Q00.col, Q01.col, Q11.col])
-        F_data = np.concatenate([Q00.data, Q01.data, Q11.data])
-        F = coo_matrix((F_data, (F_row, F_col)), (2*nstates, 2*nstates))
-
-        # Store the full matrix.
-        self.F = F
+        C = R.multiply(as_canonical_csr(E))
+
+        self._init_propagator(R, C)
+
+
+#####################################################
+# A registry of backends for the matrix exponential.
+# Each backend is a function with the signature
+# f(state_space_shape, row, col, rate, **kwargs)
+# where row, col, and rate define all transitions of the process,
+# returning an object with the methods
+# expm_mul, expm_tmul, expm_rmul, rate_mul, and gradient_red.
+# The keyword arguments are hints that a backend may ignore:
+# debug, cache, process, stationary_distn, dtype, tol, nthreads,
+# and axis_rates together with coupling if the process is a Kronecker sum.
+# A backend that estimates its errors may provide a max_error_estimate
+# attribute.
+
+_expm_backends = {}
+
+
+def register_expm_backend(name, factory):
+    """
+    Register a function that creates matrix exponential objects.
+
+    Parameters
+    ----------
+    name : str
+        Lowercase name of the backend, for example for the scene field
+        process_definitions[i].expm_backend.
+    factory : function
+        Called as factory(state_space_shape, row, col, rate, **kwargs).
+
+    """
+    _expm_backends[name.lower()] = factory
+
+
+def get_expm_backend(name):
+    try:
+        return _expm_backends[name.lower()]
+    except KeyError:
+        raise ValueError('unrecognized matrix exponential backend "%s"; '
+                'available backends: %s' % (
+                    name, ', '.join(get_expm_backend_names())))
+
+
+def get_expm_backend_names():
+    return sorted(_expm_backends)
+
+
+def create_expm_object(name, state_space_shape, row, col, rate, **kwargs):
+    """
+    Create a matrix exponential object using the named backend.
+
+    """
+    factory = get_expm_backend(name)
+    return factory(state_space_shape, row, col, rate, **kwargs)
+
+
+def _create_action_expm_factory(style):
+    def factory(state_space_shape, row, col, rate,
+            axis_rates=None, coupling=None, **kwargs):
+        if axis_rates is not None:
+            row, col, rate = coupling
+        return ActionExpm(state_space_shape, row, col, rate,
+                axis_rates=axis_rates, style=style, **kwargs)
+    return factory
+
+
+def _create_simple_factory(klass):
+    def factory(state_space_shape, row, col, rate, **kwargs):
+        return klass(state_space_shape, row, col, rate)
+    return factory
+
+
+for _style in (
+        'auto', 'dense', 'spectral', 'reversible', 'block', 'abstract',
+        'uniformization', 'krylov', 'chebyshev', 'banded', 'tridiagonal'):
+    register_expm_backend(_style, _create_action_expm_factory(_style))
+register_expm_backend('pade', _create_simple_factory(PadeExpm))
+register_expm_backend('eigen', _create_simple_factory(EigenExpm))
+register_expm_backend('action_old', _create_simple_factory(ActionExpmOld))
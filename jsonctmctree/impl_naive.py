@@ -73,6 +73,7 @@ def _apply_eagerly_precomputed_dwell_objects(
         expm_objects, dwell_objects, node_to_marginal_distn,
         node_to_subtree_likelihoods, prior_distn,
         T, root, edges, edge_rate_pairs, edge_process_pairs,
+        edge_products=None,
         ):
     """
 
@@ -91,7 +92,8 @@ def _apply_eagerly_precomputed_dwell_objects(
             scene.observed_data.nodes,
             scene.observed_data.variables,
             scene.observed_data.iid_observations,
-            debug=False)
+            debug=False,
+            edge_products=edge_products)
 
     # These dwell times will be scaled by the edge-specific scaling factor.
     # We want to remove that effect.
@@ -115,6 +117,7 @@ def _compute_transition_expectations(
         node_to_subtree_likelihoods, prior_distn,
         T, root, edges, edge_rate_pairs, edge_process_pairs,
         debug=False,
+        edge_products=None,
         ):
     """
 
@@ -132,7 +135,8 @@ def _compute_transition_expectations(
             scene.observed_data.nodes,
             scene.observed_data.variables,
             scene.observed_data.iid_observations,
-            debug=debug)
+            debug=debug,
+            edge_products=edge_products)
 
     # Map expectations back to edge indices.
     # This will have shape (nedges, nsites).
@@ -13,14 +13,17 @@ import numpy as np
 from numpy.testing import assert_equal, assert_
 
 from .expm_helpers import (
-        ActionExpm,
+        create_expm_object,
         ImplicitDwellExpmFrechet,
         ImplicitTransitionExpmFrechetEx,
         )
 from .common_likelihood import (
-        get_conditional_likelihoods, get_subtree_likelihoods, get_preorder_conditional_likelihoods)
+        get_conditional_likelihoods, get_subtree_likelihoods, get_preorder_conditional_likelihoods,
+        get_site_patterns, ObservationEncoding)
 from .common_unpacking_ex import TopLevel, interpret_tree, interpret_root_prior
-from .common_reduction import apply_prefixed_reductions, apply_reductions
+from .pyexp.caching import (
+        TransitionMatrixCache, EdgeProductCache, hash_arrays)
+from .common_reduction import apply_prefixed_reductions
 from . import expect
 from . import ll
 from .impl_naive import (
@@ -30,18 +33,74 @@ from .impl_naive import (
         )
 
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
 class InfeasibilityError(Exception):
     pass
 
 
+_precision_to_dtype = {
+        'double' : np.dtype(np.float64),
+        'single' : np.dtype(np.float32),
+        }
+
+
 class Reactor(object):
     """
     This is like a state machine.
 
+    The optional expm_backend is either the name of a matrix exponential
+    backend to use for every process or a sequence of names,
+    one for each process, where None defers to the scene.
+
+    The optional tolerance is a requested accuracy of the matrix
+    exponential products, overriding the expm_tolerance of the scene.
+    If either is provided then the output includes the largest
+    a posteriori error estimate reported by the backends.
+
+    The optional nthreads is the number of threads sharing the columns
+    of the matrix exponential products, defaulting to the environment.
+
+    The precision is either 'double' or 'single'.
+    In single precision the likelihood arrays at nodes and the matrix
+    exponential products use half of the memory,
+    while the likelihoods and their logarithms are accumulated
+    in double precision.
+
+    Sites with identical observations have identical arrays,
+    so the arrays are computed once per distinct site pattern.
+    Per-site responses are expanded from the patterns,
+    and sums over sites are weighted by the pattern counts.
+    Joint ancestral states are sampled independently at each site,
+    so the patterns are not compressed if they are requested.
+
+    The columns of the arrays of the tree passes are rescaled at each node
+    to avoid underflow on large trees, and the logarithms of the scaling
+    factors are accumulated separately for each site.
+    The likelihoods are stored on the scale of the array at the root,
+    and the derivatives and gradients are divided by likelihoods
+    on the same scale.
+
     """
-    def __init__(self, scene, debug=False):
+    def __init__(self, scene, debug=False, expm_backend=None,
+            precision='double', tolerance=None, nthreads=None):
         self.scene = scene
         self.debug = debug
+        if tolerance is None:
+            tolerance = scene.expm_tolerance
+        elif not (0 < tolerance < 1):
+            raise ValueError('expected the tolerance to be between 0 and 1')
+        self.tolerance = tolerance
+        try:
+            self.dtype = _precision_to_dtype[precision]
+        except KeyError:
+            raise ValueError('unrecognized precision "%s"; expected '
+                    'one of %s' % (precision, ', '.join(
+                        sorted(_precision_to_dtype))))
         # interpret some stuff
         self.prior_distn = interpret_root_prior(scene)
         (
@@ -51,13 +110,21 @@ class Reactor(object):
                 self.edge_rate_pairs,
                 self.edge_process_pairs,
                 ) = interpret_tree(scene)
+        self._set_site_patterns(compress=True)
         # init arrays
         self.checked_feasibility = False
         self.node_to_subtree_likelihoods = None
+        self.node_to_subtree_log_scale = None
+        # The transition matrix products along edges computed by the
+        # subtree likelihood pass share the lifetime of the subtree arrays.
+        self.edge_products = None
         self.node_to_conditional_likelihoods = None
+        self.node_to_conditional_log_scale = None
         self.node_to_preorder_conditional_likelihoods = None
+        self.node_to_preorder_log_scale = None
         self.node_to_marginal_distn = None
         self.likelihoods = None
+        self.likelihood_log_scale = None
         self.log_likelihoods = None
         self.derivatives = None
         self.gradients = None
@@ -67,6 +134,7 @@ class Reactor(object):
         # or to compute the posterior distribution at the root,
         # then only the root conditional likelihoods are required.
         self.root_conditional_likelihoods = None
+        self.root_conditional_log_scale = None
         # The root marginal distribution can be computed using
         # the root conditional likelihoods or node_to_subtree_likelihoods
         # or node_to_conditional_likelihoods.
@@ -75,21 +143,118 @@ class Reactor(object):
         # For each process, precompute the objects that are capable
         # of computing expm_mul and rate_mul for log likelihoods
         # and for its derivative with respect to edge-specific rates.
+        # Explicit transition matrices are shared across the passes
+        # through a single cache keyed by process index and edge rate.
+        self.transition_matrix_cache = TransitionMatrixCache()
         self.expm_objects = []
-        for p in scene.process_definitions:
-            obj = ActionExpm(
+        # Processes defined as Kronecker sums keep their axis structure.
+        # The matrix exponential backend of each process is taken from
+        # the scene unless it is overridden by the caller.
+        if expm_backend is None or isinstance(expm_backend, string_types):
+            backends = [expm_backend] * len(scene.process_definitions)
+        else:
+            backends = list(expm_backend)
+        if len(backends) != len(scene.process_definitions):
+            raise ValueError('expected one matrix exponential backend '
+                    'per process definition')
+        # Only a reduced precision is requested from the backends.
+        expm_dtype = None if self.dtype == np.float64 else self.dtype
+        for i, p in enumerate(scene.process_definitions):
+            axis_rates = None
+            coupling = None
+            if p.axis_processes is not None:
+                axis_rates = [(a.row_states, a.column_states, a.transition_rates)
+                        for a in p.axis_processes]
+                coupling = (
+                        p.coupling_row_states,
+                        p.coupling_column_states,
+                        p.coupling_transition_rates)
+            obj = create_expm_object(
+                    backends[i] or p.expm_backend,
                     scene.state_space_shape,
                     p.row_states,
                     p.column_states,
                     p.transition_rates,
-                    debug=debug)
+                    debug=debug,
+                    cache=self.transition_matrix_cache,
+                    process=i,
+                    axis_rates=axis_rates,
+                    coupling=coupling,
+                    stationary_distn=self.prior_distn,
+                    dtype=expm_dtype,
+                    tol=self.tolerance,
+                    nthreads=nthreads)
             self.expm_objects.append(obj)
+        # The expm frechet objects for dwell and transition expectations
+        # are keyed by kind, process index, and the contents of the reduction,
+        # so that repeated reductions reuse the propagators.
+        self._frechet_objects = {}
         self._note('reactor is initialized')
 
+    def _get_frechet_object(self, key, factory):
+        if key not in self._frechet_objects:
+            self._frechet_objects[key] = factory()
+        return self._frechet_objects[key]
+
+    def get_error_estimate(self):
+        """
+        Return the largest error estimate reported by the backends, or None.
+
+        """
+        estimates = []
+        for obj in self.expm_objects:
+            err = getattr(obj, 'max_error_estimate', None)
+            if err is not None:
+                estimates.append(err)
+        return max(estimates) if estimates else None
+
     def _note(self, msg):
         if self.debug:
             print(msg, file=sys.stderr)
 
+    def _set_site_patterns(self, compress):
+        iid_observations = self.scene.observed_data.iid_observations
+        if compress:
+            info = get_site_patterns(iid_observations)
+        else:
+            nsites = iid_observations.shape[0]
+            info = (iid_observations,
+                    np.arange(nsites), np.ones(nsites, dtype=int))
+        self.iid_observations, self.site_to_pattern, self.pattern_counts = info
+        obs = self.scene.observed_data
+        self.observation_encoding = ObservationEncoding(
+                self.scene.state_space_shape, obs.nodes, obs.variables,
+                self.iid_observations)
+
+    def _apply_reductions(self, request, out, custom_prefix=None):
+        """
+        Apply the reductions of a request to an array over site patterns.
+
+        The first axis of the array is over the distinct site patterns.
+        Per-site values are expanded from the patterns after the
+        other reductions, and the observation reduction is applied
+        to the patterns with weights accumulated over their sites.
+
+        """
+        if custom_prefix is None:
+            custom_prefix = request.property[:3]
+        s = self.scene.state_space_shape
+        observation_code = custom_prefix[0]
+        if observation_code == 'd':
+            out = apply_prefixed_reductions(s, custom_prefix, request, out)
+            return np.take(out, self.site_to_pattern, axis=0)
+        if observation_code == 's':
+            weights = self.pattern_counts
+        else:
+            reduction = request.observation_reduction
+            weights = np.bincount(
+                    self.site_to_pattern[reduction.observation_indices],
+                    weights=reduction.weights,
+                    minlength=len(self.pattern_counts))
+        out = np.tensordot(weights, out, axes=([0], [0]))
+        custom_prefix = 'x' + custom_prefix[1:]
+        return apply_prefixed_reductions(s, custom_prefix, request, out)
+
     def _delete_root_marginal_distn(self, unmet_core_requests):
         if self.root_marginal_distn is None:
             return False
@@ -106,6 +271,7 @@ class Reactor(object):
         if unmet_core_requests & {'logl', 'deri', 'grad', 'root'}:
             return False
         self.root_conditional_likelihoods = None
+        self.root_conditional_log_scale = None
         return True
 
     def _delete_likelihoods(self, unmet_core_requests):
@@ -119,6 +285,7 @@ class Reactor(object):
             if self.log_likelihoods is None:
                 return False
         self.likelihoods = None
+        self.likelihood_log_scale = None
         return True
 
     def _delete_log_likelihoods(self, unmet_core_requests):
@@ -132,9 +299,11 @@ class Reactor(object):
     def _delete_node_to_subtree_likelihoods(self, unmet_core_requests):
         if self.node_to_subtree_likelihoods is None:
             return False
-        if unmet_core_requests & {'dwel', 'tran', 'root', 'node'}:
+        if unmet_core_requests & {'dwel', 'tran', 'root', 'node', 'grid'}:
             return False
         self.node_to_subtree_likelihoods = None
+        self.node_to_subtree_log_scale = None
+        self.edge_products = None
         return True
 
     def _delete_node_to_conditional_likelihoods(self, unmet_core_requests):
@@ -143,15 +312,17 @@ class Reactor(object):
         if unmet_core_requests & {'logl', 'deri', 'grad', 'root', 'ance'}:
             return False
         self.node_to_conditional_likelihoods = None
+        self.node_to_conditional_log_scale = None
 
         if unmet_core_requests & {'grad'}:
             self.node_to_preorder_conditional_likelihoods = None
+            self.node_to_preorder_log_scale = None
         return True
 
     def _delete_node_to_marginal_distn(self, unmet_core_requests):
         if self.node_to_marginal_distn is None:
             return False
-        if unmet_core_requests & {'dwel', 'tran', 'root', 'node'}:
+        if unmet_core_requests & {'dwel', 'tran', 'root', 'node', 'grid'}:
             return False
         self.node_to_marginal_distn = None
         return True
@@ -222,16 +393,25 @@ class Reactor(object):
             return False
         if self.root_conditional_likelihoods is not None:
             arr = self.root_conditional_likelihoods
+            log_scale = self.root_conditional_log_scale
         elif self.node_to_subtree_likelihoods is not None:
             arr = self.node_to_subtree_likelihoods[self.root]
+            log_scale = self.node_to_subtree_log_scale[self.root]
         elif self.node_to_conditional_likelihoods is not None:
             arr = self.node_to_conditional_likelihoods[self.root]
+            log_scale = self.node_to_conditional_log_scale[self.root]
         else:
             return False
-        self.likelihoods = self.prior_distn.dot(arr)
+        # Accumulate the likelihoods in double precision.
+        self.likelihoods = self._get_root_likelihoods(arr)
+        self.likelihood_log_scale = log_scale
         assert_equal(len(self.likelihoods.shape), 1)
         return True
 
+    def _get_root_likelihoods(self, arr):
+        arr = arr.astype(np.float64, copy=False)
+        return self.prior_distn.dot(arr)
+
     def _create_log_likelihoods(self, unmet_core_requests):
         if self.log_likelihoods is not None:
             return False
@@ -239,7 +419,8 @@ class Reactor(object):
             return False
         if self.likelihoods is None:
             return False
-        self.log_likelihoods = np.log(self.likelihoods)
+        self.log_likelihoods = (
+                np.log(self.likelihoods) + self.likelihood_log_scale)
         return True
 
     def _create_derivatives(self, unmet_core_requests):
@@ -268,13 +449,18 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations)
+                self.iid_observations,
+                node_to_log_scale=self.node_to_conditional_log_scale,
+                encoding=self.observation_encoding)
 
         # Fill an array with all unreduced derivatives.
-        iid_observation_count = len(self.scene.observed_data.iid_observations)
+        # The derivatives are on the scale of the conditional likelihoods.
+        likelihoods = self._get_root_likelihoods(
+                self.node_to_conditional_likelihoods[self.root])
+        iid_observation_count = len(self.iid_observations)
         self.derivatives = np.empty((iid_observation_count, nedges))
         for ei, der in ei_to_derivatives.items():
-            self.derivatives[:, ei] = der / self.likelihoods
+            self.derivatives[:, ei] = der / likelihoods
         return True
 
     def _create_gradients(self, unmet_core_requests):
@@ -303,13 +489,19 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations)
+                self.iid_observations,
+                self.node_to_conditional_log_scale,
+                self.node_to_preorder_log_scale,
+                encoding=self.observation_encoding)
 
         # Fill an array with all unreduced derivatives.
-        iid_observation_count = len(self.scene.observed_data.iid_observations)
+        # The gradients are on the scale of the conditional likelihoods.
+        likelihoods = self._get_root_likelihoods(
+                self.node_to_conditional_likelihoods[self.root])
+        iid_observation_count = len(self.iid_observations)
         self.gradients = np.empty((iid_observation_count, nedges))
         for ei, der in ei_to_gradients.items():
-            self.gradients[:, ei] = der / self.likelihoods
+            self.gradients[:, ei] = der / likelihoods
         return True
 
     def _create_node_to_joint_ancestral_state(self, unmet_core_requests):
@@ -334,8 +526,9 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
-                self.prior_distn,)
+                self.iid_observations,
+                self.prior_distn,
+                encoding=self.observation_encoding)
 
         return True
 
@@ -356,6 +549,7 @@ class Reactor(object):
             if not (unmet_core_requests & {'logl', 'root'}):
                 return False
         store_all = False
+        node_to_log_scale = {}
         d = get_conditional_likelihoods(
                 self.expm_objects,
                 store_all,
@@ -367,9 +561,13 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
+                dtype=self.dtype,
+                node_to_log_scale=node_to_log_scale,
+                encoding=self.observation_encoding,
                 )
         self.root_conditional_likelihoods = d[self.root]
+        self.root_conditional_log_scale = node_to_log_scale[self.root]
         return True
 
     def _create_node_to_conditional_likelihoods(self, unmet_core_requests):
@@ -379,6 +577,7 @@ class Reactor(object):
             # other likelihood objects can be used for non-deri applications
             return False
         store_all = True
+        self.node_to_conditional_log_scale = {}
         self.node_to_conditional_likelihoods = get_conditional_likelihoods(
                 self.expm_objects,
                 store_all,
@@ -390,11 +589,15 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
+                dtype=self.dtype,
+                node_to_log_scale=self.node_to_conditional_log_scale,
+                encoding=self.observation_encoding,
                 )
 
         if (unmet_core_requests & {'grad'}):
             # store preorder partials too
+            self.node_to_preorder_log_scale = {}
             self.node_to_preorder_conditional_likelihoods = get_preorder_conditional_likelihoods(
                 self.expm_objects,
                 store_all,
@@ -406,20 +609,24 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
                 self.prior_distn,
-                self.node_to_conditional_likelihoods
+                self.node_to_conditional_likelihoods,
+                node_to_log_scale=self.node_to_preorder_log_scale,
+                node_to_postorder_log_scale=self.node_to_conditional_log_scale,
             )
         return True
 
     def _create_node_to_subtree_likelihoods(self, unmet_core_requests):
         if self.node_to_subtree_likelihoods is not None:
             return False
-        if not (unmet_core_requests & {'dwel', 'tran', 'node'}):
+        if not (unmet_core_requests & {'dwel', 'tran', 'node', 'grid'}):
             # other likelihood objects can take over for other applications
             return False
         #TODO restrict the requested number of arrays
         store_all = True
+        self.edge_products = EdgeProductCache()
+        self.node_to_subtree_log_scale = {}
         self.node_to_subtree_likelihoods = get_subtree_likelihoods(
                 self.expm_objects,
                 store_all,
@@ -431,14 +638,18 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
+                self.iid_observations,
+                dtype=self.dtype,
+                edge_products=self.edge_products,
+                node_to_log_scale=self.node_to_subtree_log_scale,
+                encoding=self.observation_encoding,
                 )
         return True
 
     def _create_node_to_marginal_distn(self, unmet_core_requests):
         if self.node_to_marginal_distn is not None:
             return False
-        if not (unmet_core_requests & {'dwel', 'tran', 'node'}):
+        if not (unmet_core_requests & {'dwel', 'tran', 'node', 'grid'}):
             return False
         if self.node_to_subtree_likelihoods is None:
             return False
@@ -454,8 +665,9 @@ class Reactor(object):
                 self.scene.state_space_shape,
                 self.scene.observed_data.nodes,
                 self.scene.observed_data.variables,
-                self.scene.observed_data.iid_observations,
-                debug=debug)
+                self.iid_observations,
+                debug=debug,
+                edge_products=self.edge_products)
         return True
 
 
@@ -467,6 +679,7 @@ class Reactor(object):
     #{D,S,W}{D,S,W}NTRAN : 9
     #{D,S,W}N{D,W}ROOT : 6
     #{D,S,W}N{D,W}NODE : 6
+    #{D,S,W}{D,W}{D,W}GRID : 12
 
     def _respond_to_root(self, unmet_core_requests, requests, responses):
         if 'root' not in unmet_core_requests:
@@ -478,8 +691,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'root':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, full_array)
+                out = self._apply_reductions(request, full_array)
                 responses[i] = out.tolist()
         return True
 
@@ -492,8 +704,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'logl':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, self.log_likelihoods)
+                out = self._apply_reductions(request, self.log_likelihoods)
                 responses[i] = out.tolist()
         return True
 
@@ -506,8 +717,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'deri':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, self.derivatives)
+                out = self._apply_reductions(request, self.derivatives)
                 responses[i] = out.tolist()
         return True
 
@@ -520,8 +730,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'grad':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, self.gradients)
+                out = self._apply_reductions(request, self.gradients)
                 responses[i] = out.tolist()
         return True
 
@@ -538,8 +747,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'ance':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, full_node_array)
+                out = self._apply_reductions(request, full_node_array)
                 responses[i] = out.tolist()
         return True
 
@@ -556,8 +764,7 @@ class Reactor(object):
             prefix = request.property[:3]
             suffix = request.property[-4:]
             if suffix == 'node':
-                s = self.scene.state_space_shape
-                out = apply_reductions(s, request, full_node_array)
+                out = self._apply_reductions(request, full_node_array)
                 responses[i] = out.tolist()
         return True
 
@@ -570,7 +777,7 @@ class Reactor(object):
             return False
 
         # Precompute some counts.
-        nsites = self.scene.observed_data.iid_observations.shape[0]
+        nsites = self.iid_observations.shape[0]
         nstates = np.prod(self.scene.state_space_shape)
 
         # If any dwell request does not reduce the 'state' axis,
@@ -611,15 +818,15 @@ class Reactor(object):
                         self.root,
                         self.edges,
                         self.edge_rate_pairs,
-                        self.edge_process_pairs))
+                        self.edge_process_pairs,
+                        edge_products=self.edge_products))
             full_dwell_array = np.array(arr).T
             # Use the full dwell array to meet the requests.
             for i, request in enumerate(requests):
                 prefix = request.property[:3]
                 suffix = request.property[-4:]
                 if suffix == 'dwel':
-                    s = self.scene.state_space_shape
-                    out = apply_reductions(s, request, full_dwell_array)
+                    out = self._apply_reductions(request, full_dwell_array)
                     responses[i] = out.tolist()
         else:
             # Compute each reduction separately.
@@ -630,16 +837,21 @@ class Reactor(object):
                     continue
 
                 # Compute the dwell object per process for the request.
+                reduction = request.state_reduction
+                reduction_key = hash_arrays(
+                        reduction.states, reduction.weights)
                 dwell_objects = []
-                for p in self.scene.process_definitions:
-                    obj = ImplicitDwellExpmFrechet(
+                for j, p in enumerate(self.scene.process_definitions):
+                    factory = lambda p=p: ImplicitDwellExpmFrechet(
                             self.scene.state_space_shape,
                             p.row_states,
                             p.column_states,
                             p.transition_rates,
-                            request.state_reduction.states,
-                            request.state_reduction.weights,
+                            reduction.states,
+                            reduction.weights,
                             )
+                    obj = self._get_frechet_object(
+                            ('dwel', j, reduction_key), factory)
                     dwell_objects.append(obj)
 
                 # Use the dwell object to compute the reduction.
@@ -658,8 +870,9 @@ class Reactor(object):
                         self.scene.state_space_shape,
                         self.scene.observed_data.nodes,
                         self.scene.observed_data.variables,
-                        self.scene.observed_data.iid_observations,
-                        debug=False)
+                        self.iid_observations,
+                        debug=False,
+                        edge_products=self.edge_products)
 
                 # These dwell times will have been scaled
                 # by the edge-specific scaling factor.
@@ -685,11 +898,8 @@ class Reactor(object):
                 custom_prefix = ''.join(custom_prefix)
 
                 # Compute the requested reduction using the custom prefix.
-                out = apply_prefixed_reductions(
-                    self.scene.state_space_shape,
-                    custom_prefix,
-                    request,
-                    dwell_array)
+                out = self._apply_reductions(
+                        request, dwell_array, custom_prefix)
                 responses[i] = out.tolist()
 
         return True
@@ -708,17 +918,23 @@ class Reactor(object):
                 continue
 
             # Create the request-specific expm transition objects.
+            reduction = request.transition_reduction
+            reduction_key = hash_arrays(
+                    reduction.row_states, reduction.column_states,
+                    reduction.weights)
             expm_transition_objects = []
-            for p in self.scene.process_definitions:
-                obj = ImplicitTransitionExpmFrechetEx(
+            for j, p in enumerate(self.scene.process_definitions):
+                factory = lambda p=p: ImplicitTransitionExpmFrechetEx(
                         self.scene.state_space_shape,
                         p.row_states,
                         p.column_states,
                         p.transition_rates,
-                        request.transition_reduction.row_states,
-                        request.transition_reduction.column_states,
-                        request.transition_reduction.weights,
+                        reduction.row_states,
+                        reduction.column_states,
+                        reduction.weights,
                         )
+                obj = self._get_frechet_object(
+                        ('tran', j, reduction_key), factory)
                 expm_transition_objects.append(obj)
             arr = _compute_transition_expectations(
                 self.scene,
@@ -732,17 +948,74 @@ class Reactor(object):
                 self.edges,
                 self.edge_rate_pairs,
                 self.edge_process_pairs,
-                debug=False)
+                debug=False,
+                edge_products=self.edge_products)
             out = np.array(arr).T
 
             # Apply further reductions.
-            s = self.scene.state_space_shape
-            out = apply_reductions(s, request, out)
+            out = self._apply_reductions(request, out)
             responses[i] = out.tolist()
 
         return True
 
 
+    def _respond_to_grid(self, unmet_core_requests, requests, responses):
+        if 'grid' not in unmet_core_requests:
+            return False
+        if self.node_to_subtree_likelihoods is None:
+            return False
+        if self.node_to_marginal_distn is None:
+            return False
+        edge_to_rate = dict(self.edge_rate_pairs)
+        edge_to_process = dict(self.edge_process_pairs)
+        for i, request in enumerate(requests):
+            suffix = request.property[-4:]
+            if suffix != 'grid':
+                continue
+
+            # Only the edges selected by the request are visited.
+            edge_code = request.property[1]
+            if edge_code == 'w':
+                edge_indices = request.edge_reduction.edges
+            else:
+                edge_indices = range(len(self.edges))
+
+            # Compute arrays like (nsites, nstates, npoints) for each edge,
+            # with all points of the time grid computed together.
+            edge_index_to_array = {}
+            for edge_index in edge_indices:
+                if edge_index in edge_index_to_array:
+                    continue
+                edge = self.edges[edge_index]
+                distns = expect.get_edge_time_grid_distns(
+                        self.expm_objects,
+                        self.node_to_subtree_likelihoods,
+                        self.node_to_marginal_distn,
+                        edge,
+                        edge_to_rate[edge],
+                        edge_to_process[edge],
+                        request.time_grid,
+                        edge_products=self.edge_products)
+                edge_index_to_array[edge_index] = np.transpose(
+                        distns, (1, 0, 2)).astype(np.float64, copy=False)
+
+            # Stack the edges or apply the edge reduction directly.
+            # The time grid axis is the last axis of the response.
+            custom_prefix = list(request.property[:3])
+            if edge_code == 'w':
+                weights = request.edge_reduction.weights
+                grid_array = sum(w * edge_index_to_array[edge_index]
+                        for w, edge_index in zip(weights, edge_indices))
+                custom_prefix[1] = 'x'
+            else:
+                grid_array = np.stack([edge_index_to_array[edge_index]
+                    for edge_index in edge_indices], axis=1)
+            custom_prefix = ''.join(custom_prefix)
+            out = self._apply_reductions(request, grid_array, custom_prefix)
+            responses[i] = out.tolist()
+
+        return True
+
     def react(self, requests, responses):
         """
         This is called repeatedly, with some progress made in each call.
@@ -800,6 +1073,8 @@ class Reactor(object):
             return self._note('respond to a "dwel" request')
         if self._respond_to_tran(unmet_core_requests, requests, responses):
             return self._note('respond to a "tran" request')
+        if self._respond_to_grid(unmet_core_requests, requests, responses):
+            return self._note('respond to a "grid" request')
 
         # Create intermediate arrays.
         if self._create_likelihoods(unmet_core_requests):
@@ -829,6 +1104,8 @@ class Reactor(object):
 
     def main(self, requests):
         responses = [None] * len(requests)
+        if any(r.property[-4:] == 'ance' for r in requests):
+            self._set_site_patterns(compress=False)
         try:
             while None in responses or not self.checked_feasibility:
                 self.react(requests, responses)
@@ -839,13 +1116,21 @@ class Reactor(object):
             j_out = dict(
                     status = 'infeasible',
                     responses = None)
+        if self.tolerance is not None:
+            j_out['error_estimate'] = self.get_error_estimate()
         # require that feasibility has been checked
         assert_(self.checked_feasibility)
+        cache = self.transition_matrix_cache
+        self._note('transition matrix cache hits: %d misses: %d' % (
+            cache.hits, cache.misses))
         return j_out
 
 
-def process_json_in(j_in, debug=False, seed = None):
+def process_json_in(j_in, debug=False, seed = None, expm_backend=None,
+        precision='double', tolerance=None, nthreads=None):
     if seed is not None:
         np.random.seed(seed)
     toplevel = TopLevel(j_in)
-    return Reactor(toplevel.scene, debug=debug).main(toplevel.requests)
+    reactor = Reactor(toplevel.scene, debug=debug, expm_backend=expm_backend,
+            precision=precision, tolerance=tolerance, nthreads=nthreads)
+    return reactor.main(toplevel.requests)
@@ -41,6 +41,13 @@ The 6 base properties can be extended as follows to a total of 39 properties:
 {D,S,W}N{D,W}ROOT : 6
 {D,S,W}N{D,W}NODE : 6
 
+The GRID base property gives state distributions at points along edges.
+Its request requires an additional time_grid member,
+a sequence of proportions of each edge from 0 (at the node towards the root)
+to 1 (at the node away from the root),
+and its response array has a final axis for the points of the time grid.
+{D,S,W}{D,W}{D,W}GRID : 12
+
 The interface is limited in that it does not support the following:
     * continuous observations along time intervals
     * non-axis-aligned state aggregate observations
@@ -62,7 +69,8 @@ def diagnose_expm_multiply():
     return _expm_multiply.expm_multiply(None, None)
 
 
-def process_json_in(j_in, debug=False, seed = None):
+def process_json_in(j_in, debug=False, seed = None, expm_backend=None,
+        precision='double', tolerance=None, nthreads=None):
     """
     The part of the input that is the same across requests is as follows.
     I'm bundling all of this stuff together and calling it a 'scene'.
@@ -126,5 +134,37 @@ def process_json_in(j_in, debug=False, seed = None):
         }
         ]
 
+    Each process definition may have an optional 'expm_backend' member
+    naming the method used for its matrix exponentials,
+    defaulting to 'auto'.  The expm_backend argument overrides it,
+    either with one name for all processes or with a sequence of names
+    (or None to defer to the scene) with one entry per process.
+
+    The precision argument is 'double' by default.
+    The 'single' precision uses half of the memory for the large
+    per-node arrays, which may be useful for early iterations
+    of an optimization, while log likelihoods are still accumulated
+    in double precision.
+
+    The tolerance argument, or the optional 'expm_tolerance' member
+    of the scene, requests a relative accuracy for matrix exponential
+    products, trading accuracy for speed when it is larger than
+    the unit roundoff.  If a tolerance is requested then the output
+    has an 'error_estimate' member with the largest a posteriori
+    relative error estimate of the products, or None if no backend
+    estimated its error.
+
+    The iid observations (sites) with identical rows are computed once,
+    and the responses are expanded or weighted back to the sites,
+    so repeated site patterns are cheap.
+
+    The nthreads argument is the number of threads that share the
+    iid observations (columns) of each matrix exponential product
+    computed without an explicit transition matrix.
+    It defaults to the JSONCTMCTREE_NUM_THREADS environment variable,
+    or to 1 if that is not set.
+
     """
-    return impl_v2.process_json_in(j_in, debug=debug, seed = seed)
+    return impl_v2.process_json_in(j_in, debug=debug, seed = seed,
+            expm_backend=expm_backend, precision=precision,
+            tolerance=tolerance, nthreads=nthreads)
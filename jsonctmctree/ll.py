@@ -13,7 +13,7 @@ import networkx as nx
 import numpy as np
 from numpy.testing import assert_equal
 
-from .expm_helpers import PadeExpm, EigenExpm, ActionExpm
+from .expm_helpers import PadeExpm, EigenExpm, ActionExpm, get_expm_backend
 from jsonctmctree.node_ordering import get_node_evaluation_order
 
 from .common_unpacking import (
@@ -24,8 +24,19 @@ from .common_unpacking import (
         get_prior_info)
 
 from .common_likelihood import (
-        create_indicator_array,
-        get_conditional_likelihoods)
+        ObservationEncoding,
+        get_conditional_likelihoods,
+        rescale_columns)
+
+
+def _multiply_observed(encoding, node, arr, factor):
+    # Multiply the array by the factor in place.
+    # If the array is None, then a new array is started from the factor
+    # and the observations at the node are applied to it.
+    if arr is None:
+        return encoding.apply(node, np.array(factor, dtype=float))
+    arr *= factor
+    return arr
 
 
 def get_site_weights(j_in):
@@ -63,11 +74,24 @@ def get_edge_derivative(
         observable_nodes,
         observable_axes,
         iid_observations,
+        node_to_log_scale=None,
+        encoding=None,
         ):
     """
 
+    The observations are applied through the ObservationEncoding if provided.
+
+    If node_to_log_scale is provided then the arrays in node_to_array
+    have rescaled columns, and the arrays along the path to the root
+    are rescaled in the same way.  The returned array is then on the scale
+    of the array at the root in node_to_array.
+
     """
     # Some preprocessing.
+    nsites = iid_observations.shape[0]
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
@@ -78,20 +102,13 @@ def get_edge_derivative(
     # For each edge use a new edge-specific array.
     # Trace the evaluation back to the root.
     node_to_deriv_array = {}
+    node_to_deriv_scale = {}
 
     # Iterate over nodes on the path from the derivative edge tail node
     # up to the root of the tree.
     node = derivative_tail_node
     while True:
-
-        # When a node is activated, its associated array
-        # is initialized to its observational likelihood array.
-        arr = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        log_scale = np.zeros(nsites)
 
         # If we are not analyzing the root node then determine
         # the characteristics of the edge upstream of the node.
@@ -110,18 +127,36 @@ def get_edge_derivative(
         if node == derivative_tail_node:
             arr = node_to_array[node]
             arr = f[edge_process].rate_mul(edge_rate, arr)
+            if node_to_log_scale is not None:
+                log_scale += node_to_log_scale[node]
         else:
+            # The array is started from the first child array,
+            # with the observations at the node applied to it.
+            arr = None
             for child in T.successors(node):
                 if child in node_to_deriv_array:
-                    arr *= node_to_deriv_array[child]
+                    arr = _multiply_observed(encoding, node, arr,
+                            node_to_deriv_array[child])
+                    log_scale += node_to_deriv_scale[child]
                     del node_to_deriv_array[child]
+                    del node_to_deriv_scale[child]
                 else:
-                    arr *= node_to_array[child]
-            if node != root:
+                    arr = _multiply_observed(encoding, node, arr,
+                            node_to_array[child])
+                    if node_to_log_scale is not None:
+                        log_scale += node_to_log_scale[child]
+                if node_to_log_scale is not None:
+                    log_scale += rescale_columns(arr)
+            if node != root and edge_rate:
                 arr = f[edge_process].expm_mul(edge_rate, arr)
 
+        # Rescale the columns if requested.
+        if node_to_log_scale is not None:
+            log_scale += rescale_columns(arr)
+
         # Associate the array with the current node.
         node_to_deriv_array[node] = arr
+        node_to_deriv_scale[node] = log_scale
 
         # If the current node is the root node then we are done.
         # Otherwise move to the parent node.
@@ -135,7 +170,10 @@ def get_edge_derivative(
     # of the edge of interest, only the array at the root
     # should still be active at this point.
     assert_equal(set(node_to_deriv_array), {root})
-    return node_to_deriv_array[root]
+    arr = node_to_deriv_array[root]
+    if node_to_log_scale is not None:
+        arr = arr * np.exp(node_to_deriv_scale[root] - node_to_log_scale[root])
+    return arr
 
 
 def get_edge_derivatives(
@@ -148,6 +186,8 @@ def get_edge_derivatives(
         observable_nodes,
         observable_axes,
         iid_observations,
+        node_to_log_scale=None,
+        encoding=None,
         ):
     """
     Recursively compute conditional likelihoods at the root.
@@ -168,11 +208,20 @@ def get_edge_derivatives(
         map from node to array returned by get_conditional_likelihoods
     distn : 1d array
         prior state distribution at the root
+    node_to_log_scale : dict, optional
+        map from node to the log scaling factors of the columns of
+        its array, if the columns have been rescaled, in which case
+        the derivatives are on the scale of the rescaled likelihoods
+    encoding : ObservationEncoding, optional
+        the compiled observations, shared by the edges
 
     """
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
 
     # Compute the likelihood derivative for each requested edge length.
     edge_index_to_derivatives = dict()
@@ -190,7 +239,9 @@ def get_edge_derivatives(
                 state_space_shape,
                 observable_nodes,
                 observable_axes,
-                iid_observations)
+                iid_observations,
+                node_to_log_scale=node_to_log_scale,
+                encoding=encoding)
 
         # Apply the prior distribution to the array.
         # Now we have the derivatives of the likelihoods with respect
@@ -215,6 +266,7 @@ def sample_joint_ancestral_state(
         observable_axes,
         iid_observations,
         prior_distn,
+        encoding=None,
         ):
     """
     Recursively compute gradients at each edge.
@@ -230,25 +282,30 @@ def sample_joint_ancestral_state(
     distn : 1d array
         prior state distribution at the root
 
+    The sampling distributions are normalized for each site,
+    so the columns of the products are rescaled to avoid underflow.
+
     """
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
     nstates = np.prod(state_space_shape)
     nsites, nobservables = iid_observations.shape
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
 
     node_to_joint_ancestral_state = {}
     for node in list(get_node_evaluation_order(T, root))[::-1]:  # reverse the post-order traversal to get a preorder traversal
 
         if node == root:
-            dist = create_indicator_array(
-                node,
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+            dist = None
             for child in T.successors(root):
-                dist *= node_to_postorder_array[child]
+                dist = _multiply_observed(encoding, node, dist,
+                        node_to_postorder_array[child])
+                rescale_columns(dist)
+            if dist is None:
+                dist = encoding.create_array(node)
             dist *= np.transpose([prior_distn])
             dist = dist / np.sum(dist, axis = 0)
             states = [np.random.choice(range(nstates), 1, replace = True, p = dist[:, i])[0] for i in range(nsites)]
@@ -258,15 +315,14 @@ def sample_joint_ancestral_state(
         # now calculate Pr(x_i | Y) \prop Pr(Y_under_i | x_i) Pr(X_i | X_pa(i)), where X_pa(i) is sampled already
         edge = child_to_edge[node]
         parent_node = list(T.predecessors(node))[0]
-        post_order_partial = create_indicator_array(
-            node,
-            state_space_shape,
-            observable_nodes,
-            observable_axes,
-            iid_observations)
+        post_order_partial = None
         for child in T.successors(node):
             if child != node:
-                post_order_partial *= node_to_postorder_array[child]
+                post_order_partial = _multiply_observed(encoding, node,
+                        post_order_partial, node_to_postorder_array[child])
+                rescale_columns(post_order_partial)
+        if post_order_partial is None:
+            post_order_partial = encoding.create_array(node)
 
         parent_states = node_to_joint_ancestral_state[parent_node]
         parent_state_arr = np.zeros((nstates, nsites), dtype = float)
@@ -291,6 +347,9 @@ def get_edge_gradients(
         observable_nodes,
         observable_axes,
         iid_observations,
+        node_to_postorder_log_scale=None,
+        node_to_preorder_log_scale=None,
+        encoding=None,
         ):
     """
     Recursively compute gradients at each edge.
@@ -305,11 +364,24 @@ def get_edge_gradients(
         map from node to array returned by get_conditional_likelihoods
     distn : 1d array
         prior state distribution at the root
+    node_to_postorder_log_scale : dict, optional
+        map from node to the log scaling factors of the columns of
+        its postorder array, if the columns have been rescaled
+    node_to_preorder_log_scale : dict, optional
+        map from node to the log scaling factors of the columns of
+        its preorder array, if the columns have been rescaled,
+        in which case the gradients are on the scale of the rescaled
+        likelihoods at the root
+    encoding : ObservationEncoding, optional
+        the compiled observations, shared by the edges
 
     """
     child_to_edge = dict((tail, (head, tail)) for head, tail in edges)
     edge_to_rate = dict(edge_rate_pairs)
     edge_to_process = dict(edge_process_pairs)
+    if encoding is None:
+        encoding = ObservationEncoding(state_space_shape,
+                observable_nodes, observable_axes, iid_observations)
 
     # Compute the likelihood derivative for each requested edge length.
     edge_index_to_derivatives = dict()
@@ -319,25 +391,33 @@ def get_edge_gradients(
         derivative_edge = edges[edge_index]
 
         preorder_partial = node_to_preorder_array[derivative_edge[1]]
-        postorder_partial = create_indicator_array(
-                derivative_edge[1],
-                state_space_shape,
-                observable_nodes,
-                observable_axes,
-                iid_observations)
+        postorder_partial = None
+        # Rescale the postorder partial if the arrays have been rescaled.
+        if node_to_postorder_log_scale is not None:
+            log_scale = node_to_preorder_log_scale[derivative_edge[1]].copy()
         for child in T.successors(derivative_edge[1]):
-            postorder_partial *= node_to_postorder_array[child]
+            postorder_partial = _multiply_observed(encoding,
+                    derivative_edge[1], postorder_partial,
+                    node_to_postorder_array[child])
+            if node_to_postorder_log_scale is not None:
+                log_scale += node_to_postorder_log_scale[child]
+                log_scale += rescale_columns(postorder_partial)
+        if postorder_partial is None:
+            postorder_partial = encoding.create_array(derivative_edge[1])
 
         # Compute the array at the root node.
         edge_process = edge_to_process[derivative_edge]
         gradient = f[edge_process].gradient_red(edge_to_rate[derivative_edge], postorder_partial, preorder_partial)
+        if node_to_postorder_log_scale is not None:
+            gradient = gradient * np.exp(
+                    log_scale - node_to_postorder_log_scale[root])
 
         edge_index_to_derivatives[edge_index] = gradient
 
     # Return the map from edge index to edge-specific derivatives.
     return edge_index_to_derivatives
 
-def process_json_in(j_in):
+def process_json_in(j_in, expm_backend='auto'):
 
     # Unpack some sizes and shapes.
     nnodes = j_in['node_count']
@@ -376,9 +456,8 @@ def process_json_in(j_in):
     # For each process, precompute the objects that are capable
     # of computing expm_mul and rate_mul for log likelihoods
     # and for its derivative with respect to edge-specific rates.
-    #expm_klass = EigenExpm # TODO soft-code this
-    #expm_klass = PadeExpm # TODO soft-code this
-    expm_klass = ActionExpm # TODO soft-code this
+    # The backend may be any name registered in expm_helpers.
+    expm_klass = get_expm_backend(expm_backend)
     f = []
     for edge_process in range(nprocesses):
         row = processes_row[edge_process]
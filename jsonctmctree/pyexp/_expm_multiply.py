@@ -250,6 +250,189 @@ def _expm_multiply_simple_core(A, B, t, mu, m_star, s, tol=None, balance=False):
     return F
 
 
+def _expm_multiply_interval(A, B, start=None, stop=None,
+        num=None, endpoint=None, balance=False, status_only=False):
+    """
+    Compute the action of the matrix exponential at multiple time points.
+
+    Parameters
+    ----------
+    A : transposable linear operator
+        The operator whose exponential is of interest.
+    B : ndarray
+        The matrix to be multiplied by the matrix exponential of A.
+    start : scalar, optional
+        The starting time point of the sequence.
+    stop : scalar, optional
+        The end time point of the sequence, unless `endpoint` is set to False.
+        In that case, the sequence consists of all but the last of ``num + 1``
+        evenly spaced time points, so that `stop` is excluded.
+        Note that the step size changes when `endpoint` is False.
+    num : int, optional
+        Number of time points to use.
+    endpoint : bool, optional
+        If True, `stop` is the last time point.  Otherwise, it is not included.
+    balance : bool
+        Indicates whether or not to apply balancing.
+    status_only : bool
+        A flag that is set to True for some debugging and testing operations.
+
+    Returns
+    -------
+    F : ndarray
+        :math:`e^{t_k A} B`
+    status : int
+        An integer status for testing and debugging.
+
+    Notes
+    -----
+    This is algorithm (5.2) in Al-Mohy and Higham (2011).
+
+    There seems to be a typo, where line 15 of the algorithm should be
+    moved to line 6.5 (between lines 6 and 7).
+
+    """
+    if balance:
+        raise NotImplementedError
+    if len(A.shape) != 2 or A.shape[0] != A.shape[1]:
+        raise ValueError('expected A to be like a square matrix')
+    if A.shape[1] != B.shape[0]:
+        raise ValueError('the matrices A and B have incompatible shapes')
+    ident = ident_like(A)
+    n = A.shape[0]
+    if len(B.shape) == 1:
+        n0 = 1
+    elif len(B.shape) == 2:
+        n0 = B.shape[1]
+    else:
+        raise ValueError('expected B to be like a matrix or a vector')
+    u_d = 2**-53
+    tol = u_d
+    mu = trace(A) / float(n)
+
+    # Get the linspace samples, attempting to preserve the linspace defaults.
+    linspace_kwargs = {'retstep' : True}
+    if num is not None:
+        linspace_kwargs['num'] = num
+    if endpoint is not None:
+        linspace_kwargs['endpoint'] = endpoint
+    samples, step = np.linspace(start, stop, **linspace_kwargs)
+
+    # Convert the linspace output to the notation used by the publication.
+    nsamples = len(samples)
+    if nsamples < 2:
+        raise ValueError('at least two time points are required')
+    q = nsamples - 1
+    h = step
+    t_0 = samples[0]
+    t_q = samples[q]
+
+    # Define the output ndarray.
+    # Use an ndim=3 shape, such that the last two indices
+    # are the ones that may be involved in level 3 BLAS operations.
+    X_shape = (nsamples, ) + B.shape
+    X = np.empty(X_shape, dtype=np.result_type(A.dtype, B.dtype, float))
+
+    # Compute the expm action up to the initial time point.
+    X[0] = _expm_multiply_simple(A, B, t_0)
+
+    t = t_q - t_0
+    A = A - mu * ident
+    A_1_norm = exact_1_norm(A)
+    ell = 2
+    if t*A_1_norm == 0:
+        m_star, s = 0, 1
+    else:
+        norm_info = LazyOperatorNormInfo(t*A, A_1_norm=t*A_1_norm, ell=ell)
+        m_star, s = _fragment_3_1(norm_info, n0, tol, ell=ell)
+
+    # Compute the expm action at the rest of the time points.
+    if q <= s:
+        if status_only:
+            return 0
+        return _expm_multiply_interval_core_0(
+                A, X, h, mu, q, A_1_norm, tol, ell, n0)
+    elif not (q % s):
+        if status_only:
+            return 1
+        return _expm_multiply_interval_core_1(A, X, h, mu, m_star, s, q, tol)
+    else:
+        if status_only:
+            return 2
+        return _expm_multiply_interval_core_2(A, X, h, mu, m_star, s, q, tol)
+
+
+def _expm_multiply_interval_core_0(A, X, h, mu, q, A_1_norm, tol, ell, n0):
+    """
+    A helper function, for the case q <= s.
+
+    """
+    # Compute the new values of m_star and s which should be applied
+    # over intervals of size t/q.
+    if h*A_1_norm == 0:
+        m_star, s = 0, 1
+    else:
+        norm_info = LazyOperatorNormInfo(h*A, A_1_norm=h*A_1_norm, ell=ell)
+        m_star, s = _fragment_3_1(norm_info, n0, tol, ell=ell)
+    for k in range(q):
+        X[k+1] = _expm_multiply_simple_core(A, X[k], h, mu, m_star, s, tol)
+    return X, 0
+
+
+def _expm_multiply_interval_core_1(A, X, h, mu, m_star, s, q, tol):
+    """
+    A helper function, for the case q > s and q % s == 0.
+
+    """
+    d = q // s
+    return _expm_multiply_interval_segments(
+            A, X, h, mu, m_star, d, [d] * s, tol), 1
+
+
+def _expm_multiply_interval_core_2(A, X, h, mu, m_star, s, q, tol):
+    """
+    A helper function, for the case q > s and q % s > 0.
+
+    """
+    d = q // s
+    j = q // d
+    r = q - d * j
+    return _expm_multiply_interval_segments(
+            A, X, h, mu, m_star, d, [d] * j + [r], tol), 2
+
+
+def _expm_multiply_interval_segments(A, X, h, mu, m_star, d, counts, tol):
+    """
+    A helper function for the cases q > s.
+
+    Within each segment the scaled Taylor terms of the segment's
+    initial point are computed once and are shared among the
+    time points of the segment.
+
+    """
+    input_shape = X.shape[1:]
+    K_shape = (m_star + 1, ) + input_shape
+    K = np.empty(K_shape, dtype=X.dtype)
+    for i, effective_d in enumerate(counts):
+        K[0] = X[i*d]
+        high_p = 0
+        for k in range(1, effective_d+1):
+            F = K[0]
+            c1 = exact_inf_norm(F)
+            for p in range(1, m_star+1):
+                if p == high_p + 1:
+                    K[p] = h * A.dot(K[p-1]) / float(p)
+                    high_p = p
+                coeff = float(pow(k, p))
+                F = F + coeff * K[p]
+                c2 = coeff * exact_inf_norm(K[p])
+                if c1 + c2 <= tol * exact_inf_norm(F):
+                    break
+                c1 = c2
+            X[k + i*d] = np.exp(k*h*mu) * F
+    return X
+
+
 def _onenormest_matrix_power(A, p,
         t=2, itmax=5, compute_v=False, compute_w=False):
     """
@@ -23,6 +23,15 @@ class HighLevelInterface(object):
         return self._adjoint()
     def dot(self, other):
         return self._matmat(other)
+    def dot_into(self, other, out):
+        # Compute the product into a preallocated output array.
+        # Classes may define _matmat_into to avoid temporary arrays.
+        f = getattr(self, '_matmat_into', None)
+        if f is None:
+            out[...] = self._matmat(other)
+        else:
+            f(other, out)
+        return out
 
 
 class VanillaAdjointOperator(HighLevelInterface):
@@ -41,6 +50,12 @@ class VanillaAdjointOperator(HighLevelInterface):
         return self._L.dtype
     def _matmat(self, other):
         return self._L._my_adjoint_matmat(other)
+    def _matmat_into(self, other, out):
+        f = getattr(self._L, '_my_adjoint_matmat_into', None)
+        if f is None:
+            out[...] = self._L._my_adjoint_matmat(other)
+        else:
+            f(other, out)
     def _adjoint(self):
         return self._L
     def _transpose(self):
@@ -64,6 +79,12 @@ class ExtendedAdjointOperator(HighLevelInterface):
         return self._L.dtype
     def _matmat(self, other):
         return self._L._my_adjoint_matmat(other)
+    def _matmat_into(self, other, out):
+        f = getattr(self._L, '_my_adjoint_matmat_into', None)
+        if f is None:
+            out[...] = self._L._my_adjoint_matmat(other)
+        else:
+            f(other, out)
     def abs_sum_axis_0(self):
         return self._L.abs_sum_axis_1()
     def abs_sum_axis_1(self):
@@ -0,0 +1,210 @@
+"""
+Bounded caches of arrays that are expensive to recompute.
+
+The iteration stash cache persists across calls within a process,
+and if the JSONCTMCTREE_CACHE_DIR environment variable names a directory
+then it also persists across processes through files in that directory.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .experimental import IterationStash
+
+
+__all__ = ['LRUCache', 'TransitionMatrixCache', 'EdgeProductCache',
+        'IterationStashCache', 'get_iteration_stash_cache', 'hash_arrays']
+
+
+_iteration_stash_cache = None
+
+
+def hash_arrays(*arrays):
+    """
+    Return a hex digest of the types, shapes, and contents of the arrays.
+
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(('%s%s' % (a.dtype.str, a.shape)).encode('ascii'))
+        h.update(a.tobytes() if hasattr(a, 'tobytes') else a.tostring())
+    return h.hexdigest()
+
+
+class LRUCache(object):
+    """
+    A least-recently-used cache with a memory cap.
+
+    The cap is on the total number of bytes of the cached ndarrays.
+    Values that are not ndarrays are counted as having no bytes.
+    Hits and misses are counted so that the usefulness of the cache
+    can be checked in practice.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._d = OrderedDict()
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def get(self, key, factory):
+        """
+        Return the cached value, computing and caching it if necessary.
+
+        Parameters
+        ----------
+        key : hashable
+            The cache key.
+        factory : function
+            A function with no arguments that computes the value.
+
+        """
+        try:
+            value = self._d.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = factory()
+            self._insert(key, value)
+        else:
+            self.hits += 1
+            self._d[key] = value
+        return value
+
+    def clear(self):
+        self._d.clear()
+        self.nbytes = 0
+
+    def _insert(self, key, value):
+        nbytes = getattr(value, 'nbytes', 0)
+        if nbytes > self.max_bytes:
+            return
+        self._d[key] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            k, v = self._d.popitem(last=False)
+            self.nbytes -= getattr(v, 'nbytes', 0)
+
+
+class TransitionMatrixCache(LRUCache):
+    """
+    Explicit transition probability matrices keyed by (process, edge rate).
+
+    A single cache is meant to be shared by all of the processes of a scene,
+    so that the forward, transpose, and adjoint products along an edge
+    all reuse one matrix, and so that edges with equal rates
+    and equal processes also reuse the same matrix.
+
+    """
+    def __init__(self, max_bytes=2**26):
+        LRUCache.__init__(self, max_bytes)
+
+    def get_transition_matrix(self, process, rate, factory):
+        return self.get((process, float(rate)), factory)
+
+    def has_transition_matrix(self, process, rate):
+        return (process, float(rate)) in self
+
+
+class EdgeProductCache(LRUCache):
+    """
+    Transition matrix products with subtree likelihood arrays, keyed by edge.
+
+    The product along each edge is computed by the subtree likelihood pass
+    and is needed again by the marginal distribution pass
+    and by the posterior expectation passes.
+    Products that do not fit within the memory cap are recomputed
+    by the later passes when they are needed.
+
+    """
+    def __init__(self, max_bytes=2**28):
+        LRUCache.__init__(self, max_bytes)
+
+    def add_product(self, edge, value):
+        if edge in self._d:
+            self.nbytes -= getattr(self._d.pop(edge), 'nbytes', 0)
+        self._insert(edge, value)
+
+    def get_product(self, edge, factory):
+        return self.get(edge, factory)
+
+
+class IterationStashCache(LRUCache):
+    """
+    Iteration stashes keyed by a content hash of the operator.
+
+    Estimating the norms of powers of an operator is expensive,
+    and it does not depend on the edge rate scaling factors,
+    so the stash of an unchanged process can be reused
+    across calls, for example within an optimization loop
+    that only changes edge rates.
+    If a cache directory is provided then the norms are also
+    stored on disk, one small file per stash.
+
+    """
+    def __init__(self, max_bytes=2**22, cache_dir=None):
+        LRUCache.__init__(self, max_bytes)
+        self.cache_dir = cache_dir
+
+    def _get_filename(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _load(self, key, theta):
+        if self.cache_dir is None:
+            return None
+        try:
+            return IterationStash.from_norms(
+                    np.load(self._get_filename(key)), theta)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, key, stash):
+        if self.cache_dir is None:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            np.save(self._get_filename(key), stash.get_norms())
+        except (IOError, OSError):
+            pass
+
+    def get_iteration_stash(self, key, A, theta=None):
+        """
+        Return the stash of the operator A identified by the string key.
+
+        The key should distinguish stashes with different theta tables.
+
+        """
+        def factory():
+            stash = self._load(key, theta)
+            if stash is None:
+                stash = IterationStash(A, theta)
+                self._save(key, stash)
+            return stash
+        return self.get(key, factory)
+
+
+def get_iteration_stash_cache():
+    """
+    Return the iteration stash cache shared by all propagators.
+
+    """
+    global _iteration_stash_cache
+    if _iteration_stash_cache is None:
+        cache_dir = os.environ.get('JSONCTMCTREE_CACHE_DIR') or None
+        if cache_dir is not None:
+            cache_dir = os.path.join(cache_dir, 'iteration_stash')
+        _iteration_stash_cache = IterationStashCache(cache_dir=cache_dir)
+    return _iteration_stash_cache
@@ -16,7 +16,8 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 from numpy.testing import assert_equal
 
-__all__ = ['MMAX', 'PMAX', 'THETA']
+__all__ = ['MMAX', 'PMAX', 'THETA', 'THETA_SINGLE',
+        'get_theta', 'get_tolerance']
 
 
 MMAX = 55
@@ -87,3 +88,71 @@ THETA = {
         50: 8.5,
         55: 9.9,
         }
+
+
+# These values correspond to single precision u_s = 2**-24,
+# from table 3.1 of Computing the Action of the Matrix Exponential.
+THETA_SINGLE = {
+        5: 1.3e-1,
+        10: 1.0,
+        15: 2.2,
+        20: 3.6,
+        25: 4.9,
+        30: 6.3,
+        35: 7.7,
+        40: 9.1,
+        45: 1.1e1,
+        50: 1.2e1,
+        55: 1.3e1,
+        }
+
+
+def _get_unit_roundoff(dtype):
+    if np.dtype(dtype) == np.float32:
+        return np.ldexp(1, -24)
+    return np.ldexp(1, -53)
+
+
+def _interpolate_theta(tol):
+    # Interpolate log theta linearly in log tol between the double
+    # and single precision tables, extrapolating for larger tolerances.
+    # Only the degrees present in both tables are used.
+    low = np.log(np.ldexp(1, -53))
+    high = np.log(np.ldexp(1, -24))
+    x = (np.log(tol) - low) / (high - low)
+    theta = {}
+    for m in THETA_SINGLE:
+        a = np.log(THETA[m])
+        b = np.log(THETA_SINGLE[m])
+        theta[m] = float(np.exp((1 - x) * a + x * b))
+    return theta
+
+
+def get_theta(dtype, tol=None):
+    """
+    Return the theta table matched to a precision and tolerance.
+
+    Without a tolerance, the table is matched to the unit roundoff
+    of the dtype.  A tolerance smaller than the unit roundoff
+    is not attainable, so the unit roundoff is used instead.
+
+    """
+    tol = get_tolerance(dtype, tol)
+    if tol == np.ldexp(1, -53):
+        return THETA
+    if tol == np.ldexp(1, -24):
+        return THETA_SINGLE
+    return _interpolate_theta(tol)
+
+
+def get_tolerance(dtype, tol=None):
+    """
+    Return the tolerance matched to the precision of the dtype.
+
+    This is the unit roundoff, or the requested tolerance if it is larger.
+
+    """
+    u = _get_unit_roundoff(dtype)
+    if tol is None:
+        return u
+    return max(u, tol)
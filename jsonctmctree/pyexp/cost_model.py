@@ -0,0 +1,198 @@
+"""
+Predict the costs of alternative strategies for matrix exponential actions.
+
+The action of expm(t*Q) on a block of ncols columns can be computed
+either by the truncated Taylor method, which costs m*s products of the
+sparse operator with the block, or by forming the dense transition matrix
+and multiplying it by the block.
+The first strategy scales with nnz * ncols * m * s,
+whereas the second strategy scales with nstates**3 for the dense matrix
+exponential (unless the transition matrix is already cached)
+plus nstates**2 * ncols for the dense product.
+
+The constants of proportionality depend on the machine,
+so they are measured by a quick microbenchmark the first time they
+are needed.  The measurements are cached as json on disk,
+in the directory named by the JSONCTMCTREE_CACHE_DIR environment variable
+or in ~/.cache/jsonctmctree by default.
+Setting the environment variable to the empty string disables
+the disk cache.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import scipy
+import scipy.linalg
+import scipy.sparse
+
+
+__all__ = ['CostModel', 'get_cost_model', 'calibrate', 'get_cache_dir']
+
+
+_cost_model = None
+
+
+def get_cache_dir():
+    """
+    Return the directory of the on-disk cache, or None if it is disabled.
+
+    """
+    cache_dir = os.environ.get('JSONCTMCTREE_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(
+                os.path.expanduser('~'), '.cache', 'jsonctmctree')
+    return cache_dir or None
+
+
+def _get_calibration_key():
+    return '-'.join((
+        'numpy', np.__version__,
+        'scipy', scipy.__version__,
+        platform.machine()))
+
+
+def _best_time(f, repeats=3):
+    elapsed = []
+    for i in range(repeats):
+        tm = time.time()
+        f()
+        elapsed.append(time.time() - tm)
+    # Avoid zero times from coarse clocks.
+    return max(min(elapsed), 1e-9)
+
+
+def calibrate():
+    """
+    Measure the machine-dependent constants of the cost model.
+
+    Returns
+    -------
+    constants : dict
+        Seconds per unit of work for each kind of operation.
+
+    """
+    rng = np.random.RandomState(0)
+
+    # Dense matrix products, in seconds per multiply-add.
+    n = 200
+    A = rng.rand(n, n)
+    B = rng.rand(n, n)
+    gemm = _best_time(lambda: A.dot(B)) / (n * n * n)
+
+    # Sparse matrix products, in seconds per nonzero per column.
+    n = 2000
+    ncols = 32
+    S = scipy.sparse.random(n, n, density=0.005, format='csr',
+            random_state=rng)
+    X = rng.rand(n, ncols)
+    spmm = _best_time(lambda: S.dot(X)) / max(S.nnz * ncols, 1)
+
+    # Elementwise dense operations, in seconds per entry.
+    axpy = _best_time(lambda: X + 2 * X) / (n * ncols)
+
+    # Dense matrix exponentials, in seconds per cubed state count.
+    n = 100
+    Q = rng.rand(n, n)
+    Q -= np.diag(Q.sum(axis=1))
+    expm = _best_time(lambda: scipy.linalg.expm(Q)) / (n * n * n)
+
+    return dict(gemm=gemm, spmm=spmm, axpy=axpy, expm=expm)
+
+
+def _load_constants(cache_dir, key):
+    if cache_dir is None:
+        return None
+    filename = os.path.join(cache_dir, 'cost_model.json')
+    try:
+        with open(filename) as fin:
+            d = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+    if d.get('key') != key:
+        return None
+    return d.get('constants')
+
+
+def _save_constants(cache_dir, key, constants):
+    if cache_dir is None:
+        return
+    filename = os.path.join(cache_dir, 'cost_model.json')
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(filename, 'w') as fout:
+            json.dump(dict(key=key, constants=constants), fout, indent=2)
+    except (IOError, OSError):
+        pass
+
+
+class CostModel(object):
+    """
+    Predict the time of each strategy for a matrix exponential action.
+
+    """
+    def __init__(self, gemm, spmm, axpy, expm):
+        self.gemm = gemm
+        self.spmm = spmm
+        self.axpy = axpy
+        self.expm = expm
+
+    def action_cost(self, nstates, nnz, ncols, m, s):
+        """
+        Predict the time of the Taylor action with m*s operator products.
+
+        Each operator product is followed by a scaled accumulation
+        and a norm computation on the block.
+
+        """
+        per_product = self.spmm * nnz * ncols + 3 * self.axpy * nstates * ncols
+        return m * s * per_product
+
+    def explicit_cost(self, nstates, ncols, cached):
+        """
+        Predict the time of the dense product with the transition matrix.
+
+        If the transition matrix is not already cached,
+        then its dense matrix exponential is included.
+
+        """
+        cost = self.gemm * nstates * nstates * ncols
+        if not cached:
+            cost += self.expm * nstates * nstates * nstates
+        return cost
+
+    def prefer_explicit(self, nstates, nnz, ncols, m, s, cached):
+        """
+        Return True if the explicit transition matrix is predicted to win.
+
+        """
+        action = self.action_cost(nstates, nnz, ncols, m, s)
+        explicit = self.explicit_cost(nstates, ncols, cached)
+        return explicit < action
+
+
+def get_cost_model():
+    """
+    Return the cost model, calibrating it if necessary.
+
+    The calibration is done at most once per process,
+    and at most once per machine and library versions if the disk cache
+    is enabled.
+
+    """
+    global _cost_model
+    if _cost_model is None:
+        cache_dir = get_cache_dir()
+        key = _get_calibration_key()
+        constants = _load_constants(cache_dir, key)
+        if constants is None:
+            constants = calibrate()
+            _save_constants(cache_dir, key, constants)
+        _cost_model = CostModel(**constants)
+    return _cost_model
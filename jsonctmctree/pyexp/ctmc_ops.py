@@ -4,20 +4,78 @@ Define some custom linear operators.
 """
 from __future__ import division, print_function, absolute_import
 
+import threading
+
 import numpy as np
+import networkx as nx
 
 import scipy.linalg
+import scipy.sparse
+import scipy.special
 from scipy.linalg import get_lapack_funcs
+from scipy.sparse.csgraph import connected_components, reverse_cuthill_mckee
+
+try:
+    from scipy.sparse._sparsetools import csr_matvecs
+except ImportError:
+    csr_matvecs = None
 
 from .experimental import IterationStash
+from .constants import get_theta, get_tolerance
+from .caching import get_iteration_stash_cache, hash_arrays
+from .parallel import get_thread_count, get_thread_pool, get_column_shards
 from .basic_ops import (
         HighLevelInterface, VanillaAdjointOperator,
         ConcreteInterface, ExtendedAdjointOperator, ExtendedMatrixOperator)
 
 
-__all__ = ['RdOperator', 'RdcOperator', 'RdCOperator',
-           'Propagator', 'ExplicitPropagator', 'SmarterPropagator',
-           'MatrixExponential']
+__all__ = ['as_canonical_csr', 'RdOperator', 'RdcOperator', 'RdCOperator', 'KroneckerSumOperator',
+           'Propagator', 'ExplicitPropagator', 'SpectralPropagator',
+           'UniformizationPropagator', 'KrylovPropagator',
+           'ChebyshevPropagator', 'check_sparse_detailed_balance',
+           'ReversiblePropagator', 'get_stationary_distribution',
+           'BlockTriangularPropagator', 'get_strong_components',
+           'get_bandwidth', 'get_banded_ordering', 'BandedOperator',
+           'PermutedPropagator', 'TridiagonalPropagator',
+           'get_multi_matmat', 'get_adjoint_multi_matmat',
+           'SmarterPropagator', 'MatrixExponential']
+
+
+def as_canonical_csr(R):
+    """
+    Convert a sparse matrix to csr format with sorted unique indices.
+
+    Duplicate entries are summed.
+    Single precision entries are kept,
+    and other entries are converted to double precision.
+    A matrix that is already in this form is returned unchanged,
+    so the conversion can be requested freely by each consumer.
+
+    """
+    dtype = np.result_type(R.dtype, np.float32)
+    if (scipy.sparse.isspmatrix_csr(R) and R.has_canonical_format and
+            R.dtype == dtype):
+        return R
+    R = scipy.sparse.csr_matrix(R, dtype=dtype)
+    R.sum_duplicates()
+    R.sort_indices()
+    return R
+
+
+def _csr_diag_matmat_into(R, d, other, out):
+    # Compute (R + diag(d)).dot(other) into the preallocated output.
+    # The compiled sparse kernel accumulates R.dot(other) in place
+    # when the arrays have compatible layouts and types.
+    np.multiply(d[:, np.newaxis], other, out=out)
+    if (csr_matvecs is not None and
+            other.flags.c_contiguous and out.flags.c_contiguous and
+            other.dtype == R.dtype and out.dtype == R.dtype):
+        n_row, n_col = R.shape
+        csr_matvecs(n_row, n_col, other.shape[1],
+                R.indptr, R.indices, R.data, other.ravel(), out.ravel())
+    else:
+        out += R.dot(other)
+    return out
 
 
 class RdOperator(HighLevelInterface, ConcreteInterface):
@@ -33,8 +91,12 @@ class RdOperator(HighLevelInterface, ConcreteInterface):
     so conjugate transposes are just transposes.
     The 1-norm of this operator can be computed without much difficulty.
 
+    The R component is compiled to canonical csr format once,
+    and its csr transpose is compiled once when the adjoint is first used.
+
     """
     def __init__(self, R, d):
+        R = as_canonical_csr(R)
         self.dtype = R.dtype
         self.shape = R.shape
         self._R = R
@@ -56,13 +118,296 @@ class RdOperator(HighLevelInterface, ConcreteInterface):
             self._abs_sum_axis_1 = self._R.sum(axis=1).A.ravel() + self._d_abs
         return self._abs_sum_axis_1
 
+    def content_key(self):
+        # Identify the operator by its contents.
+        R = self._R
+        return hash_arrays(R.indptr, R.indices, R.data, self._d)
+
+    def _get_RT(self):
+        if self._RT is None:
+            self._RT = as_canonical_csr(self._R.T)
+        return self._RT
+
     def _matmat(self, other):
-        return self._R.dot(other) + self._d[:, np.newaxis] * other
+        if other.ndim != 2:
+            return self._R.dot(other) + self._d * other
+        out = np.empty(other.shape, dtype=np.result_type(self.dtype, other))
+        return _csr_diag_matmat_into(self._R, self._d, other, out)
+
+    def _matmat_into(self, other, out):
+        return _csr_diag_matmat_into(self._R, self._d, other, out)
 
     def _my_adjoint_matmat(self, other):
-        if self._RT is None:
-            self._RT = self._R.T
-        return self._RT.dot(other) + self._d[:, np.newaxis] * other
+        if other.ndim != 2:
+            return self._get_RT().dot(other) + self._d * other
+        out = np.empty(other.shape, dtype=np.result_type(self.dtype, other))
+        return _csr_diag_matmat_into(self._get_RT(), self._d, other, out)
+
+    def _my_adjoint_matmat_into(self, other, out):
+        return _csr_diag_matmat_into(self._get_RT(), self._d, other, out)
+
+    def todense(self):
+        # Return the full matrix as an ndarray.
+        # This is intended for small state spaces.
+        return self._R.A + np.diag(self._d)
+
+
+class KroneckerSumOperator(HighLevelInterface, ConcreteInterface):
+    """
+    This is a custom linear operator for multivariate processes.
+
+    It is the sum of a Kronecker sum of small dense square matrices,
+    one for each component of the multivariate state,
+    a square sparse coupling matrix C, and a diagonal matrix d.
+    The Kronecker sum is applied axis by axis to the input
+    reshaped as a tensor, so the full matrix is never formed.
+    As with RdOperator, the off-diagonal entries are assumed to be
+    non-negative and the diagonal entries are carried by d.
+
+    """
+    def __init__(self, axis_matrices, C, d):
+        self._axis_matrices = [np.asarray(A) for A in axis_matrices]
+        self._axis_shape = tuple(A.shape[0] for A in self._axis_matrices)
+        n = int(np.prod(self._axis_shape))
+        self.dtype = np.dtype(float)
+        self.shape = (n, n)
+        self._C = scipy.sparse.csr_matrix(C)
+        self._d = d
+        self._d_abs = np.abs(d)
+        self.args = axis_matrices, C, d
+        self._CT = None
+        self._abs_sum_axis_0 = None
+        self._abs_sum_axis_1 = None
+        self._init_concrete_cache()
+
+    def _kronecker_sum_of_vectors(self, vectors):
+        # Entry (i_1, ..., i_k) of the output is the sum of v_j[i_j].
+        total = np.zeros(self._axis_shape)
+        ndim = len(self._axis_shape)
+        for axis, v in enumerate(vectors):
+            shape = [1] * ndim
+            shape[axis] = -1
+            total = total + v.reshape(shape)
+        return total.ravel()
+
+    def abs_sum_axis_0(self):
+        if self._abs_sum_axis_0 is None:
+            self._abs_sum_axis_0 = (
+                    self._kronecker_sum_of_vectors(
+                        [np.abs(A).sum(axis=0) for A in self._axis_matrices]) +
+                    abs(self._C).sum(axis=0).A.ravel() + self._d_abs)
+        return self._abs_sum_axis_0
+
+    def abs_sum_axis_1(self):
+        if self._abs_sum_axis_1 is None:
+            self._abs_sum_axis_1 = (
+                    self._kronecker_sum_of_vectors(
+                        [np.abs(A).sum(axis=1) for A in self._axis_matrices]) +
+                    abs(self._C).sum(axis=1).A.ravel() + self._d_abs)
+        return self._abs_sum_axis_1
+
+    def content_key(self):
+        # Identify the operator by its contents.
+        C = self._C
+        return hash_arrays(C.indptr, C.indices, C.data, self._d,
+                *self._axis_matrices)
+
+    def _axis_matmat(self, matrices, other):
+        # Apply the Kronecker sum of the matrices to the columns of other.
+        ncols = other.shape[1]
+        X = other.reshape(self._axis_shape + (ncols, ))
+        M = np.zeros(X.shape, dtype=np.result_type(self.dtype, other))
+        for axis, A in enumerate(matrices):
+            Y = np.tensordot(A, X, axes=(1, axis))
+            M += np.moveaxis(Y, 0, axis)
+        return M.reshape(other.shape)
+
+    def _matmat(self, other):
+        return (self._axis_matmat(self._axis_matrices, other) +
+                self._C.dot(other) + self._d[:, np.newaxis] * other)
+
+    def _my_adjoint_matmat(self, other):
+        if self._CT is None:
+            self._CT = self._C.T.tocsr()
+        return (self._axis_matmat([A.T for A in self._axis_matrices], other) +
+                self._CT.dot(other) + self._d[:, np.newaxis] * other)
+
+    def todense(self):
+        # Return the full matrix as an ndarray.
+        # This is intended for small state spaces.
+        M = self._C.A + np.diag(self._d)
+        for axis, A in enumerate(self._axis_matrices):
+            left = int(np.prod(self._axis_shape[:axis]))
+            right = int(np.prod(self._axis_shape[axis+1:]))
+            M += np.kron(np.kron(np.identity(left), A), np.identity(right))
+        return M
+
+    def tosparse(self):
+        # Return the full matrix as a scipy sparse matrix in csr format.
+        M = self._C + scipy.sparse.diags(self._d, 0)
+        for axis, A in enumerate(self._axis_matrices):
+            left = int(np.prod(self._axis_shape[:axis]))
+            right = int(np.prod(self._axis_shape[axis+1:]))
+            M = M + scipy.sparse.kron(scipy.sparse.kron(
+                scipy.sparse.identity(left), scipy.sparse.csr_matrix(A)),
+                scipy.sparse.identity(right))
+        return M.tocsr()
+
+
+def get_bandwidth(R):
+    """
+    Return the largest distance of a nonzero entry from the diagonal.
+
+    """
+    R = scipy.sparse.coo_matrix(R)
+    if not R.nnz:
+        return 0
+    return int(np.abs(R.row - R.col).max())
+
+
+def get_banded_ordering(R):
+    """
+    Try to reduce the bandwidth of a sparse square matrix by reordering.
+
+    The reverse Cuthill-McKee ordering of the symmetrized sparsity
+    structure is used if it reduces the bandwidth.
+
+    Returns
+    -------
+    perm : 1d ndarray of integers
+        The permutation of the states.
+        The permuted matrix is R[perm][:, perm].
+    bandwidth : integer
+        The bandwidth of the permuted matrix.
+
+    """
+    R = scipy.sparse.csr_matrix(R)
+    n = R.shape[0]
+    bandwidth = get_bandwidth(R)
+    identity = np.arange(n)
+    if bandwidth <= 1:
+        return identity, bandwidth
+    S = abs(R)
+    S = (S + S.T).tocsr()
+    perm = np.asarray(reverse_cuthill_mckee(S, symmetric_mode=True), dtype=int)
+    permuted_bandwidth = get_bandwidth(R[perm][:, perm])
+    if permuted_bandwidth < bandwidth:
+        return perm, permuted_bandwidth
+    return identity, bandwidth
+
+
+class BandedOperator(HighLevelInterface, ConcreteInterface):
+    """
+    This is like RdOperator except with banded storage.
+
+    The sum of a sparse matrix R with a small bandwidth
+    and a diagonal matrix d is stored in the general band storage
+    of LAPACK with equal lower and upper bandwidths b,
+    so that ab[b + i - j, j] is the (i, j) entry.
+    Products are computed one diagonal at a time,
+    which costs O(n*b) per column with contiguous memory access.
+
+    """
+    def __init__(self, R, d, bandwidth=None):
+        R = scipy.sparse.coo_matrix(R)
+        n = R.shape[0]
+        if bandwidth is None:
+            bandwidth = get_bandwidth(R)
+        if get_bandwidth(R) > bandwidth:
+            raise ValueError('the matrix has entries outside of the band')
+        b = bandwidth
+        dtype = np.result_type(R.dtype, d, np.float32)
+        ab = np.zeros((2*b + 1, n), dtype=dtype)
+        np.add.at(ab, (b + R.row - R.col, R.col), R.data)
+        ab[b] += d
+        self.dtype = dtype
+        self.shape = (n, n)
+        self.bandwidth = b
+        self._ab = ab
+        self.args = R, d
+        self._workspace = threading.local()
+        self._abs_sum_axis_0 = None
+        self._abs_sum_axis_1 = None
+        self._init_concrete_cache()
+
+    def content_key(self):
+        # Identify the operator by its contents.
+        return hash_arrays(self._ab)
+
+    def _offsets(self):
+        # Yield the offset k of each off-diagonal, with the range of rows
+        # i for which the entry (i, i+k) is inside the matrix.
+        n = self.shape[0]
+        for k in range(-self.bandwidth, self.bandwidth+1):
+            lo, hi = max(0, -k), min(n, n - k)
+            if k and lo < hi:
+                yield k, lo, hi
+
+    def abs_sum_axis_0(self):
+        if self._abs_sum_axis_0 is None:
+            self._abs_sum_axis_0 = np.abs(self._ab).sum(axis=0)
+        return self._abs_sum_axis_0
+
+    def abs_sum_axis_1(self):
+        if self._abs_sum_axis_1 is None:
+            b = self.bandwidth
+            ab_abs = np.abs(self._ab)
+            total = ab_abs[b].copy()
+            for k, lo, hi in self._offsets():
+                total[lo:hi] += ab_abs[b - k, lo + k:hi + k]
+            self._abs_sum_axis_1 = total
+        return self._abs_sum_axis_1
+
+    def _get_workspace(self, shape, dtype):
+        # Each thread has its own workspace.
+        w = getattr(self._workspace, 'array', None)
+        if w is None or w.shape != shape or w.dtype != dtype:
+            w = np.empty(shape, dtype=dtype)
+            self._workspace.array = w
+        return w
+
+    def _banded_matmat_into(self, transpose, other, out):
+        # The (i, i+k) entry is ab[b-k, i+k],
+        # and the (i, i+k) entry of the transpose is ab[b+k, i].
+        b = self.bandwidth
+        ab = self._ab
+        np.multiply(ab[b][:, np.newaxis], other, out=out)
+        W = self._get_workspace(out.shape, out.dtype)
+        for k, lo, hi in self._offsets():
+            if transpose:
+                coeffs = ab[b + k, lo:hi]
+            else:
+                coeffs = ab[b - k, lo + k:hi + k]
+            w = W[:hi - lo]
+            np.multiply(coeffs[:, np.newaxis], other[lo + k:hi + k], out=w)
+            out[lo:hi] += w
+        return out
+
+    def _matmat_into(self, other, out):
+        return self._banded_matmat_into(False, other, out)
+
+    def _my_adjoint_matmat_into(self, other, out):
+        return self._banded_matmat_into(True, other, out)
+
+    def _matmat(self, other):
+        X = other.reshape(other.shape[0], -1)
+        out = np.empty(X.shape, dtype=np.result_type(self.dtype, other))
+        return self._matmat_into(X, out).reshape(other.shape)
+
+    def _my_adjoint_matmat(self, other):
+        X = other.reshape(other.shape[0], -1)
+        out = np.empty(X.shape, dtype=np.result_type(self.dtype, other))
+        return self._my_adjoint_matmat_into(X, out).reshape(other.shape)
+
+    def todense(self):
+        # Return the full matrix as an ndarray.
+        # This is intended for small state spaces.
+        b = self.bandwidth
+        M = np.diag(self._ab[b])
+        for k, lo, hi in self._offsets():
+            rows = np.arange(lo, hi)
+            M[rows, rows + k] = self._ab[b - k, lo + k:hi + k]
+        return M
 
 
 class RdcOperator(HighLevelInterface, ConcreteInterface):
@@ -109,6 +454,20 @@ class RdcOperator(HighLevelInterface, ConcreteInterface):
                     self._c[:, np.newaxis] * other[:n, :])
         return M
 
+    def _matmat_into(self, other, out):
+        n = self._c.size
+        self._Rd.dot_into(other[n:, :], out[n:, :])
+        self._Rd.dot_into(other[:n, :], out[:n, :])
+        out[:n, :] += self._c[:, np.newaxis] * other[n:, :]
+        return out
+
+    def content_key(self):
+        # Identify the operator by its contents.
+        content_key = getattr(self._Rd, 'content_key', None)
+        if content_key is None:
+            return None
+        return '%s-%s' % (content_key(), hash_arrays(self._c))
+
 
 class RdCOperator(HighLevelInterface, ConcreteInterface):
     # R+d  C
@@ -156,40 +515,253 @@ class RdCOperator(HighLevelInterface, ConcreteInterface):
                     self._CH.dot(other[:n, :]))
         return M
 
+    def _matmat_into(self, other, out):
+        n = self._C.shape[0]
+        self._Rd.dot_into(other[n:, :], out[n:, :])
+        self._Rd.dot_into(other[:n, :], out[:n, :])
+        out[:n, :] += self._C.dot(other[n:, :])
+        return out
+
+    def content_key(self):
+        # Identify the operator by its contents.
+        content_key = getattr(self._Rd, 'content_key', None)
+        if content_key is None:
+            return None
+        C = as_canonical_csr(self.args[1])
+        return '%s-%s' % (content_key(),
+                hash_arrays(C.indptr, C.indices, C.data))
 
-def _expm_product_helper(A, mu, iteration_stash, t, B):
+
+# The default number of columns propagated together by the Taylor action.
+# Narrower blocks keep the workspace small and let each block stop
+# as soon as its own columns have converged.
+DEFAULT_BLOCK_WIDTH = 256
+
+
+def _expm_product_helper(A, mu, iteration_stash, t, B, block_width=None,
+        tol=None, nthreads=1):
     # Estimate expm(t*M).dot(B).
     # A = M - mu*I
     # mu = mean(trace(M))
     # The iteration stash helps to compute numbers of iterations to use.
     # t is a scaling factor.
     # B is the input matrix for the linear operator.
+    # block_width is the maximum number of columns propagated together.
+    # tol is the requested accuracy, defaulting to the unit roundoff.
+    # nthreads is the number of threads propagating column shards.
+    # Returns the product and an estimate of its relative error.
+    if block_width is None:
+        block_width = DEFAULT_BLOCK_WIDTH
+    if block_width < 1:
+        raise ValueError('expected a positive block width')
+    n, ncols = B.shape
+    dtype = np.result_type(A.dtype, B.dtype)
+    shards = get_column_shards(ncols, block_width, nthreads)
+    if len(shards) <= 1:
+        F = np.array(B, dtype=dtype, order='C')
+        return _expm_product_block(A, mu, iteration_stash, t, F, tol=tol)
+
+    out = np.empty((n, ncols), dtype=dtype)
+    if nthreads > 1:
+        # Each thread propagates its own shard in its own workspace.
+        def propagate(shard):
+            start, stop = shard
+            F = np.array(B[:, start:stop], dtype=dtype, order='C')
+            return _expm_product_block(A, mu, iteration_stash, t, F, tol=tol)
+        results = get_thread_pool(nthreads).map(propagate, shards)
+        err = 0
+        for (start, stop), (F, shard_err) in zip(shards, results):
+            out[:, start:stop] = F
+            err = max(err, shard_err)
+        return out, err
+
+    # Propagate each block of columns in turn,
+    # reusing the workspace across blocks of the full width.
+    workspace = None
+    err = 0
+    for start, stop in shards:
+        if stop - start == block_width:
+            if workspace is None:
+                workspace = [np.empty((n, block_width), dtype=dtype)
+                        for i in range(3)]
+            F, X, W = workspace
+        else:
+            F, X, W = [np.empty((n, stop - start), dtype=dtype)
+                    for i in range(3)]
+        F[...] = B[:, start:stop]
+        out[:, start:stop], block_err = _expm_product_block(
+                A, mu, iteration_stash, t, F, X, W, tol)
+        err = max(err, block_err)
+    return out, err
+
+
+def _expm_product_block(A, mu, iteration_stash, t, F, X=None, W=None,
+        tol=None):
+    # Estimate expm(t*M).dot(F) in place for one block of columns.
+    # F is a C-contiguous block which is overwritten with the result.
+    # X and W are optional workspace blocks with the shape of F.
+    # Returns the block and an estimate of its relative error.
 
     # Compute some input-dependent constants.
-    tol = np.ldexp(1, -53)
-    n0 = B.shape[1]
+    # The tolerance is matched to the precision of the block.
+    tol = get_tolerance(F.dtype, tol)
+    n0 = F.shape[1]
     m, s = iteration_stash.fragment_3_1(n0, t)
 
     #print('1-norm:', A.one_norm(), 't:', t, 'mu:', mu, 'n0:', n0, 'm:', m, 's:', s)
 
+    # F accumulates the sum, X holds the current Taylor term,
+    # and W receives the next product with A before being swapped with X.
+    if X is None:
+        X = np.empty_like(F)
+    if W is None:
+        W = np.empty_like(F)
+    X[...] = F
+
     # Get the lapack function for computing matrix norms.
-    lange, = get_lapack_funcs(('lange',), (B,))
+    # The infinity norm of a C-contiguous array is the 1-norm
+    # of its Fortran-contiguous transpose, which avoids a copy.
+    lange, = get_lapack_funcs(('lange',), (F,))
+    def inf_norm(M):
+        return lange('1', M.T)
 
-    F = B
-    eta = np.exp(t*mu / float(s))
+    # The a posteriori error estimate of each segment is the norm
+    # of the last two Taylor terms relative to the norm of the sum,
+    # and the estimates are added across segments.
+    err = 0
+    eta = np.exp(t*mu / float(s)) if s else 1
     for i in range(s):
-        c1 = lange('i', B)
+        c1 = inf_norm(X)
+        # At the start of each segment F is equal to X.
+        # By the triangle inequality, norm_bound is an upper bound on
+        # the norm of F, so the full norm of F is computed only if
+        # the convergence test passes with the bound.
+        norm_bound = c1
+        F_norm = None
         for j in range(m):
             coeff = t / float(s*(j+1))
-            B = coeff * A.dot(B)
-            c2 = lange('i', B)
-            F = F + B
-            if c1 + c2 <= tol * lange('i', F):
+            A.dot_into(X, W)
+            W *= coeff
+            X, W = W, X
+            c2 = inf_norm(X)
+            F += X
+            norm_bound += c2
+            if c1 + c2 <= tol * norm_bound:
+                F_norm = inf_norm(F)
+                if c1 + c2 <= tol * F_norm:
+                    break
+                F_norm = None
+            c1 = c2
+        if F_norm is None:
+            F_norm = inf_norm(F)
+        if F_norm:
+            err += (c1 + c2) / F_norm
+        F *= eta
+        X[...] = F
+    return F, err
+
+
+def _expm_product_grid_helper(A, mu, iteration_stash, ts, B,
+        block_width=None, tol=None, nthreads=1):
+    # Estimate expm(t*M).dot(B) for each non-negative t in ts.
+    # The arguments are as in _expm_product_helper.
+    # Returns the list of products in the order of ts,
+    # and an estimate of the largest relative error.
+    if block_width is None:
+        block_width = DEFAULT_BLOCK_WIDTH
+    if block_width < 1:
+        raise ValueError('expected a positive block width')
+    ts = np.asarray(ts, dtype=float)
+    if np.any(ts < 0):
+        raise ValueError('expected non-negative scaling factors')
+    n, ncols = B.shape
+    dtype = np.result_type(A.dtype, B.dtype)
+    out = [np.empty((n, ncols), dtype=dtype) for t in ts]
+    shards = get_column_shards(ncols, block_width, nthreads)
+    def propagate(shard):
+        start, stop = shard
+        F = np.array(B[:, start:stop], dtype=dtype, order='C')
+        return _expm_product_grid_block(A, mu, iteration_stash, ts, F, tol)
+    if nthreads > 1 and len(shards) > 1:
+        results = get_thread_pool(nthreads).map(propagate, shards)
+    else:
+        results = [propagate(shard) for shard in shards]
+    err = 0
+    for (start, stop), (blocks, shard_err) in zip(shards, results):
+        for arr, block in zip(out, blocks):
+            arr[:, start:stop] = block
+        err = max(err, shard_err)
+    return out, err
+
+
+def _expm_product_grid_block(A, mu, iteration_stash, ts, F, tol=None):
+    # Estimate expm(t*M).dot(F) for each t in ts, for one block of columns.
+    # The interval up to the largest t is split into the s segments
+    # chosen for that t.  Within each segment the scaled Taylor terms
+    # of the segment's initial block are computed once and are shared
+    # by every requested time point in the segment,
+    # following the interval algorithm (5.2) of Al-Mohy and Higham (2011)
+    # but allowing time points that are not evenly spaced.
+    # F is overwritten.
+    # Returns the list of blocks and an estimate of the relative error.
+    tol = get_tolerance(F.dtype, tol)
+    n0 = F.shape[1]
+    order = np.argsort(ts, kind='mergesort')
+    t_max = ts[order[-1]] if ts.shape[0] else 0
+    out = [None] * ts.shape[0]
+    m, s = iteration_stash.fragment_3_1(n0, t_max)
+    if not t_max or not s:
+        for i in order:
+            out[i] = F.copy()
+        return out, 0
+
+    lange, = get_lapack_funcs(('lange',), (F,))
+    def inf_norm(M):
+        return lange('1', M.T)
+
+    h = t_max / float(s)
+    X = np.empty_like(F)
+    W = np.empty_like(F)
+    err = 0
+    k = 0
+    for i in range(s):
+        base = i * h
+
+        # Collect the time points within this segment,
+        # which are each represented by a fraction of the segment.
+        group = []
+        while k < order.shape[0] and (
+                i == s - 1 or ts[order[k]] <= base + h):
+            group.append(order[k])
+            k += 1
+        fractions = [min(max((ts[j] - base) / h, 0), 1) for j in group]
+        sums = [F.copy() for j in group]
+
+        # The scaled Taylor terms of the segment are shared by all points,
+        # and the convergence test is for the end of the segment,
+        # where the terms are the largest.
+        X[...] = F
+        c1 = inf_norm(X)
+        for p in range(m):
+            A.dot_into(X, W)
+            W *= h / float(p+1)
+            X, W = W, X
+            c2 = inf_norm(X)
+            F += X
+            for arr, fraction in zip(sums, fractions):
+                if fraction:
+                    arr += fraction ** (p+1) * X
+            if c1 + c2 <= tol * inf_norm(F):
                 break
             c1 = c2
-        F = eta * F
-        B = F
-    return F
+        F_norm = inf_norm(F)
+        if F_norm:
+            err += (c1 + c2) / F_norm
+        for j, arr, fraction in zip(group, sums, fractions):
+            arr *= np.exp(fraction * h * mu)
+            out[j] = arr
+        F *= np.exp(h * mu)
+    return out, err
 
 
 class SmarterPropagator(object):
@@ -241,36 +813,445 @@ class Propagator(object):
 
     The point of this class is basically to cache properties
     that are the same across different values of t.
+    If the operator provides a content key, then the norm estimates
+    are shared through a cache with propagators of equal operators,
+    including those created by later calls.
+
+    The requested tolerance selects both the theta table and the
+    stopping rule of the Taylor series, and the relative error estimate
+    of the most recent call is available as the error_estimate attribute.
+
+    With more than one thread, the columns are split into one shard
+    per thread, up to the block width, and the shards are propagated
+    concurrently.  The convergence test is per shard,
+    so the results are reproducible for a given number of threads
+    but may differ slightly between numbers of threads.
 
     """
-    def __init__(self, A, mu):
+    def __init__(self, A, mu, block_width=None, tol=None, nthreads=None):
         # A = M - mu*I is an abstract linear operator
         # whose 1-norm is directly accessible.
         # mu is the mean trace of M.
+        # block_width is the maximum number of columns propagated together.
+        # tol is the requested accuracy, defaulting to the unit roundoff.
+        # nthreads is the number of threads, defaulting to the environment.
         self.shape = A.shape
         self.dtype = A.dtype
         self._A = A
         self._mu = mu
+        if block_width is None:
+            block_width = DEFAULT_BLOCK_WIDTH
+        self.block_width = block_width
+        self.nthreads = get_thread_count(nthreads)
+        self._tol = get_tolerance(self.dtype, tol)
         self._forward_iteration_stash = None
         self._adjoint_iteration_stash = None
+        self.error_estimate = None
+
+    def _get_iteration_stash(self, adjoint):
+        # Reuse the shared stash of an operator with the same contents.
+        # The theta table is matched to the precision of the operator,
+        # which is also part of the content key, and to the tolerance.
+        A = self._A.H if adjoint else self._A
+        theta = get_theta(self.dtype, self._tol)
+        content_key = getattr(self._A, 'content_key', None)
+        content_key = content_key() if content_key is not None else None
+        if content_key is None:
+            return IterationStash(A, theta)
+        key = '%s-%s-%r' % (
+                content_key, 'adjoint' if adjoint else 'forward', self._tol)
+        return get_iteration_stash_cache().get_iteration_stash(key, A, theta)
+
+    def predict_iterations(self, t, ncols):
+        # Predict the Taylor degree m and the number of segments s
+        # of the forward action on ncols columns.
+        if self._forward_iteration_stash is None:
+            self._forward_iteration_stash = self._get_iteration_stash(False)
+        shards = get_column_shards(ncols, self.block_width, self.nthreads)
+        n0 = max(shards[0][1] - shards[0][0], 1) if shards else 1
+        return self._forward_iteration_stash.fragment_3_1(n0, t)
 
     def _parameterized_matmat(self, t, B):
         # Approximate expm(M*t).dot(B).
         # t is a scaling factor of L
         # B the input matrix of the linear function
         if self._forward_iteration_stash is None:
-            self._forward_iteration_stash = IterationStash(self._A)
-        return _expm_product_helper(
-                self._A, self._mu, self._forward_iteration_stash, t, B)
+            self._forward_iteration_stash = self._get_iteration_stash(False)
+        F, self.error_estimate = _expm_product_helper(
+                self._A, self._mu, self._forward_iteration_stash, t, B,
+                self.block_width, self._tol, self.nthreads)
+        return F
 
     def _parameterized_adjoint_matmat(self, t, B):
         # Approximate expm(M.H*t).dot(B).
         # t is a scaling factor of L
         # B the input matrix of the adjoint linear function
         if self._adjoint_iteration_stash is None:
-            self._adjoint_iteration_stash = IterationStash(self._A.H)
-        return _expm_product_helper(
-                self._A.H, self._mu, self._adjoint_iteration_stash, t, B)
+            self._adjoint_iteration_stash = self._get_iteration_stash(True)
+        F, self.error_estimate = _expm_product_helper(
+                self._A.H, self._mu, self._adjoint_iteration_stash, t, B,
+                self.block_width, self._tol, self.nthreads)
+        return F
+
+    def _parameterized_multi_matmat(self, ts, B):
+        # Approximate expm(M*t).dot(B) for each t in ts,
+        # sharing Taylor terms among nearby scaling factors.
+        if self._forward_iteration_stash is None:
+            self._forward_iteration_stash = self._get_iteration_stash(False)
+        out, self.error_estimate = _expm_product_grid_helper(
+                self._A, self._mu, self._forward_iteration_stash, ts, B,
+                self.block_width, self._tol, self.nthreads)
+        return out
+
+    def _parameterized_adjoint_multi_matmat(self, ts, B):
+        # Approximate expm(M.H*t).dot(B) for each t in ts,
+        # sharing Taylor terms among nearby scaling factors.
+        if self._adjoint_iteration_stash is None:
+            self._adjoint_iteration_stash = self._get_iteration_stash(True)
+        out, self.error_estimate = _expm_product_grid_helper(
+                self._A.H, self._mu, self._adjoint_iteration_stash, ts, B,
+                self.block_width, self._tol, self.nthreads)
+        return out
+
+
+class UniformizationPropagator(object):
+    """
+    Wraps a rate matrix operator, using uniformization.
+
+    With uniformization rate lam no smaller than the largest exit rate,
+    the matrix S = I + Q/lam is non-negative, and
+    expm(Q*t) is the sum over k of the Poisson(lam*t) probability
+    of k multiplied by the kth power of S.
+    The Poisson tail after truncation bounds the error,
+    and no cancellation occurs because all terms are non-negative.
+    To avoid underflow of the Poisson probabilities,
+    large values of lam*t are split into steps of at most max_step.
+
+    """
+    def __init__(self, Q, rate, tol=None, max_step=32):
+        # Q is a linear operator whose off-diagonal entries are non-negative
+        # and whose diagonal entries are no smaller than -rate.
+        self.shape = Q.shape
+        self.dtype = Q.dtype
+        self._Q = Q
+        self._rate = float(rate)
+        self._tol = np.ldexp(1, -53) if tol is None else tol
+        self._max_step = max_step
+
+    def _get_poisson_weights(self, x):
+        # Poisson(x) probabilities until the tail is below tolerance.
+        w = [np.exp(-x)]
+        k = 0
+        while True:
+            w_next = w[-1] * x / (k + 1)
+            if k + 2 > x:
+                tail = w_next * (k + 2) / (k + 2 - x)
+                if tail <= self._tol:
+                    return np.array(w)
+            w.append(w_next)
+            k += 1
+
+    def _poisson_sums(self, op, B, xs):
+        # For each x in xs, sum Poisson(x) weighted powers of S applied to B.
+        weights = [self._get_poisson_weights(x) for x in xs]
+        nterms = max(w.shape[0] for w in weights)
+        out = [w[0] * B for w in weights]
+        V = B
+        for k in range(1, nterms):
+            V = V + op.dot(V) / self._rate
+            for i, w in enumerate(weights):
+                if k < w.shape[0]:
+                    out[i] += w[k] * V
+        return out
+
+    def _multi_helper(self, op, ts, B):
+        # Push the input B through several scaling factors,
+        # sharing one sequence of powers among nearby scaling factors
+        # and stepping forward from the largest scaling factor so far.
+        ts = np.asarray(ts, dtype=float)
+        out = [None] * ts.shape[0]
+        if not self._rate:
+            return [B.copy() for t in ts]
+        order = np.argsort(ts)
+        h = self._max_step / self._rate
+        base_t = 0.0
+        F = B
+        i = 0
+        while i < order.shape[0]:
+            if ts[order[i]] - base_t > h:
+                F = self._poisson_sums(op, F, [self._max_step])[0]
+                base_t += h
+                continue
+            group = []
+            while i < order.shape[0] and ts[order[i]] - base_t <= h:
+                group.append(order[i])
+                i += 1
+            xs = [self._rate * (ts[j] - base_t) for j in group]
+            for j, arr in zip(group, self._poisson_sums(op, F, xs)):
+                out[j] = arr
+            base_t = ts[group[-1]]
+            F = out[group[-1]]
+        return out
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        return self._multi_helper(self._Q, [t], B)[0]
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        return self._multi_helper(self._Q.H, [t], B)[0]
+
+    def _parameterized_multi_matmat(self, ts, B):
+        # Approximate expm(M*t).dot(B) for each t in ts.
+        return self._multi_helper(self._Q, ts, B)
+
+    def _parameterized_adjoint_multi_matmat(self, ts, B):
+        # Approximate expm(M.H*t).dot(B) for each t in ts.
+        return self._multi_helper(self._Q.H, ts, B)
+
+
+def _round_step(x):
+    # Round a step size up to two significant digits, as in Expokit.
+    s = np.power(10.0, np.floor(np.log10(x)) - 1)
+    return np.ceil(x / s) * s
+
+
+def _krylov_expv(op, anorm, t, v, m, tol, max_rejections=20):
+    # Estimate expm(t*M).dot(v) for a vector v,
+    # following the time-stepping scheme of the Expokit expv function.
+    # op is the linear operator M and anorm is its infinity norm.
+    # Each time step builds a new Arnoldi basis of dimension at most m,
+    # which restarts the Krylov subspace from the current vector.
+    # Returns the estimate and an a posteriori estimate of its error.
+    n = v.shape[0]
+    v_norm = np.linalg.norm(v)
+    if not v_norm or not t or not anorm:
+        return v.copy(), 0.0
+    m = min(m, n)
+    btol = 1e-7
+    gamma = 0.9
+    delta = 1.2
+    w = v / v_norm
+    beta = 1.0
+    t_now = 0.0
+    err = 0.0
+    xm = 1.0 / m
+    fact = np.power((m + 1) / np.exp(1), m + 1) * np.sqrt(2*np.pi*(m + 1))
+    t_new = (1 / anorm) * np.power((fact * tol) / (4 * beta * anorm), xm)
+    t_new = _round_step(t_new)
+    while t_now < t:
+        t_step = min(t - t_now, t_new)
+        V = np.zeros((n, m + 1))
+        H = np.zeros((m + 2, m + 2))
+        V[:, 0] = w / beta
+        mb = m
+        happy = False
+        for j in range(m):
+            p = op.dot(V[:, j:j+1])[:, 0]
+            for i in range(j + 1):
+                H[i, j] = V[:, i].dot(p)
+                p -= H[i, j] * V[:, i]
+            s = np.linalg.norm(p)
+            if s < btol:
+                happy = True
+                mb = j + 1
+                t_step = t - t_now
+                break
+            H[j + 1, j] = s
+            V[:, j + 1] = p / s
+        if not happy:
+            H[m + 1, m] = 1
+            avnorm = np.linalg.norm(op.dot(V[:, m:m+1]))
+        nrejections = 0
+        while True:
+            mx = mb if happy else mb + 2
+            F = scipy.linalg.expm(t_step * H[:mx, :mx])
+            if happy:
+                err_loc = btol
+                break
+            phi1 = abs(beta * F[m, 0])
+            phi2 = abs(beta * F[m + 1, 0] * avnorm)
+            if phi1 > 10 * phi2:
+                err_loc = phi2
+                xm = 1.0 / m
+            elif phi1 > phi2:
+                err_loc = (phi1 * phi2) / (phi1 - phi2)
+                xm = 1.0 / m
+            else:
+                err_loc = phi1
+                xm = 1.0 / (m - 1)
+            if err_loc <= delta * t_step * tol:
+                break
+            if nrejections == max_rejections:
+                raise Exception('the requested tolerance is too high')
+            t_step = _round_step(
+                    gamma * t_step * np.power(t_step * tol / err_loc, xm))
+            nrejections += 1
+        mx = mb if happy else mb + 1
+        w = V[:, :mx].dot(beta * F[:mx, 0])
+        beta = np.linalg.norm(w)
+        t_now += t_step
+        if not beta:
+            break
+        err_loc = max(err_loc, np.finfo(float).tiny)
+        t_new = _round_step(
+                gamma * t_step * np.power(t_step * tol / err_loc, xm))
+        err += err_loc
+    return v_norm * w, v_norm * err
+
+
+class KrylovPropagator(object):
+    """
+    Wraps a linear operator, using restarted Krylov subspaces.
+
+    Each column of the input is propagated through its own sequence of
+    Krylov subspaces of small dimension m, with time steps chosen
+    by the a posteriori local error estimates of Expokit.
+    The number of operator actions is therefore decoupled from the
+    number of columns of the input, unlike the Taylor helper,
+    so this is meant for large operators acting on few columns.
+    The accumulated error estimate of the most recent call
+    is available as the error_estimate attribute.
+
+    """
+    def __init__(self, A, m=30, tol=1e-12):
+        self.shape = A.shape
+        self.dtype = A.dtype
+        self._A = A
+        self._m = m
+        self._tol = tol
+        self._anorm = None
+        self._adjoint_anorm = None
+        self.error_estimate = None
+
+    def _helper(self, op, anorm, t, B):
+        F = np.empty(B.shape, dtype=float)
+        err = 0.0
+        for j in range(B.shape[1]):
+            F[:, j], e = _krylov_expv(op, anorm, t, B[:, j], self._m, self._tol)
+            err = max(err, e)
+        self.error_estimate = err
+        return F
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        if self._anorm is None:
+            self._anorm = self._A.inf_norm()
+        return self._helper(self._A, self._anorm, t, B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        if self._adjoint_anorm is None:
+            self._adjoint_anorm = self._A.one_norm()
+        return self._helper(self._A.H, self._adjoint_anorm, t, B)
+
+
+def check_sparse_detailed_balance(R, distn, rtol=1e-8):
+    """
+    Check detailed balance of a sparse rate matrix.
+
+    Parameters
+    ----------
+    R : sparse square matrix
+        Non-negative off-diagonal rates.
+    distn : 1d ndarray, optional
+        A candidate stationary distribution.
+        The check fails unless all of its entries are positive.
+    rtol : float, optional
+        Tolerance relative to the largest probability flow.
+
+    """
+    if distn is None or distn.shape != R.shape[:1]:
+        return False
+    if not np.all(distn > 0):
+        return False
+    F = scipy.sparse.csr_matrix(R).multiply(distn[:, np.newaxis]).tocsr()
+    if not F.nnz:
+        return True
+    scale = np.abs(F.data).max()
+    D = (F - F.T).tocsr()
+    if not D.nnz:
+        return True
+    return np.abs(D.data).max() <= rtol * scale
+
+
+class ChebyshevPropagator(object):
+    """
+    Wraps a linear operator with a real spectrum, using Chebyshev polynomials.
+
+    The rate matrix M is assumed to satisfy detailed balance, so that it is
+    similar to a symmetric matrix, and its spectrum lies in [-2*lam, 0]
+    where lam is the largest exit rate.
+    With X = M/lam + I whose spectrum lies in [-1, 1],
+    expm(M*t) = exp(-lam*t) * expm(lam*t*X), which is expanded in Chebyshev
+    polynomials of X with coefficients given by modified Bessel functions.
+    The degree of the expansion is the smallest for which the sum of
+    the magnitudes of the remaining coefficients is below tolerance,
+    so no norms of matrix powers need to be estimated.
+    The error bound holds in the norm weighted by the
+    stationary distribution, so it is inflated by the square root of the
+    ratio of the largest to the smallest stationary probabilities.
+
+    """
+    def __init__(self, Q, rate, tol=None):
+        # Q is a linear operator that satisfies detailed balance.
+        self.shape = Q.shape
+        self.dtype = Q.dtype
+        self._Q = Q
+        self._rate = float(rate)
+        self._tol = np.ldexp(1, -53) if tol is None else tol
+
+    def get_coefficients(self, t):
+        """
+        Chebyshev coefficients of exp(lam*t*(x-1)) on [-1, 1].
+
+        """
+        x = self._rate * t
+        nterms = int(np.ceil(x + 10*np.sqrt(x) + 30))
+        while True:
+            c = scipy.special.ive(np.arange(nterms), x)
+            c[1:] *= 2
+            tail = np.cumsum(np.abs(c[::-1]))[::-1]
+            small = np.flatnonzero(tail <= self._tol)
+            if small.size:
+                return c[:max(1, small[0])]
+            nterms *= 2
+
+    def _helper(self, op, t, B):
+        if not self._rate or not t:
+            return B.copy()
+        c = self.get_coefficients(t)
+        T_prev = B
+        F = c[0] * B
+        if c.shape[0] == 1:
+            return F
+        T_curr = op.dot(B) / self._rate + B
+        F += c[1] * T_curr
+        for k in range(2, c.shape[0]):
+            T_next = 2 * (op.dot(T_curr) / self._rate + T_curr) - T_prev
+            F += c[k] * T_next
+            T_prev, T_curr = T_curr, T_next
+        return F
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        return self._helper(self._Q, t, B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        return self._helper(self._Q.H, t, B)
 
 
 class ExplicitPropagator(object):
@@ -284,6 +1265,11 @@ class ExplicitPropagator(object):
         self.dtype = M.dtype
         self._M = M
 
+    def _parameterized_expm(self, t):
+        # Compute expm(M*t) as an explicit ndarray.
+        # t is a scaling factor of M
+        return scipy.linalg.expm(self._M*t)
+
     def _parameterized_matmat(self, t, B):
         # Approximate expm(M*t).dot(B).
         # t is a scaling factor of L
@@ -297,6 +1283,502 @@ class ExplicitPropagator(object):
         return scipy.linalg.expm(self._M.T*t).dot(B)
 
 
+class SpectralPropagator(object):
+    """
+    This explicitly computes the matrix exponential from a cached factorization.
+
+    The matrix is factored once as M = U diag(w) V where V is the inverse
+    of U, so that expm(M*t) = U diag(exp(w*t)) V for every scaling factor t.
+    This replaces one Pade approximation per call by a scaled matrix product.
+
+    If the matrix of eigenvectors is too poorly conditioned to be trusted,
+    for example because M is not diagonalizable, then the factorization
+    is discarded and each call falls back to the Pade approximation.
+    The same fallback is used for any scaling factor t whose reconstructed
+    matrix exponential does not pass a cheap sanity check.
+
+    """
+    def __init__(self, M, max_condition=1e6):
+        # M is assumed to be an explicit real ndarray.
+        self.shape = M.shape
+        self.dtype = M.dtype
+        self._M = M
+        self._w = None
+        self._U = None
+        self._V = None
+        try:
+            w, U = scipy.linalg.eig(M)
+            if np.all(np.isfinite(w)) and np.linalg.cond(U) < max_condition:
+                self._w = w
+                self._U = U
+                self._V = scipy.linalg.inv(U)
+        except (np.linalg.LinAlgError, ValueError):
+            pass
+
+    @property
+    def factored(self):
+        return self._w is not None
+
+    def _parameterized_expm(self, t):
+        # Compute expm(M*t) as an explicit ndarray.
+        # t is a scaling factor of M
+        if self._w is not None:
+            P = (self._U * np.exp(self._w * t)).dot(self._V)
+            if np.isrealobj(P):
+                return P
+            # Complex conjugate eigenvalue pairs cancel in exact arithmetic.
+            # A large imaginary residual indicates loss of accuracy.
+            if np.all(np.isfinite(P)):
+                scale = max(1.0, np.abs(P.real).max())
+                if np.abs(P.imag).max() <= 1e-8 * scale:
+                    return P.real
+        return scipy.linalg.expm(self._M*t)
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        return self._parameterized_expm(t).dot(B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        return self._parameterized_expm(t).T.dot(B)
+
+
+def get_stationary_distribution(M):
+    """
+    Solve for a stationary distribution of a dense rate matrix.
+
+    The solution is unique only if the process is irreducible,
+    and it is returned without checking its positivity.
+
+    """
+    n = M.shape[0]
+    A = np.vstack((M.T, np.ones(n)))
+    b = np.zeros(n + 1)
+    b[-1] = 1
+    distn, residues, rank, sv = scipy.linalg.lstsq(A, b)
+    return distn
+
+
+def _check_detailed_balance(M, distn, rtol):
+    if distn is None or distn.shape != M.shape[:1]:
+        return False
+    if not np.all(distn > 0):
+        return False
+    F = distn[:, np.newaxis] * M
+    return np.allclose(F, F.T, rtol=0, atol=rtol * np.abs(F).max())
+
+
+class ReversiblePropagator(object):
+    """
+    This explicitly computes the matrix exponential of a reversible process.
+
+    If the rate matrix M satisfies detailed balance with respect to
+    a positive distribution p, then with D = diag(p) the similar matrix
+    D^(1/2) M D^(-1/2) is symmetric and its eigendecomposition
+    S = U diag(w) U' can be computed with the symmetric solver.
+    This is faster and better conditioned than the general solver,
+    and expm(M*t) = D^(-1/2) U diag(exp(w*t)) U' D^(1/2)
+    is real for every scaling factor t.
+
+    The candidate distribution is typically the prior distribution
+    at the root.  If it is missing or if detailed balance is not satisfied
+    with respect to it, then a stationary distribution of M is computed
+    and checked instead.  If neither distribution works,
+    the propagator falls back to a SpectralPropagator.
+
+    """
+    def __init__(self, M, distn=None, rtol=1e-8):
+        # M is assumed to be an explicit real ndarray.
+        self.shape = M.shape
+        self.dtype = M.dtype
+        self._M = M
+        self._w = None
+        self._fallback = None
+        if not _check_detailed_balance(M, distn, rtol):
+            distn = get_stationary_distribution(M)
+        if _check_detailed_balance(M, distn, rtol):
+            r = np.sqrt(distn)
+            S = (r[:, np.newaxis] * M) / r
+            w, U = scipy.linalg.eigh((S + S.T) / 2)
+            self._w = w
+            self._left = U / r[:, np.newaxis]
+            self._right = U.T * r
+            self.stationary_distn = distn
+        else:
+            self._fallback = SpectralPropagator(M)
+            self.stationary_distn = None
+
+    @property
+    def reversible(self):
+        return self._w is not None
+
+    def _parameterized_expm(self, t):
+        # Compute expm(M*t) as an explicit ndarray.
+        # t is a scaling factor of M
+        if self._fallback is not None:
+            return self._fallback._parameterized_expm(t)
+        return (self._left * np.exp(self._w * t)).dot(self._right)
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        return self._parameterized_expm(t).dot(B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        return self._parameterized_expm(t).T.dot(B)
+
+
+class PermutedPropagator(object):
+    """
+    Wraps a propagator of a matrix whose states have been reordered.
+
+    If the wrapped propagator acts on M[perm][:, perm],
+    then this propagator acts on M.
+    The input is reordered once per call rather than once per product.
+
+    """
+    def __init__(self, P, perm):
+        self.shape = P.shape
+        self.dtype = P.dtype
+        self._P = P
+        self._perm = perm
+
+    @property
+    def error_estimate(self):
+        return getattr(self._P, 'error_estimate', None)
+
+    def predict_iterations(self, t, ncols):
+        return self._P.predict_iterations(t, ncols)
+
+    def _unpermuted(self, Y):
+        out = np.empty_like(Y)
+        out[self._perm] = Y
+        return out
+
+    def _permuted(self, f, t, B):
+        return self._unpermuted(f(t, B[self._perm]))
+
+    def _parameterized_matmat(self, t, B):
+        return self._permuted(self._P._parameterized_matmat, t, B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        return self._permuted(self._P._parameterized_adjoint_matmat, t, B)
+
+    def _parameterized_multi_matmat(self, ts, B):
+        Ys = get_multi_matmat(self._P, ts, B[self._perm])
+        return [self._unpermuted(Y) for Y in Ys]
+
+    def _parameterized_adjoint_multi_matmat(self, ts, B):
+        Ys = get_adjoint_multi_matmat(self._P, ts, B[self._perm])
+        return [self._unpermuted(Y) for Y in Ys]
+
+
+class TridiagonalPropagator(object):
+    """
+    This explicitly computes the matrix exponential of a birth-death process.
+
+    The rate matrix R + diag(d) must be tridiagonal after the optional
+    reordering of the states, with positive rates in both directions
+    between each pair of neighboring states.
+    Such a process satisfies detailed balance with respect to its
+    stationary distribution p, so with D = diag(p) the similar matrix
+    D^(1/2) M D^(-1/2) is symmetric tridiagonal,
+    and its eigendecomposition is computed by the tridiagonal solver.
+    The reordering is absorbed into the eigenvectors.
+
+    """
+    def __init__(self, R, d, perm=None):
+        R = scipy.sparse.csr_matrix(R)
+        n = R.shape[0]
+        if perm is None:
+            perm = np.arange(n)
+        R = R[perm][:, perm]
+        diag = np.asarray(d, dtype=float)[perm] + R.diagonal()
+        if get_bandwidth(R) > 1:
+            raise ValueError('expected a tridiagonal rate matrix')
+        upper = R.diagonal(1)
+        lower = R.diagonal(-1)
+        if not (np.all(upper > 0) and np.all(lower > 0)):
+            raise ValueError('expected positive rates in both directions '
+                    'between neighboring states')
+
+        # The logarithm of the square root of the stationary distribution
+        # is computed up to an additive constant.
+        half_log_p = np.concatenate((
+            [0], np.cumsum(np.log(upper) - np.log(lower)) / 2))
+        half_log_p -= (half_log_p.max() + half_log_p.min()) / 2
+        if np.ptp(half_log_p) > 600:
+            raise ValueError('the stationary distribution is too uneven '
+                    'for a symmetric similarity transformation')
+        r = np.exp(half_log_p)
+        w, U = scipy.linalg.eigh_tridiagonal(diag, np.sqrt(upper * lower))
+
+        # Undo the reordering of the states.
+        left = np.empty_like(U)
+        right = np.empty_like(U)
+        left[perm] = U / r[:, np.newaxis]
+        right[:, perm] = U.T * r
+        self.shape = (n, n)
+        self.dtype = left.dtype
+        self._w = w
+        self._left = left
+        self._right = right
+        p = np.empty(n)
+        p[perm] = r * r
+        self.stationary_distn = p / p.sum()
+
+    def _parameterized_expm(self, t):
+        # Compute expm(M*t) as an explicit ndarray.
+        # t is a scaling factor of M
+        return (self._left * np.exp(self._w * t)).dot(self._right)
+
+    def _parameterized_matmat(self, t, B):
+        # Compute expm(M*t).dot(B) without forming the matrix.
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        E = np.exp(self._w * t)
+        if B.ndim == 1:
+            return self._left.dot(E * self._right.dot(B))
+        return self._left.dot(E[:, np.newaxis] * self._right.dot(B))
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Compute expm(M.H*t).dot(B) without forming the matrix.
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        E = np.exp(self._w * t)
+        if B.ndim == 1:
+            return self._right.T.dot(E * self._left.T.dot(B))
+        return self._right.T.dot(E[:, np.newaxis] * self._left.T.dot(B))
+
+
+def get_strong_components(R):
+    """
+    Find the strongly connected components of the graph of a rate matrix.
+
+    Parameters
+    ----------
+    R : sparse square matrix
+        Non-negative off-diagonal rates.
+
+    Returns
+    -------
+    ncomponents : int
+        The number of strongly connected components.
+    labels : 1d integer ndarray
+        The component label of each state.
+    G : networkx DiGraph
+        The directed acyclic condensation graph on component labels.
+
+    """
+    R = scipy.sparse.coo_matrix(R)
+    mask = R.data != 0
+    row = R.row[mask]
+    col = R.col[mask]
+    A = scipy.sparse.coo_matrix(
+            (np.ones(row.shape[0]), (row, col)), shape=R.shape)
+    ncomponents, labels = connected_components(
+            A, directed=True, connection='strong')
+    G = nx.DiGraph()
+    G.add_nodes_from(range(ncomponents))
+    lrow = labels[row]
+    lcol = labels[col]
+    mask = lrow != lcol
+    G.add_edges_from(set(zip(lrow[mask].tolist(), lcol[mask].tolist())))
+    return ncomponents, labels, G
+
+
+def _min_eigenvalue_distance(a, b):
+    return np.min(np.abs(a[:, np.newaxis] - b[np.newaxis, :]))
+
+
+class BlockTriangularPropagator(object):
+    """
+    This explicitly computes the matrix exponential of a reducible rate matrix.
+
+    The states are permuted according to a topological order of the
+    strongly connected components of the graph of the rate matrix,
+    so that the permuted rate matrix is block upper triangular.
+    Each diagonal block is exponentiated by its own small propagator,
+    and each off-diagonal block of the matrix exponential is computed
+    by the block Parlett recurrence, which requires solving one
+    Sylvester equation per coupled pair of blocks.
+    The real Schur forms of the diagonal blocks are computed only once.
+
+    The Sylvester equations are well conditioned only if the spectra
+    of coupled diagonal blocks are well separated,
+    so coupled blocks with nearby eigenvalues are merged beforehand.
+
+    """
+    def __init__(self, R, exit_rates, separation=1e-2):
+        # R is a sparse matrix of non-negative off-diagonal rates.
+        self.shape = R.shape
+        self.dtype = R.dtype
+        n = R.shape[0]
+        ncomponents, labels, G = get_strong_components(R)
+        order = list(nx.topological_sort(G))
+        position = np.empty(ncomponents, dtype=int)
+        position[order] = np.arange(ncomponents)
+        state_positions = position[labels]
+        Q = (scipy.sparse.csr_matrix(R) -
+                scipy.sparse.diags(exit_rates, 0)).tocsr()
+        self._Q = Q
+
+        # Each group is a contiguous range of positions in the
+        # topological order of the components.
+        descendants = [nx.descendants(G, c) for c in range(ncomponents)]
+        groups = [(i, i+1) for i in range(ncomponents)]
+        scale = 1 + np.max(np.abs(exit_rates)) if n else 1
+
+        def group_states(group):
+            lo, hi = group
+            return np.flatnonzero(
+                    (lo <= state_positions) & (state_positions < hi))
+
+        def group_eigenvalues(group):
+            idx = group_states(group)
+            return scipy.linalg.eigvals(Q[idx][:, idx].A)
+
+        def group_reaches(ga, gb):
+            targets = set(order[gb[0]:gb[1]])
+            return any(targets & descendants[c] for c in order[ga[0]:ga[1]])
+
+        eigenvalues = [group_eigenvalues(g) for g in groups]
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(groups)):
+                for j in range(i+1, len(groups)):
+                    if not group_reaches(groups[i], groups[j]):
+                        continue
+                    dist = _min_eigenvalue_distance(
+                            eigenvalues[i], eigenvalues[j])
+                    if dist < separation * scale:
+                        group = (groups[i][0], groups[j][1])
+                        groups[i:j+1] = [group]
+                        eigenvalues[i:j+1] = [group_eigenvalues(group)]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        # Precompute per-group quantities that do not depend on t.
+        self._indices = [group_states(g) for g in groups]
+        k = len(groups)
+        self._reach = np.zeros((k, k), dtype=bool)
+        for i in range(k):
+            for j in range(i+1, k):
+                self._reach[i, j] = group_reaches(groups[i], groups[j])
+        self._blocks = {}
+        for i in range(k):
+            for j in range(i, k):
+                idx, jdx = self._indices[i], self._indices[j]
+                block = Q[idx][:, jdx]
+                if i == j or block.nnz:
+                    self._blocks[i, j] = block.A
+        self._diagonal_propagators = []
+        self._schur = []
+        for i in range(k):
+            M = self._blocks[i, i]
+            self._diagonal_propagators.append(SpectralPropagator(M))
+            if any(self._reach[i, i+1:]) or any(self._reach[:i, i]):
+                self._schur.append(scipy.linalg.schur(M, output='real'))
+            else:
+                self._schur.append(None)
+        self._trsyl = None
+        self.block_sizes = [idx.shape[0] for idx in self._indices]
+
+    @property
+    def max_block_size(self):
+        return max(self.block_sizes) if self.block_sizes else 0
+
+    def _solve_sylvester(self, i, j, C):
+        # Solve Q_ii X - X Q_jj = C using the cached real Schur forms.
+        Si, Ui = self._schur[i]
+        Sj, Uj = self._schur[j]
+        if self._trsyl is None:
+            self._trsyl, = get_lapack_funcs(('trsyl',), (Si, Sj, C))
+        F = Ui.T.dot(C).dot(Uj)
+        Y, scale, info = self._trsyl(Si, Sj, F, isgn=-1)
+        if info < 0:
+            raise np.linalg.LinAlgError('illegal value in trsyl')
+        return Ui.dot(Y).dot(Uj.T) / scale
+
+    def _parameterized_expm(self, t):
+        # Compute expm(M*t) as an explicit ndarray.
+        # t is a scaling factor of M
+        n = self.shape[0]
+        k = len(self._indices)
+        F = {}
+        for i in range(k):
+            F[i, i] = self._diagonal_propagators[i]._parameterized_expm(t)
+        if t:
+            for gap in range(1, k):
+                for i in range(k - gap):
+                    j = i + gap
+                    if not self._reach[i, j]:
+                        continue
+                    # Use the commutation of F = expm(Q*t) with Q.
+                    ni = self._indices[i].shape[0]
+                    nj = self._indices[j].shape[0]
+                    C = np.zeros((ni, nj))
+                    for m in range(i, j):
+                        if (i, m) in F and (m, j) in self._blocks:
+                            C += F[i, m].dot(self._blocks[m, j])
+                    for m in range(i+1, j+1):
+                        if (i, m) in self._blocks and (m, j) in F:
+                            C -= self._blocks[i, m].dot(F[m, j])
+                    F[i, j] = self._solve_sylvester(i, j, C)
+        P = np.zeros((n, n))
+        for (i, j), block in F.items():
+            P[np.ix_(self._indices[i], self._indices[j])] = block
+        return P
+
+    def _parameterized_matmat(self, t, B):
+        # Approximate expm(M*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the linear function
+        return self._parameterized_expm(t).dot(B)
+
+    def _parameterized_adjoint_matmat(self, t, B):
+        # Approximate expm(M.H*t).dot(B).
+        # t is a scaling factor of L
+        # B the input matrix of the adjoint linear function
+        return self._parameterized_expm(t).T.dot(B)
+
+
+def get_multi_matmat(P, ts, B):
+    """
+    Compute expm(M*t).dot(B) for each t in ts using the propagator P.
+
+    Propagators that share work among scaling factors provide
+    _parameterized_multi_matmat, and the others are called once per t.
+
+    """
+    f = getattr(P, '_parameterized_multi_matmat', None)
+    if f is not None:
+        return f(ts, B)
+    return [P._parameterized_matmat(t, B) for t in ts]
+
+
+def get_adjoint_multi_matmat(P, ts, B):
+    """
+    Compute expm(M.H*t).dot(B) for each t in ts using the propagator P.
+
+    """
+    f = getattr(P, '_parameterized_adjoint_multi_matmat', None)
+    if f is not None:
+        return f(ts, B)
+    return [P._parameterized_adjoint_matmat(t, B) for t in ts]
+
+
 class MatrixExponential(HighLevelInterface):
     # The input is already a propagator; this just scales by a specific t.
     def __init__(self, P, t):
@@ -54,22 +54,25 @@ class IterationStash(object):
     The second iteration count is related to the number
     of requested segments that the interval should be broken into.
 
+    The theta table defaults to the double precision table.
+
     """
-    def __init__(self, A):
+    def __init__(self, A, theta=None):
         self._A = A
         self._mmax = MMAX
         self._pmax = PMAX
+        self._theta = THETA if theta is None else theta
 
         self._A_1_norm = A.one_norm()
         self._d = {1 : self._A_1_norm}
         self._alpha = {}
 
-        # Initialize the S matrix.
-        self._S = np.zeros((self._pmax+1, self._mmax+1))
+        # Collect the norm estimates that define the _S matrix.
+        norms = np.zeros(self._pmax+1)
+        norms[1] = self._A_1_norm
         for p in range(2, self._pmax+1):
-            for m in range(p*(p-1)-1, self._mmax+1):
-                if m in THETA:
-                    self._S[p, m] = self.alpha(p) / THETA[m]
+            norms[p] = self.alpha(p)
+        self._init_table(norms)
 
         # Remove connections to some values that had been used
         # to create the _S matrix.
@@ -78,6 +81,52 @@ class IterationStash(object):
         self._d = None
         self._alpha = None
 
+    @classmethod
+    def from_norms(cls, norms, theta=None):
+        """
+        Create a stash from norms previously returned by get_norms.
+
+        This skips the norm estimation, which is the expensive part
+        of creating a stash from a matrix.
+
+        """
+        obj = cls.__new__(cls)
+        obj._A = None
+        obj._mmax = MMAX
+        obj._pmax = PMAX
+        obj._theta = THETA if theta is None else theta
+        norms = np.asarray(norms, dtype=float)
+        if norms.shape != (obj._pmax+1, ):
+            raise ValueError('expected %d norms' % (obj._pmax+1))
+        obj._A_1_norm = norms[1]
+        obj._d = None
+        obj._alpha = None
+        obj._init_table(norms)
+        return obj
+
+    def _init_table(self, norms):
+        # The entry norms[1] is the 1-norm of the matrix,
+        # and for p >= 2 the entry norms[p] is alpha(p).
+        self._norms = norms
+
+        # Initialize the S matrix.
+        self._S = np.zeros((self._pmax+1, self._mmax+1))
+        for p in range(2, self._pmax+1):
+            for m in range(p*(p-1)-1, self._mmax+1):
+                if m in self._theta:
+                    self._S[p, m] = norms[p] / self._theta[m]
+
+    def get_norms(self):
+        """
+        Return the 1d array of norm estimates defining this stash.
+
+        """
+        return self._norms.copy()
+
+    @property
+    def nbytes(self):
+        return self._norms.nbytes + self._S.nbytes
+
     def d(self, p):
         # This calculation requires computing a root of an estimate
         # of the one-norm of a power of the A matrix.
@@ -106,7 +155,7 @@ class IterationStash(object):
         elif self.condition_3_13(n0, t, ell):
             onenorm = self._A_1_norm * t
             triples = []
-            for m, theta in THETA.items():
+            for m, theta in self._theta.items():
                 s = int(np.ceil(onenorm / theta))
                 triples.append((m*s, m, s))
             #print(triples)
@@ -121,7 +170,7 @@ class IterationStash(object):
         a = 2 * ell * self._pmax * (self._pmax + 3)
 
         # Evaluate the condition (3.13).
-        b = THETA[self._mmax] / float(n0 * self._mmax)
+        b = self._theta[self._mmax] / float(n0 * self._mmax)
         return self._A_1_norm * t <= a * b
 
     def cmstar(self, t):
@@ -6,7 +6,15 @@ from __future__ import division, print_function, absolute_import
 import numpy as np
 from numpy.testing import assert_
 
-from .ctmc_ops import Propagator, ExplicitPropagator, RdOperator
+import scipy.sparse
+
+from .ctmc_ops import (
+        Propagator, ExplicitPropagator, SpectralPropagator, ReversiblePropagator,
+        BlockTriangularPropagator, UniformizationPropagator, KrylovPropagator,
+        ChebyshevPropagator, check_sparse_detailed_balance, as_canonical_csr,
+        RdOperator, KroneckerSumOperator, get_strong_components,
+        get_banded_ordering, BandedOperator, PermutedPropagator,
+        TridiagonalPropagator)
 
 
 class LinearSystem(object):
@@ -26,28 +34,110 @@ class LinearSystem(object):
     The style hint determines whether to use a dense vs. an abstract
     linear operator.  Note that regardless of the style hint,
     the input should still be a scipy sparse matrix.
+    The 'dense' style computes a Pade approximation of each requested
+    matrix exponential, whereas the 'spectral' style factors the dense
+    rate matrix once and reuses the factorization across scaling factors.
+    The 'reversible' style is like the 'spectral' style, except that
+    if the process satisfies detailed balance with respect to the
+    candidate stationary distribution or with respect to a computed
+    stationary distribution, then the symmetric eigensolver is used.
+    The 'block' style permutes a reducible rate matrix to block upper
+    triangular form according to the strongly connected components
+    of its graph, and exponentiates small dense blocks.
+    The 'uniformization' style uses an abstract linear operator
+    and sums Poisson weighted powers of the uniformized transition matrix.
+    The 'krylov' style uses an abstract linear operator and restarted
+    Krylov subspaces, which is useful for large state spaces
+    when few columns are propagated at once.
+    The 'chebyshev' style uses an abstract linear operator and a Chebyshev
+    expansion, which requires detailed balance with respect to the
+    stationary distribution so that the spectrum is real.
+    The 'banded' style reorders the states to reduce the bandwidth
+    of the rate matrix and uses an abstract linear operator
+    with banded storage.
+    The 'tridiagonal' style is for birth-death processes
+    whose rate matrices are tridiagonal after reordering,
+    and it uses the symmetric tridiagonal eigensolver.
+    For small state spaces the 'auto' style uses the 'reversible' style.
+    For larger birth-death processes the 'auto' style uses the
+    'tridiagonal' style, and for other rate matrices with narrow bands
+    after reordering it uses the 'banded' style.
+    For moderately large reducible state spaces whose strongly connected
+    components are small, the 'auto' style uses the 'block' style.
+    Otherwise for large state spaces the 'auto' style uses the 'chebyshev'
+    style if the process is reversible with respect to the provided
+    stationary distribution, and the 'abstract' style if not.
+
+    If axis matrices are provided, then the off-diagonal rates are
+    the Kronecker sum of the dense axis matrices plus the sparse matrix R,
+    and the 'abstract' style applies the Kronecker sum axis by axis.
+
+    The 'abstract' style propagates the columns of its input in blocks
+    of at most block_width columns, or of a default width if this is None,
+    and it splits the columns among nthreads threads.
+    If the dtype is single precision, then the 'abstract' style uses
+    a single precision operator with tolerances matched to that precision.
+    The optional tol is a requested accuracy for the 'abstract',
+    'uniformization', 'krylov', and 'chebyshev' styles,
+    which may trade accuracy for speed.
 
     """
-    def __init__(self, R, style='auto'):
+    def __init__(self, R, style='auto', axis_matrices=None,
+            stationary_distn=None, block_width=None, dtype=None, tol=None,
+            nthreads=None):
 
         # Input validation.
-        assert_(style in {'auto', 'dense', 'abstract'})
+        assert_(style in {
+            'auto', 'dense', 'spectral', 'reversible', 'block', 'abstract',
+            'uniformization', 'krylov', 'chebyshev', 'banded', 'tridiagonal'})
         if len(R.shape) != 2:
             raise ValueError
         if R.shape[1] != R.shape[0]:
             raise ValueError
 
+        # Represent the Kronecker sum form with zero diagonal.
+        if axis_matrices is not None:
+            d = np.zeros(R.shape[0])
+            K = KroneckerSumOperator(axis_matrices, R, d)
+            if K.shape != R.shape:
+                raise ValueError
+
         # Determine whether to use a dense matrix or not.
         n = R.shape[0]
+        auto = (style == 'auto')
+        if auto and axis_matrices is not None:
+            style = 'reversible' if n < 100 else 'abstract'
+        perm = None
+        bandwidth = None
+        if style in ('banded', 'tridiagonal') and axis_matrices is not None:
+            raise ValueError('the %s style requires explicit rates' % style)
+        if style in ('auto', 'banded', 'tridiagonal'):
+            if style != 'auto' or n >= 100:
+                perm, bandwidth = get_banded_ordering(R)
         if style == 'auto':
             auto_threshold = 100
+            block_threshold = 2000
+            tridiagonal_threshold = 1000
             if n < auto_threshold:
-                use_dense_matrix = True
+                style = 'reversible'
+            elif bandwidth == 1 and n <= tridiagonal_threshold:
+                style = 'tridiagonal'
+            elif (4*bandwidth < n and
+                    (2*bandwidth + 1) * n <= 2 * (R.nnz + n)):
+                style = 'banded'
+            elif n <= block_threshold:
+                ncomponents, labels, G = get_strong_components(R)
+                max_component_size = np.bincount(labels).max()
+                if ncomponents > 1 and max_component_size < auto_threshold:
+                    style = 'block'
+                else:
+                    style = 'abstract'
             else:
-                use_dense_matrix = False
-        elif style == 'dense':
+                style = 'abstract'
+        if style in ('dense', 'spectral', 'reversible', 'block'):
             use_dense_matrix = True
-        elif style == 'abstract':
+        elif style in ('abstract', 'uniformization', 'krylov', 'chebyshev',
+                'banded', 'tridiagonal'):
             use_dense_matrix = False
         else:
             raise ValueError
@@ -55,20 +145,101 @@ class LinearSystem(object):
         # R : sparse square matrix of non-negative off-diagonal rates
         self.shape = R.shape
         self.dtype = R.dtype
+        self._explicit_P = None
 
         # Compute exit rates.
-        exit_rates = R.sum(axis=1).A.ravel()
+        if axis_matrices is not None:
+            exit_rates = K.abs_sum_axis_1()
+            if use_dense_matrix:
+                R = scipy.sparse.csr_matrix(K.todense())
+        else:
+            exit_rates = R.sum(axis=1).A.ravel()
+
+        # The Chebyshev expansion requires a real spectrum,
+        # so check detailed balance with respect to the given distribution.
+        if style in ('abstract', 'chebyshev') and stationary_distn is not None:
+            full_R = R if axis_matrices is None else K.tosparse()
+            reversible = check_sparse_detailed_balance(full_R, stationary_distn)
+            if auto and reversible:
+                style = 'chebyshev'
+            if style == 'chebyshev' and not reversible:
+                raise ValueError('the chebyshev style requires detailed '
+                        'balance with respect to the stationary distribution')
+        elif style == 'chebyshev':
+            raise ValueError('the chebyshev style requires '
+                    'a stationary distribution')
 
         # Determine whether to use abstract or explicit linear operators.
-        if use_dense_matrix:
+        if style == 'block':
+            self._P = BlockTriangularPropagator(R, exit_rates)
+            self._Q = self._P._Q
+        elif use_dense_matrix:
             self._Q = R.A - np.diag(exit_rates)
-            self._P = ExplicitPropagator(self._Q)
+            if style == 'reversible':
+                self._P = ReversiblePropagator(self._Q, stationary_distn)
+            elif style == 'spectral':
+                self._P = SpectralPropagator(self._Q)
+            else:
+                self._P = ExplicitPropagator(self._Q)
         else:
+            # Compile the sparse rates once for all of the operators.
+            R = as_canonical_csr(R)
             d = -exit_rates
-            mu = np.mean(d)
-            op = RdOperator(R, d - mu)
-            self._P = Propagator(op, mu)
-            self._Q = RdOperator(R, d)
+            rate = np.max(exit_rates) if n else 0
+            if axis_matrices is not None:
+                self._Q = KroneckerSumOperator(axis_matrices, R, d)
+            else:
+                self._Q = RdOperator(R, d)
+            if style == 'tridiagonal':
+                try:
+                    self._P = TridiagonalPropagator(R, d, perm)
+                except ValueError:
+                    if not auto:
+                        raise
+                    style = 'banded'
+            if style == 'tridiagonal':
+                pass
+            elif style == 'banded':
+                mu = np.mean(d)
+                Rp = R[perm][:, perm]
+                op = BandedOperator(Rp, d[perm] - mu, bandwidth)
+                P = Propagator(op, mu, block_width, tol, nthreads)
+                if np.array_equal(perm, np.arange(n)):
+                    self._P = P
+                else:
+                    self._P = PermutedPropagator(P, perm)
+            elif style == 'uniformization':
+                self._P = UniformizationPropagator(self._Q, rate, tol)
+            elif style == 'krylov':
+                if tol is None:
+                    self._P = KrylovPropagator(self._Q)
+                else:
+                    self._P = KrylovPropagator(self._Q, tol=tol)
+            elif style == 'chebyshev':
+                self._P = ChebyshevPropagator(self._Q, rate, tol)
+            else:
+                mu = np.mean(d)
+                if axis_matrices is not None:
+                    op = KroneckerSumOperator(axis_matrices, R, d - mu)
+                elif dtype is not None and np.dtype(dtype) == np.float32:
+                    op = RdOperator(R.astype(np.float32),
+                            (d - mu).astype(np.float32))
+                else:
+                    op = RdOperator(R, d - mu)
+                self._P = Propagator(op, mu, block_width, tol, nthreads)
+
+        # Count the nonzero entries touched by each product
+        # with the instantaneous operator, including its diagonal.
+        if axis_matrices is not None and not use_dense_matrix:
+            self.nnz = R.nnz + n + sum(
+                    n * np.count_nonzero(A) // A.shape[0]
+                    for A in axis_matrices)
+        elif use_dense_matrix:
+            self.nnz = n * n
+        elif style == 'banded':
+            self.nnz = (2*bandwidth + 1) * n
+        else:
+            self.nnz = R.nnz + n
 
     @property
     def instantaneous_operator(self):
@@ -79,3 +250,18 @@ class LinearSystem(object):
         # This could be converted to an operator using the following:
         # op = MatrixExponential(P, t)
         return self._P
+
+    def get_explicit_propagator(self):
+        """
+        Return a propagator that can compute explicit transition matrices.
+
+        If the propagator already has this capability then it is returned,
+        otherwise a Pade approximation propagator is created for
+        the dense rate matrix and reused across calls.
+
+        """
+        if hasattr(self._P, '_parameterized_expm'):
+            return self._P
+        if self._explicit_P is None:
+            self._explicit_P = ExplicitPropagator(self._Q.todense())
+        return self._explicit_P
@@ -0,0 +1,73 @@
+"""
+Shared worker threads for column-parallel matrix exponential actions.
+
+The columns of the input block of a matrix exponential action
+are independent, so they can be split into contiguous shards
+that are propagated by separate threads.
+The sparse products and the dense array operations release the GIL.
+
+The default number of threads is taken from the JSONCTMCTREE_NUM_THREADS
+environment variable, and it is 1 if the variable is not set.
+Each shard is written to its own columns of the output,
+so the results do not depend on the scheduling of the threads.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = ['get_thread_count', 'get_thread_pool', 'get_column_shards']
+
+
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_count(nthreads=None):
+    """
+    Return the requested number of threads, or the default number.
+
+    """
+    if nthreads is None:
+        value = os.environ.get('JSONCTMCTREE_NUM_THREADS')
+        nthreads = int(value) if value else 1
+    nthreads = int(nthreads)
+    if nthreads < 1:
+        raise ValueError('expected a positive number of threads')
+    return nthreads
+
+
+def get_thread_pool(nthreads):
+    """
+    Return a pool of worker threads that is shared within the process.
+
+    """
+    with _thread_pools_lock:
+        pool = _thread_pools.get(nthreads)
+        if pool is None:
+            pool = ThreadPool(nthreads)
+            _thread_pools[nthreads] = pool
+    return pool
+
+
+def get_column_shards(ncols, block_width, nthreads=1):
+    """
+    Split the columns into contiguous shards.
+
+    Each shard has at most block_width columns,
+    and there are at least nthreads shards if there are enough columns.
+
+    Returns
+    -------
+    shards : list of pairs
+        The start and stop column of each shard.
+
+    """
+    width = block_width
+    if nthreads > 1:
+        width = max(1, min(block_width, -(-ncols // nthreads)))
+    return [(start, min(start + width, ncols))
+            for start in range(0, ncols, width)]
@@ -0,0 +1,198 @@
+"""
+Test caches of intermediate arrays.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+import scipy.sparse
+from scipy.linalg import expm
+
+from jsonctmctree.pyexp.caching import (
+        LRUCache, TransitionMatrixCache, EdgeProductCache,
+        IterationStashCache, get_iteration_stash_cache)
+from jsonctmctree.pyexp.ctmc_ops import RdOperator, Propagator
+from jsonctmctree.pyexp.experimental import IterationStash
+from jsonctmctree.expm_helpers import (
+        ActionExpm, ImplicitTransitionExpmFrechet, create_dense_rate_matrix)
+from jsonctmctree.common_unpacking_ex import (
+        TopLevel, interpret_tree, interpret_root_prior)
+from jsonctmctree.common_likelihood import get_subtree_likelihoods
+from jsonctmctree import expect
+
+
+def test_lru_cache_eviction():
+    # Each array uses 80 bytes, so the cache can hold two of them.
+    cache = LRUCache(max_bytes=160)
+    for key in 'a', 'b', 'a', 'c', 'b':
+        cache.get(key, lambda: np.zeros(10))
+    assert_equal(cache.hits, 1)
+    assert_equal(cache.misses, 4)
+    assert_equal(len(cache), 2)
+    assert_equal(cache.nbytes, 160)
+    assert_equal('a' in cache, False)
+
+
+def test_lru_cache_oversized_value():
+    cache = LRUCache(max_bytes=8)
+    value = cache.get('a', lambda: np.zeros(10))
+    assert_equal(value.shape, (10, ))
+    assert_equal(len(cache), 0)
+    assert_equal(cache.nbytes, 0)
+
+
+def test_shared_transition_matrix_cache():
+    np.random.seed(1234)
+    state_space_shape = (3, )
+    row = np.array([[0], [0], [1], [1], [2], [2]])
+    col = np.array([[1], [2], [0], [2], [0], [1]])
+    cache = TransitionMatrixCache()
+    objects = []
+    for process in range(2):
+        rate = np.exp(np.random.randn(6))
+        obj = ActionExpm(state_space_shape, row, col, rate,
+                cache=cache, process=process)
+        Q = create_dense_rate_matrix(state_space_shape, row, col, rate)
+        objects.append((obj, Q))
+
+    # The forward, transpose, and adjoint products share a matrix
+    # for each (process, rate) pair.
+    A = np.random.randn(3, 5)
+    for t in 0.5, 2.0, 0.5:
+        for obj, Q in objects:
+            P = expm(Q * t)
+            assert_allclose(obj.expm_mul(t, A), P.dot(A))
+            assert_allclose(obj.expm_tmul(t, A), P.T.dot(A))
+            assert_allclose(obj.expm_rmul(t, A.T), A.T.dot(P))
+    assert_equal(cache.misses, 4)
+    assert_equal(cache.hits, 14)
+
+
+def test_edge_product_cache():
+    # The products along edges from the subtree likelihood pass
+    # are reused by the marginal distribution and expectation passes.
+    np.random.seed(1234)
+    n = 4
+    Q = np.exp(np.random.randn(n, n))
+    np.fill_diagonal(Q, 0)
+    row, col = np.nonzero(Q)
+    scene = dict(
+            node_count = 4,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = [1 / n] * n),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = Q[row, col].tolist())],
+            tree = dict(
+                row_nodes = [0, 0, 2],
+                column_nodes = [1, 2, 3],
+                edge_rate_scaling_factors = [0.1, 0.2, 0.3],
+                edge_processes = [0, 0, 0]),
+            observed_data = dict(
+                nodes = [1, 3],
+                variables = [0, 0],
+                iid_observations = [[0, 1], [2, 2], [3, 0]]))
+    scene = TopLevel(dict(scene=scene, requests=[])).scene
+    p = scene.process_definitions[0]
+    shape = scene.state_space_shape
+    obs = scene.observed_data
+    tree_info = interpret_tree(scene)
+    prior = interpret_root_prior(scene)
+    f = [ActionExpm(shape, p.row_states, p.column_states, p.transition_rates)]
+    g = [ImplicitTransitionExpmFrechet(shape,
+        p.row_states, p.column_states, p.transition_rates, np.ones(len(row)))]
+    nsites = obs.iid_observations.shape[0]
+    common = tree_info + (shape, obs.nodes, obs.variables,
+            obs.iid_observations)
+    subtree = get_subtree_likelihoods(f, True, *common)
+    marginal = expect.get_node_to_marginal_distn(f, subtree, prior, *common)
+    expectations = expect.get_edge_to_site_expectations(
+            nsites, n, f, g, marginal, subtree, prior, *common)
+
+    # Products that do not fit in the cache are recomputed.
+    for max_bytes, nproducts in (2**20, 3), (0, 0):
+        cache = EdgeProductCache(max_bytes)
+        get_subtree_likelihoods(f, True, *common, edge_products=cache)
+        assert_equal(len(cache), nproducts)
+        actual = expect.get_node_to_marginal_distn(
+                f, subtree, prior, *common, edge_products=cache)
+        for node, distn in marginal.items():
+            assert_allclose(actual[node], distn)
+        assert_equal(cache.hits, nproducts)
+        actual = expect.get_edge_to_site_expectations(
+                nsites, n, f, g, marginal, subtree, prior, *common,
+                edge_products=cache)
+        for edge, site_expectations in expectations.items():
+            assert_allclose(actual[edge], site_expectations)
+        assert_equal(cache.hits, 2 * nproducts)
+
+
+def _get_operator():
+    np.random.seed(1234)
+    n = 20
+    R = scipy.sparse.csr_matrix(np.exp(np.random.randn(n, n)))
+    R.setdiag(0)
+    R.eliminate_zeros()
+    d = -R.sum(axis=1).A.ravel()
+    return R, d
+
+
+def test_iteration_stash_from_norms():
+    R, d = _get_operator()
+    A = RdOperator(R, d - np.mean(d))
+    stash = IterationStash(A)
+    other = IterationStash.from_norms(stash.get_norms())
+    for n0 in 1, 10, 1000:
+        for t in 0.01, 1.0, 100.0:
+            assert_equal(other.fragment_3_1(n0, t), stash.fragment_3_1(n0, t))
+
+
+def test_shared_iteration_stash_cache():
+    # Propagators of operators with equal contents share stashes.
+    R, d = _get_operator()
+    mu = np.mean(d)
+    cache = get_iteration_stash_cache()
+    cache.clear()
+    hits = cache.hits
+    misses = cache.misses
+    B = np.random.randn(R.shape[0], 3)
+    for i in range(3):
+        P = Propagator(RdOperator(R.copy(), d - mu), mu)
+        P._parameterized_matmat(0.5, B)
+        P._parameterized_adjoint_matmat(0.5, B)
+    assert_equal(cache.misses - misses, 2)
+    assert_equal(cache.hits - hits, 4)
+
+    # Changing a rate changes the key.
+    R = R.copy()
+    R.data[0] *= 2
+    P = Propagator(RdOperator(R, d - mu), mu)
+    P._parameterized_matmat(0.5, B)
+    assert_equal(cache.misses - misses, 3)
+
+
+def test_iteration_stash_disk_cache():
+    R, d = _get_operator()
+    A = RdOperator(R, d - np.mean(d))
+    cache_dir = tempfile.mkdtemp()
+    try:
+        key = A.content_key()
+        stash = IterationStashCache(cache_dir=cache_dir).get_iteration_stash(
+                key, A)
+
+        # A new cache loads the norms without using the operator.
+        cache = IterationStashCache(cache_dir=cache_dir)
+        other = cache.get_iteration_stash(key, None)
+        assert_equal(cache.misses, 1)
+        assert_allclose(other.get_norms(), stash.get_norms())
+    finally:
+        shutil.rmtree(cache_dir)
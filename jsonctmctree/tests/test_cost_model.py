@@ -0,0 +1,78 @@
+"""
+Test the cost model that chooses between explicit and action strategies.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose, assert_
+
+from scipy.linalg import expm
+
+from jsonctmctree.pyexp import cost_model
+from jsonctmctree.pyexp.cost_model import CostModel, calibrate, get_cost_model
+from jsonctmctree.expm_helpers import ActionExpm, create_dense_rate_matrix
+from jsonctmctree.testutil import sample_time_nonreversible_rate_matrix
+
+
+def test_calibrate():
+    constants = calibrate()
+    assert_equal(set(constants), {'gemm', 'spmm', 'axpy', 'expm'})
+    for value in constants.values():
+        assert_(value > 0)
+
+
+def test_disk_cache():
+    cache_dir = tempfile.mkdtemp()
+    old_env = os.environ.get('JSONCTMCTREE_CACHE_DIR')
+    old_model = cost_model._cost_model
+    try:
+        os.environ['JSONCTMCTREE_CACHE_DIR'] = cache_dir
+        cost_model._cost_model = None
+        a = get_cost_model()
+        assert_(os.path.exists(os.path.join(cache_dir, 'cost_model.json')))
+        cost_model._cost_model = None
+        b = get_cost_model()
+        assert_equal(vars(a), vars(b))
+    finally:
+        if old_env is None:
+            del os.environ['JSONCTMCTREE_CACHE_DIR']
+        else:
+            os.environ['JSONCTMCTREE_CACHE_DIR'] = old_env
+        cost_model._cost_model = old_model
+        shutil.rmtree(cache_dir)
+
+
+def test_prefer_explicit():
+    model = CostModel(gemm=1e-9, spmm=1e-8, axpy=1e-9, expm=1e-8)
+    nstates = 3721
+    nnz = 61 * 61 * 120
+    m, s = 30, 4
+    assert_equal(model.prefer_explicit(nstates, nnz, 5000, m, s, True), True)
+    assert_equal(model.prefer_explicit(nstates, nnz, 3, m, s, False), False)
+
+
+def test_strategies_agree():
+    # Both strategies should give the same products.
+    np.random.seed(1234)
+    n = 120
+    Q, d = sample_time_nonreversible_rate_matrix(n)
+    row, col = np.nonzero(Q - np.diag(np.diag(Q)))
+    rate = Q[row, col]
+    state_space_shape = (n, )
+    row = row[:, np.newaxis]
+    col = col[:, np.newaxis]
+    explicit = CostModel(gemm=0, spmm=1, axpy=1, expm=0)
+    action = CostModel(gemm=1, spmm=0, axpy=0, expm=1)
+    A = np.random.randn(n, 3)
+    t = 0.01
+    P = expm(Q * t)
+    for model in explicit, action:
+        obj = ActionExpm(state_space_shape, row, col, rate, cost_model=model)
+        assert_allclose(obj.expm_mul(t, A), P.dot(A))
+        assert_allclose(obj.expm_tmul(t, A), P.T.dot(A))
+        assert_allclose(obj.expm_rmul(t, A.T), A.T.dot(P))
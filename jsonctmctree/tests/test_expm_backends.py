@@ -0,0 +1,98 @@
+"""
+Test that the registered matrix exponential backends agree.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_unpacking_ex import UnpackingError, TopLevel
+from jsonctmctree.expm_helpers import (
+        get_expm_backend_names, register_expm_backend, PadeExpm)
+from jsonctmctree.testutil import sample_time_reversible_rate_matrix
+
+
+# These backends require rate matrices with special structure.
+_restricted_backends = {'tridiagonal'}
+
+
+def _get_json_input():
+    # The process is reversible with respect to the root prior,
+    # so that every unrestricted backend is applicable.
+    np.random.seed(1234)
+    n = 4
+    Q, d = sample_time_reversible_rate_matrix(n)
+    row, col = np.nonzero(Q - np.diag(np.diag(Q)))
+    scene = dict(
+            node_count = 4,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = d.tolist()),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = Q[row, col].tolist())],
+            tree = dict(
+                row_nodes = [0, 0, 2],
+                column_nodes = [1, 2, 3],
+                edge_rate_scaling_factors = [0.1, 0.2, 0.3],
+                edge_processes = [0, 0, 0]),
+            observed_data = dict(
+                nodes = [1, 3],
+                variables = [0, 0],
+                iid_observations = [[0, 1], [2, 2], [3, 0]]))
+    requests = [
+            dict(property = 'dnnlogl'),
+            dict(property = 'ddnderi'),
+            dict(property = 'dndnode'),
+            dict(property = 'ddddwel')]
+    return dict(scene=scene, requests=requests)
+
+
+def test_backends_agree():
+    j_in = _get_json_input()
+    desired = process_json_in(j_in)
+    for name in get_expm_backend_names():
+        if name in _restricted_backends:
+            continue
+        actual = process_json_in(j_in, expm_backend=name)
+        assert_equal(actual['status'], 'feasible')
+        for a, b in zip(actual['responses'], desired['responses']):
+            assert_allclose(a, b)
+
+        # The same backend can be requested through the scene.
+        j_named = copy.deepcopy(j_in)
+        j_named['scene']['process_definitions'][0]['expm_backend'] = name
+        actual = process_json_in(j_named)
+        for a, b in zip(actual['responses'], desired['responses']):
+            assert_allclose(a, b)
+
+
+def test_unrecognized_backend():
+    j_in = _get_json_input()
+    j_in['scene']['process_definitions'][0]['expm_backend'] = 'magic'
+    assert_raises(UnpackingError, TopLevel, j_in)
+    j_in = _get_json_input()
+    assert_raises(ValueError, process_json_in, j_in, expm_backend='magic')
+
+
+def test_register_backend():
+    # Register a backend that counts its objects.
+    created = []
+    def factory(state_space_shape, row, col, rate, **kwargs):
+        obj = PadeExpm(state_space_shape, row, col, rate)
+        created.append(obj)
+        return obj
+    register_expm_backend('counted_pade', factory)
+    j_in = _get_json_input()
+    desired = process_json_in(j_in)
+    actual = process_json_in(j_in, expm_backend=['counted_pade'])
+    assert_equal(len(created), 1)
+    for a, b in zip(actual['responses'], desired['responses']):
+        assert_allclose(a, b)
@@ -0,0 +1,80 @@
+"""
+Test the implicit expm frechet products against dense calculations.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from itertools import product
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from scipy.linalg import expm_frechet
+
+from jsonctmctree.expm_helpers import (
+        create_dense_rate_matrix,
+        ImplicitDwellExpmFrechet,
+        ImplicitTransitionExpmFrechet,
+        ImplicitTransitionExpmFrechetEx)
+
+
+def _sample_process(n):
+    pairs = [(i, j) for i, j in product(range(n), repeat=2) if i != j]
+    row = np.array([[i] for i, j in pairs])
+    col = np.array([[j] for i, j in pairs])
+    rate = np.exp(np.random.randn(len(pairs)))
+    return row, col, rate
+
+
+def _check_frechet_product(obj, Q, E):
+    n = Q.shape[0]
+    B = np.random.rand(n, 3)
+    for t in 0.1, 1.0, 5.0:
+        P, K = expm_frechet(Q * t, E * t)
+        PB, KB = obj.get_expm_frechet_product(t, B)
+        assert_allclose(PB, P.dot(B))
+        assert_allclose(KB, K.dot(B), atol=1e-12)
+        assert_allclose(obj.get_frechet_product(t, B), K.dot(B), atol=1e-12)
+
+
+def test_dwell_frechet_product():
+    np.random.seed(1234)
+    n = 5
+    shape = (n, )
+    row, col, rate = _sample_process(n)
+    Q = create_dense_rate_matrix(shape, row, col, rate)
+    states = np.array([[1], [3], [1]])
+    weights = np.array([0.5, 2.0, 0.25])
+    obj = ImplicitDwellExpmFrechet(shape, row, col, rate, states, weights)
+    E = np.diag([0, 0.75, 0, 2.0, 0])
+    _check_frechet_product(obj, Q, E)
+
+
+def test_transition_frechet_product():
+    np.random.seed(1234)
+    n = 5
+    shape = (n, )
+    row, col, rate = _sample_process(n)
+    Q = create_dense_rate_matrix(shape, row, col, rate)
+    expect = np.random.rand(len(rate))
+    obj = ImplicitTransitionExpmFrechet(shape, row, col, rate, expect)
+    E = create_dense_rate_matrix(shape, row, col, rate * expect)
+    E -= np.diag(np.diag(E))
+    _check_frechet_product(obj, Q, E)
+
+
+def test_transition_frechet_product_ex():
+    np.random.seed(1234)
+    n = 5
+    shape = (n, )
+    row, col, rate = _sample_process(n)
+    Q = create_dense_rate_matrix(shape, row, col, rate)
+    expect_row = np.array([[0], [2]])
+    expect_col = np.array([[1], [4]])
+    expect_rate = np.array([1.0, 3.0])
+    obj = ImplicitTransitionExpmFrechetEx(shape, row, col, rate,
+            expect_row, expect_col, expect_rate)
+    E = np.zeros((n, n))
+    E[0, 1] = Q[0, 1]
+    E[2, 4] = 3 * Q[2, 4]
+    _check_frechet_product(obj, Q, E)
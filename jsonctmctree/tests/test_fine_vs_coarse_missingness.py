@@ -8,6 +8,8 @@ import numpy as np
 from numpy.testing import assert_equal
 
 from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_likelihood import (
+        ObservationEncoding, create_indicator_array)
 
 
 def get_partial_scene():
@@ -73,3 +75,30 @@ def test_coarse_vs_fine_grained_missingness():
     # so if this test fails in the future then consider allowing
     # some epsilon of closeness.
     assert_equal(j_out_coarse, j_out_fine)
+
+
+def test_observation_encoding():
+    # The compiled observations agree with the dense indicator arrays,
+    # both where all variables are observed and with missing observations.
+    shape = (3, 2)
+    nodes = np.array([1, 1, 2, 3, 3, 3])
+    axes = np.array([0, 1, 0, 1, 0, 1])
+    iid_observations = np.array([
+        [0, 1, 2, -1, 1, -1],
+        [2, 0, -1, -1, 0, 1],
+        [1, 1, 0, -1, -1, -1],
+        [0, 0, -1, -1, 2, 0]])
+    encoding = ObservationEncoding(shape, nodes, axes, iid_observations)
+    sites = np.array([3, 1, 1])
+    for node in 0, 1, 2, 3:
+        desired = create_indicator_array(
+                node, shape, nodes, axes, iid_observations)
+        assert_equal(encoding.create_array(node), desired)
+        assert_equal(encoding.create_array(node, sites), desired[:, sites])
+        arr = np.random.rand(6, 4)
+        assert_equal(encoding.apply(node, arr.copy()), arr * desired)
+
+    # The observable at index 3 is missing at every site,
+    # so it is dropped, and node 0 has no observations.
+    assert_equal(encoding.is_observed(0), False)
+    assert_equal(encoding.is_observed(3), True)
@@ -0,0 +1,154 @@
+"""
+Test processes defined as Kronecker sums of univariate axis processes.
+
+The paralog-like bivariate process has an independent univariate process
+acting on each axis, together with a gene conversion coupling
+that copies the state of one axis to the other.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+from itertools import product
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_unpacking_ex import UnpackingError, TopLevel
+
+
+def _get_axis_process(n):
+    row_states = []
+    column_states = []
+    for i, j in product(range(n), repeat=2):
+        if i != j:
+            row_states.append(i)
+            column_states.append(j)
+    rates = np.exp(np.random.randn(len(row_states)))
+    return dict(
+            row_states = row_states,
+            column_states = column_states,
+            transition_rates = rates.tolist())
+
+
+def _get_coupling(n, tau):
+    row_states = []
+    column_states = []
+    for i, j in product(range(n), repeat=2):
+        if i != j:
+            row_states.extend([[i, j], [i, j]])
+            column_states.extend([[i, i], [j, j]])
+    return dict(
+            row_states = row_states,
+            column_states = column_states,
+            transition_rates = [tau] * len(row_states))
+
+
+def _expand(axis_processes, coupling, n):
+    # Explicitly list the transitions of the Kronecker sum.
+    row_states = list(coupling['row_states'])
+    column_states = list(coupling['column_states'])
+    rates = list(coupling['transition_rates'])
+    for axis, a in enumerate(axis_processes):
+        triples = zip(a['row_states'], a['column_states'],
+                a['transition_rates'])
+        for i, j, rate in triples:
+            for k in range(n):
+                if axis == 0:
+                    row_states.append([i, k])
+                    column_states.append([j, k])
+                else:
+                    row_states.append([k, i])
+                    column_states.append([k, j])
+                rates.append(rate)
+    return dict(
+            row_states = row_states,
+            column_states = column_states,
+            transition_rates = rates)
+
+
+def _get_json_inputs(n):
+    np.random.seed(1234)
+    axis_processes = [_get_axis_process(n), _get_axis_process(n)]
+    coupling = _get_coupling(n, 0.5)
+    structured = dict(axis_processes=axis_processes)
+    structured.update(coupling)
+    explicit = _expand(axis_processes, coupling, n)
+    iid_observations = np.random.randint(0, n, size=(3, 4)).tolist()
+    scene = dict(
+            node_count = 3,
+            process_count = 1,
+            state_space_shape = [n, n],
+            root_prior = dict(
+                states = [[i, i] for i in range(n)],
+                probabilities = [1 / n] * n),
+            process_definitions = [structured],
+            tree = dict(
+                row_nodes = [0, 0],
+                column_nodes = [1, 2],
+                edge_rate_scaling_factors = [0.1, 0.2],
+                edge_processes = [0, 0]),
+            observed_data = dict(
+                nodes = [1, 1, 2, 2],
+                variables = [0, 1, 0, 1],
+                iid_observations = iid_observations))
+    requests = [
+            dict(property = 'dnnlogl'),
+            dict(property = 'ddnderi'),
+            dict(property = 'sndnode'),
+            dict(
+                property = 'sdntran',
+                transition_reduction = dict(
+                    row_states = [[0, 1], [1, 0]],
+                    column_states = [[0, 0], [1, 1]],
+                    weights = [1, 1]))]
+    j_structured = dict(scene=scene, requests=requests)
+    j_explicit = copy.deepcopy(j_structured)
+    j_explicit['scene']['process_definitions'] = [explicit]
+    return j_structured, j_explicit
+
+
+def test_kronecker_sum_matches_explicit_transitions():
+    # The smaller state space uses a dense matrix,
+    # and the larger state space uses the axis-wise linear operator.
+    for n in 4, 11:
+        j_structured, j_explicit = _get_json_inputs(n)
+        out_structured = process_json_in(j_structured)
+        out_explicit = process_json_in(j_explicit)
+        assert_equal(out_structured['status'], 'feasible')
+        assert_equal(out_explicit['status'], 'feasible')
+        for a, b in zip(
+                out_structured['responses'], out_explicit['responses']):
+            assert_allclose(a, b)
+
+
+def test_kronecker_sum_without_coupling():
+    j_structured, j_explicit = _get_json_inputs(3)
+    p = j_structured['scene']['process_definitions'][0]
+    for name in 'row_states', 'column_states', 'transition_rates':
+        del p[name]
+    toplevel = TopLevel(j_structured)
+    p = toplevel.scene.process_definitions[0]
+    assert_equal(p.coupling_row_states.shape, (0, 2))
+    assert_equal(p.row_states.shape, (2 * 6 * 3, 2))
+
+
+def test_kronecker_sum_bad_input():
+    j_structured, j_explicit = _get_json_inputs(3)
+
+    # The coupling must be either complete or absent.
+    j_in = copy.deepcopy(j_structured)
+    del j_in['scene']['process_definitions'][0]['transition_rates']
+    assert_raises(UnpackingError, TopLevel, j_in)
+
+    # There must be one axis process per component of the state space.
+    j_in = copy.deepcopy(j_structured)
+    j_in['scene']['process_definitions'][0]['axis_processes'].pop()
+    assert_raises(UnpackingError, TopLevel, j_in)
+
+    # Axis states must be in range.
+    j_in = copy.deepcopy(j_structured)
+    a = j_in['scene']['process_definitions'][0]['axis_processes'][0]
+    a['column_states'][0] = 3
+    assert_raises(UnpackingError, TopLevel, j_in)
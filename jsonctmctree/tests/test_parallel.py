@@ -0,0 +1,99 @@
+"""
+Test the thread-parallel propagation of column shards.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+import scipy.sparse
+from scipy.linalg import expm
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.pyexp.parallel import get_thread_count, get_column_shards
+from jsonctmctree.pyexp.ctmc_ops import (
+        RdOperator, BandedOperator, Propagator, get_multi_matmat)
+
+
+def _sample_rates(n, bandwidth=None):
+    R = scipy.sparse.random(n, n, density=0.1, format='csr') * 5
+    R = R - scipy.sparse.diags(R.diagonal())
+    if bandwidth is not None:
+        R = scipy.sparse.triu(scipy.sparse.tril(R, bandwidth), -bandwidth)
+    return scipy.sparse.csr_matrix(R)
+
+
+def test_get_column_shards():
+    assert_equal(get_column_shards(10, 4), [(0, 4), (4, 8), (8, 10)])
+    assert_equal(get_column_shards(10, 256, 3), [(0, 4), (4, 8), (8, 10)])
+    assert_equal(get_column_shards(10, 2, 3),
+            [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)])
+    assert_equal(get_column_shards(2, 256, 4), [(0, 1), (1, 2)])
+    assert_equal(get_column_shards(0, 256, 4), [])
+
+
+def test_get_thread_count():
+    assert_equal(get_thread_count(3), 3)
+    assert_raises(ValueError, get_thread_count, 0)
+
+
+def test_threaded_propagator():
+    # The shards are propagated by separate threads,
+    # and the results are reproducible.
+    np.random.seed(1234)
+    n = 60
+    R = _sample_rates(n, bandwidth=3)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    d = -exit_rates
+    mu = np.mean(d)
+    B = np.random.rand(n, 37)
+    for op in RdOperator(R, d - mu), BandedOperator(R, d - mu):
+        P = Propagator(op, mu, nthreads=4)
+        for t in 0.1, 2.0:
+            actual = P._parameterized_matmat(t, B)
+            assert_allclose(actual, expm(Q * t).dot(B), atol=1e-12)
+            assert_equal(P._parameterized_matmat(t, B), actual)
+            actual = P._parameterized_adjoint_matmat(t, B)
+            assert_allclose(actual, expm(Q.T * t).dot(B), atol=1e-12)
+            assert_equal(P._parameterized_adjoint_matmat(t, B), actual)
+        ts = [0.1, 2.0]
+        for t, actual in zip(ts, get_multi_matmat(P, ts, B)):
+            assert_allclose(actual, expm(Q * t).dot(B), atol=1e-12)
+
+
+def test_threaded_likelihoods():
+    np.random.seed(1234)
+    n = 120
+    R = _sample_rates(n)
+    row, col = R.nonzero()
+    scene = dict(
+            node_count = 3,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = [1 / n] * n),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = R[row, col].A.ravel().tolist(),
+                expm_backend = 'abstract')],
+            tree = dict(
+                row_nodes = [0, 0],
+                column_nodes = [1, 2],
+                edge_rate_scaling_factors = [0.1, 0.2],
+                edge_processes = [0, 0]),
+            observed_data = dict(
+                nodes = [1, 2],
+                variables = [0, 0],
+                iid_observations = np.random.randint(
+                    0, n, size=(20, 2)).tolist()))
+    j_in = dict(scene=scene, requests=[
+        dict(property='dnnlogl'), dict(property='ddnderi')])
+    desired = process_json_in(j_in)
+    actual = process_json_in(j_in, nthreads=3)
+    assert_equal(actual['status'], 'feasible')
+    for a, b in zip(actual['responses'], desired['responses']):
+        assert_allclose(a, b)
@@ -3,7 +3,8 @@
 from __future__ import division, print_function, absolute_import
 
 import numpy as np
-from numpy.testing import assert_equal, assert_array_less, assert_allclose
+from numpy.testing import (
+        assert_equal, assert_array_less, assert_allclose, assert_raises)
 
 import scipy.sparse
 from scipy.linalg import expm
@@ -11,8 +12,16 @@ from scipy.linalg import expm
 import jsonctmctree
 from jsonctmctree.pyexp.basic_ops import PowerOperator, ExtendedMatrixOperator
 from jsonctmctree.pyexp.ctmc_ops import (
-        RdOperator, RdcOperator, RdCOperator,
-        Propagator, SmarterPropagator, MatrixExponential)
+        RdOperator, RdcOperator, RdCOperator, KroneckerSumOperator,
+        Propagator, SmarterPropagator, SpectralPropagator, ReversiblePropagator,
+        BlockTriangularPropagator, UniformizationPropagator, KrylovPropagator,
+        ChebyshevPropagator, MatrixExponential, BandedOperator,
+        PermutedPropagator, TridiagonalPropagator, get_bandwidth,
+        get_banded_ordering)
+from jsonctmctree.pyexp.linear_system import LinearSystem
+from jsonctmctree.testutil import (
+        sample_time_reversible_rate_matrix,
+        sample_time_nonreversible_rate_matrix)
 
 
 def get_random_rate_matrix(n):
@@ -75,6 +84,100 @@ def test_RdOperator():
     check_operator_equivalence(L, M)
 
 
+def test_RdOperator_dot_into():
+    # The rates are given as a coo matrix with duplicate entries,
+    # which are summed when the operator is compiled.
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n).tocoo()
+    R = scipy.sparse.coo_matrix(
+            (np.concatenate([R.data, R.data]),
+                (np.concatenate([R.row, R.row]),
+                    np.concatenate([R.col, R.col]))),
+            shape=R.shape)
+    d = np.random.randn(n)
+    M = R.A + np.diag(d)
+    L = RdOperator(R, d)
+    assert_allclose(L.todense(), M)
+    B = np.random.randn(n, 3)
+    for f, g in (L, M), (L.T, M.T), (L.H, M.T):
+        out = np.empty_like(B)
+        f.dot_into(B, out)
+        assert_allclose(out, g.dot(B))
+        # Non-contiguous inputs use the fallback product.
+        out = np.empty_like(B)
+        f.dot_into(np.asfortranarray(B), out)
+        assert_allclose(out, g.dot(B))
+        # 1d inputs are supported by the ordinary product.
+        assert_allclose(f.dot(B[:, 0]), g.dot(B[:, 0]))
+
+
+def test_Propagator_preserves_input():
+    np.random.seed(1234)
+    n = 6
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    mu = -np.mean(exit_rates)
+    P = Propagator(RdOperator(R, -exit_rates - mu), mu)
+    Q = R.A - np.diag(exit_rates)
+    B = np.random.randn(n, 4)
+    B_copy = B.copy()
+    for t in 0.1, 10.0:
+        assert_allclose(P._parameterized_matmat(t, B), expm(Q * t).dot(B))
+        assert_allclose(
+                P._parameterized_adjoint_matmat(t, B), expm(Q.T * t).dot(B))
+        assert_equal(B, B_copy)
+
+
+def test_Propagator_column_blocks():
+    # The result does not depend on the width of the column blocks,
+    # including a final block that is narrower than the others.
+    np.random.seed(1234)
+    n = 6
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    mu = -np.mean(exit_rates)
+    Q = R.A - np.diag(exit_rates)
+    B = np.random.randn(n, 7)
+    B[:, 2] = 0
+    B[:, 3] = 1
+    for block_width in 1, 3, 7, 100:
+        P = Propagator(RdOperator(R, -exit_rates - mu), mu, block_width)
+        for t in 0.1, 10.0:
+            assert_allclose(
+                    P._parameterized_matmat(t, B), expm(Q * t).dot(B),
+                    atol=1e-12)
+            assert_allclose(
+                    P._parameterized_adjoint_matmat(t, B),
+                    expm(Q.T * t).dot(B),
+                    atol=1e-12)
+    P = Propagator(RdOperator(R, -exit_rates), 0, 0)
+    assert_raises(ValueError, P._parameterized_matmat, 1.0, B)
+
+
+def test_KroneckerSumOperator():
+    # This is an n x n square operator with n = 2 * 3 * 4.
+    np.random.seed(1234)
+    axis_matrices = [get_random_rate_matrix(k).A for k in (2, 3, 4)]
+    n = 2 * 3 * 4
+    C = get_random_rate_matrix(n)
+    d = np.random.randn(n)
+
+    # Define the dense numpy ndarray.
+    M = C.A + np.diag(d)
+    M += np.kron(axis_matrices[0], np.identity(12))
+    M += np.kron(np.kron(np.identity(2), axis_matrices[1]), np.identity(4))
+    M += np.kron(np.identity(6), axis_matrices[2])
+
+    # Define the linear operator.
+    L = KroneckerSumOperator(axis_matrices, C, d)
+    assert_allclose(L.todense(), M)
+    assert_allclose(L.tosparse().A, M)
+
+    # Test properties of the operator, its transpose, and its adjoint.
+    check_operator_equivalence(L, M)
+
+
 def test_RdcOperator():
     # This is a 2n x 2n square operator.
     np.random.seed(1234)
@@ -216,3 +319,312 @@ def test_SmarterPropagator():
             desired = expm(Q * t).dot(B)
             actual = L.dot(B)
             assert_allclose(actual, desired)
+
+
+def test_SpectralPropagator():
+    np.random.seed(1234)
+    n = 4
+
+    # Compare to the brute force calculation across several scaling factors.
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    P = SpectralPropagator(Q)
+    for t in 0.42, 4.2, 42.0:
+        L = MatrixExponential(P, t)
+        for n0 in 2, 10:
+            B = np.random.randn(n, n0)
+            assert_allclose(L.dot(B), expm(Q * t).dot(B))
+            assert_allclose(L.T.dot(B), expm(Q * t).T.dot(B))
+
+
+def test_SpectralPropagator_defective():
+    # This rate matrix is not diagonalizable,
+    # so the propagator should fall back to the Pade approximation.
+    Q = np.array([
+        [-1, 1, 0],
+        [0, -1, 1],
+        [0, 0, 0]], dtype=float)
+    P = SpectralPropagator(Q)
+    assert_equal(P.factored, False)
+    B = np.identity(3)
+    for t in 0.42, 4.2, 42.0:
+        L = MatrixExponential(P, t)
+        assert_allclose(L.dot(B), expm(Q * t))
+
+
+def _get_reducible_rate_matrix():
+    # Two transient classes feed into two absorbing classes.
+    # The classes are listed in an order that is not topological,
+    # and the two transient classes have equal spectra.
+    np.random.seed(1234)
+    sizes = [3, 4, 3, 3]
+    offsets = np.cumsum([0] + sizes)
+    n = offsets[-1]
+    R = np.zeros((n, n))
+    def block(k):
+        return slice(offsets[k], offsets[k+1])
+    for k in range(4):
+        R[block(k), block(k)] = np.exp(np.random.randn(sizes[k], sizes[k]))
+    R[block(2), block(2)] = R[block(3), block(3)]
+    R[block(2), block(0)] = np.exp(np.random.randn(3, 3))
+    R[block(3), block(1)] = np.exp(np.random.randn(3, 4))
+    R[block(2), block(3)] = np.exp(np.random.randn(3, 3))
+    R[block(0), block(1)] = np.exp(np.random.randn(3, 4))
+    np.fill_diagonal(R, 0)
+    return scipy.sparse.csr_matrix(R)
+
+
+def test_BlockTriangularPropagator():
+    R = _get_reducible_rate_matrix()
+    n = R.shape[0]
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    P = BlockTriangularPropagator(R, exit_rates)
+    assert_array_less(P.max_block_size, n)
+    B = np.identity(n)
+    for t in 0, 0.42, 4.2, 42.0:
+        L = MatrixExponential(P, t)
+        assert_allclose(L.dot(B), expm(Q * t), atol=1e-12)
+        assert_allclose(L.T.dot(B), expm(Q * t).T, atol=1e-12)
+
+
+def test_LinearSystem_block_style():
+    R = _get_reducible_rate_matrix()
+    n = R.shape[0]
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    L = LinearSystem(R, style='block')
+    B = np.random.randn(n, 3)
+    assert_allclose(L.instantaneous_operator.dot(B), Q.dot(B))
+    for t in 0.42, 4.2:
+        actual = L.propagator._parameterized_matmat(t, B)
+        assert_allclose(actual, expm(Q * t).dot(B))
+
+
+def test_UniformizationPropagator():
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    P = UniformizationPropagator(RdOperator(R, -exit_rates), exit_rates.max())
+    B = np.random.randn(n, 3)
+    ts = [42.0, 0, 0.42, 4.2, 0.42]
+    desired = [expm(Q * t).dot(B) for t in ts]
+    adjoint_desired = [expm(Q * t).T.dot(B) for t in ts]
+
+    # Check the single and multiple scaling factor interfaces.
+    for t, d, ad in zip(ts, desired, adjoint_desired):
+        L = MatrixExponential(P, t)
+        assert_allclose(L.dot(B), d)
+        assert_allclose(L.T.dot(B), ad)
+    for actual, d in zip(P._parameterized_multi_matmat(ts, B), desired):
+        assert_allclose(actual, d)
+    actuals = P._parameterized_adjoint_multi_matmat(ts, B)
+    for actual, ad in zip(actuals, adjoint_desired):
+        assert_allclose(actual, ad)
+
+
+def test_LinearSystem_uniformization_style():
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    L = LinearSystem(R, style='uniformization')
+    B = np.random.randn(n, 2)
+    actual = L.propagator._parameterized_matmat(4.2, B)
+    assert_allclose(actual, expm(Q * 4.2).dot(B))
+
+
+def test_KrylovPropagator():
+    np.random.seed(1234)
+    n = 40
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+
+    # Use subspaces smaller than the state space to force restarts.
+    # The error estimate is conservative after a happy breakdown,
+    # which occurs as the propagated vectors become constant.
+    P = KrylovPropagator(RdOperator(R, -exit_rates), m=10)
+    B = np.random.randn(n, 3)
+    for t in 0, 0.042, 0.42, 4.2:
+        L = MatrixExponential(P, t)
+        assert_allclose(L.dot(B), expm(Q * t).dot(B), atol=1e-10)
+        assert_array_less(P.error_estimate, 1e-6)
+        assert_allclose(L.T.dot(B), expm(Q * t).T.dot(B), atol=1e-10)
+
+
+def test_LinearSystem_krylov_style():
+    # A small state space produces a happy breakdown of the subspace.
+    np.random.seed(1234)
+    n = 5
+    R = get_random_rate_matrix(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    L = LinearSystem(R, style='krylov')
+    B = np.random.randn(n, 2)
+    actual = L.propagator._parameterized_matmat(4.2, B)
+    assert_allclose(actual, expm(Q * 4.2).dot(B))
+
+
+def test_ReversiblePropagator():
+    np.random.seed(1234)
+    n = 5
+    Q, d = sample_time_reversible_rate_matrix(n)
+    B = np.identity(n)
+
+    # Supply the stationary distribution, a wrong candidate, or nothing.
+    for distn in d, np.ones(n) / n, None:
+        P = ReversiblePropagator(Q, distn)
+        assert_equal(P.reversible, True)
+        assert_allclose(P.stationary_distn, d)
+        for t in 0.42, 4.2, 42.0:
+            L = MatrixExponential(P, t)
+            assert_allclose(L.dot(B), expm(Q * t), atol=1e-12)
+            assert_allclose(L.T.dot(B), expm(Q * t).T, atol=1e-12)
+
+
+def test_ReversiblePropagator_nonreversible():
+    np.random.seed(1234)
+    n = 5
+    Q, d = sample_time_nonreversible_rate_matrix(n)
+    P = ReversiblePropagator(Q, d)
+    assert_equal(P.reversible, False)
+    for t in 0.42, 4.2, 42.0:
+        assert_allclose(P._parameterized_expm(t), expm(Q * t))
+
+
+def test_ChebyshevPropagator():
+    np.random.seed(1234)
+    n = 5
+    Q, d = sample_time_reversible_rate_matrix(n)
+    exit_rates = -np.diag(Q)
+    R = scipy.sparse.csr_matrix(Q + np.diag(exit_rates))
+    P = ChebyshevPropagator(RdOperator(R, -exit_rates), exit_rates.max())
+    B = np.random.randn(n, 3)
+    for t in 0, 0.042, 0.42, 4.2, 42.0:
+        L = MatrixExponential(P, t)
+        assert_allclose(L.dot(B), expm(Q * t).dot(B), atol=1e-12)
+        assert_allclose(L.T.dot(B), expm(Q * t).T.dot(B), atol=1e-12)
+
+
+def test_LinearSystem_chebyshev_style():
+    # The auto style should choose the chebyshev style
+    # for a large reversible process when its distribution is provided.
+    np.random.seed(1234)
+    n = 120
+    Q, d = sample_time_reversible_rate_matrix(n)
+    R = scipy.sparse.csr_matrix(Q - np.diag(np.diag(Q)))
+    L = LinearSystem(R, stationary_distn=d)
+    assert_equal(isinstance(L.propagator, ChebyshevPropagator), True)
+    B = np.random.randn(n, 2)
+    actual = L.propagator._parameterized_matmat(0.42, B)
+    assert_allclose(actual, expm(Q * 0.42).dot(B))
+
+    # Without a distribution the default abstract style is used.
+    L = LinearSystem(R)
+    assert_equal(isinstance(L.propagator, Propagator), True)
+    assert_raises(ValueError, LinearSystem, R, 'chebyshev')
+
+
+def _get_birth_death_rate_matrix(n, perm=None):
+    # The states of a birth-death process are optionally shuffled.
+    births = np.exp(np.random.randn(n - 1))
+    deaths = np.exp(np.random.randn(n - 1))
+    row = np.concatenate([np.arange(n - 1), np.arange(1, n)])
+    col = np.concatenate([np.arange(1, n), np.arange(n - 1)])
+    data = np.concatenate([births, deaths])
+    if perm is not None:
+        inv = np.argsort(perm)
+        row, col = inv[row], inv[col]
+    return scipy.sparse.csr_matrix((data, (row, col)), shape=(n, n))
+
+
+def _get_queue_rate_matrix(n, k):
+    # Arrivals in batches of up to k customers and single departures.
+    row = []
+    col = []
+    for i in range(n):
+        for j in range(max(i - 1, 0), min(i + k, n - 1) + 1):
+            if i != j:
+                row.append(i)
+                col.append(j)
+    data = np.exp(np.random.randn(len(row)))
+    return scipy.sparse.csr_matrix((data, (row, col)), shape=(n, n))
+
+
+def test_BandedOperator():
+    np.random.seed(1234)
+    n = 7
+    R = _get_queue_rate_matrix(n, 2)
+    d = np.random.randn(n)
+    M = R.A + np.diag(d)
+    L = BandedOperator(R, d)
+    assert_equal(L.bandwidth, 2)
+    assert_allclose(L.todense(), M)
+    check_operator_equivalence(L, M)
+    B = np.random.randn(n, 3)
+    for f, g in (L, M), (L.T, M.T):
+        out = np.empty_like(B)
+        f.dot_into(B, out)
+        assert_allclose(out, g.dot(B))
+
+
+def test_get_banded_ordering():
+    np.random.seed(1234)
+    n = 30
+    perm = np.random.permutation(n)
+    R = _get_birth_death_rate_matrix(n, perm)
+    assert_equal(get_bandwidth(R) > 1, True)
+    p, bandwidth = get_banded_ordering(R)
+    assert_equal(bandwidth, 1)
+    assert_equal(get_bandwidth(R[p][:, p]), 1)
+
+
+def test_TridiagonalPropagator():
+    np.random.seed(1234)
+    n = 30
+    for perm in None, np.random.permutation(n):
+        R = _get_birth_death_rate_matrix(n, perm)
+        exit_rates = R.sum(axis=1).A.ravel()
+        Q = R.A - np.diag(exit_rates)
+        p, bandwidth = get_banded_ordering(R)
+        P = TridiagonalPropagator(R, -exit_rates, p)
+        B = np.random.randn(n, 3)
+        for t in 0, 0.42, 4.2, 42.0:
+            assert_allclose(P._parameterized_expm(t), expm(Q * t), atol=1e-12)
+            L = MatrixExponential(P, t)
+            assert_allclose(L.dot(B), expm(Q * t).dot(B), atol=1e-12)
+            assert_allclose(L.T.dot(B), expm(Q * t).T.dot(B), atol=1e-12)
+        assert_allclose(P.stationary_distn.dot(Q), 0, atol=1e-12)
+
+    # Rate matrices that are not birth-death processes are rejected.
+    R = _get_queue_rate_matrix(n, 2)
+    exit_rates = R.sum(axis=1).A.ravel()
+    assert_raises(ValueError, TridiagonalPropagator, R, -exit_rates)
+
+
+def test_LinearSystem_banded_styles():
+    # The auto style should recognize birth-death processes
+    # and other processes with narrow bands after reordering.
+    np.random.seed(1234)
+    n = 150
+    perm = np.random.permutation(n)
+    B = np.random.randn(n, 2)
+    for R, propagator_type in (
+            (_get_birth_death_rate_matrix(n, perm), TridiagonalPropagator),
+            (_get_queue_rate_matrix(n, 3)[perm][:, perm], PermutedPropagator)):
+        exit_rates = R.sum(axis=1).A.ravel()
+        Q = R.A - np.diag(exit_rates)
+        desired = expm(Q * 0.42).dot(B)
+        L = LinearSystem(R)
+        assert_equal(isinstance(L.propagator, propagator_type), True)
+        assert_allclose(L.propagator._parameterized_matmat(0.42, B), desired)
+        L = LinearSystem(R, style='banded')
+        assert_allclose(L.propagator._parameterized_matmat(0.42, B), desired)
+        actual = L.propagator._parameterized_adjoint_matmat(0.42, B)
+        assert_allclose(actual, expm(Q * 0.42).T.dot(B))
+    assert_raises(ValueError, LinearSystem, R, 'tridiagonal')
@@ -0,0 +1,114 @@
+"""
+Test the rescaling of the arrays of the tree passes on a large tree.
+
+Without rescaling, the likelihoods of the sites of a star tree
+with hundreds of observed tips underflow to zero.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+from scipy.linalg import expm
+from scipy.special import logsumexp
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_likelihood import rescale_columns
+
+
+def _get_star_scene(n, ntips, edge_rates, iid_observations):
+    np.random.seed(1234)
+    R = np.exp(np.random.randn(n, n))
+    np.fill_diagonal(R, 0)
+    row, col = np.nonzero(R)
+    prior = np.random.dirichlet(np.ones(n))
+    scene = dict(
+            node_count = ntips + 1,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = prior.tolist()),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = R[row, col].tolist())],
+            tree = dict(
+                row_nodes = [0] * ntips,
+                column_nodes = list(range(1, ntips + 1)),
+                edge_rate_scaling_factors = list(edge_rates),
+                edge_processes = [0] * ntips),
+            observed_data = dict(
+                nodes = list(range(1, ntips + 1)),
+                variables = [0] * ntips,
+                iid_observations = iid_observations.tolist()))
+    Q = R - np.diag(R.sum(axis=1))
+    return scene, Q, prior
+
+
+def test_rescale_columns():
+    arr = np.array([[1e-300, 0, -4], [2e-300, 0, 2]])
+    log_scale = rescale_columns(arr)
+    assert_allclose(arr, [[0.5, 0, -1], [1, 0, 0.5]])
+    assert_allclose(log_scale, [np.log(2e-300), 0, np.log(4)])
+
+
+def test_star_tree_underflow():
+    n = 50
+    ntips = 200
+    np.random.seed(1234)
+    edge_rates = np.random.uniform(0.2, 1, size=ntips)
+    iid_observations = np.random.randint(0, n, size=(3, ntips))
+    scene, Q, prior = _get_star_scene(
+            n, ntips, edge_rates, iid_observations)
+
+    # Compute the log likelihoods and the root distributions directly.
+    log_P = [np.log(expm(Q * t)) for t in edge_rates]
+    log_joint = np.log(prior) + np.array([
+        sum(lp[:, obs] for lp, obs in zip(log_P, site))
+        for site in iid_observations])
+    desired_logl = logsumexp(log_joint, axis=1)
+    desired_root = np.exp(log_joint - desired_logl[:, np.newaxis])
+    assert_equal(np.any(np.exp(desired_logl) > 0), False)
+
+    j_in = dict(scene=scene, requests=[
+        dict(property='dnnlogl'),
+        dict(property='dndnode'),
+        dict(property='ddnderi'),
+        dict(property='ddngrad')])
+    j_out = process_json_in(j_in)
+    assert_equal(j_out['status'], 'feasible')
+    logl, node, deri, grad = [np.array(x) for x in j_out['responses']]
+    assert_allclose(logl, desired_logl)
+    assert_allclose(node[:, :, 0], desired_root)
+
+    # The derivatives with respect to the logarithms of the edge rates
+    # are compared to finite differences for a few edges.
+    eps = 1e-6
+    for edge in 0, 199:
+        rates = edge_rates.copy()
+        rates[edge] *= np.exp(eps)
+        perturbed, Q, prior = _get_star_scene(
+                n, ntips, rates, iid_observations)
+        j_out = process_json_in(dict(scene=perturbed, requests=[
+            dict(property='dnnlogl')]))
+        desired = (np.array(j_out['responses'][0]) - logl) / eps
+        assert_allclose(deri[:, edge], desired, atol=1e-6)
+        assert_allclose(grad[:, edge], desired, atol=1e-6)
+
+
+def test_star_tree_ancestral_states():
+    # The tips are fully observed, so their sampled states are known.
+    n = 50
+    ntips = 200
+    np.random.seed(1234)
+    edge_rates = np.random.uniform(0.2, 1, size=ntips)
+    iid_observations = np.random.randint(0, n, size=(3, ntips))
+    scene, Q, prior = _get_star_scene(
+            n, ntips, edge_rates, iid_observations)
+    j_in = dict(scene=scene, requests=[dict(property='ddnance')])
+    j_out = process_json_in(j_in, seed=1234)
+    assert_equal(j_out['status'], 'feasible')
+    states = np.array(j_out['responses'][0])
+    assert_equal(states[:, 1:], iid_observations)
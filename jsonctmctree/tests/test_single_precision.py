@@ -0,0 +1,100 @@
+"""
+Test the single precision mode.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+from itertools import product
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+import scipy.sparse
+from scipy.linalg import expm
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_likelihood import create_indicator_array
+from jsonctmctree.pyexp.ctmc_ops import RdOperator, Propagator
+
+
+def _get_json_input(n):
+    np.random.seed(1234)
+    pairs = [(i, j) for i, j in product(range(n), repeat=2)
+            if i != j and np.random.rand() < 20 / n]
+    row, col = zip(*pairs)
+    rates = np.exp(np.random.randn(len(pairs)))
+    scene = dict(
+            node_count = 4,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = [1 / n] * n),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = rates.tolist())],
+            tree = dict(
+                row_nodes = [0, 0, 2],
+                column_nodes = [1, 2, 3],
+                edge_rate_scaling_factors = [0.1, 0.2, 0.3],
+                edge_processes = [0, 0, 0]),
+            observed_data = dict(
+                nodes = [1, 3],
+                variables = [0, 0],
+                iid_observations = np.random.randint(
+                    -1, n, size=(5, 2)).tolist()))
+    requests = [
+            dict(property = 'snnlogl'),
+            dict(property = 'dnnlogl'),
+            dict(property = 'ddnderi')]
+    return dict(scene=scene, requests=requests)
+
+
+def test_single_precision_propagator():
+    np.random.seed(1234)
+    n = 30
+    R = scipy.sparse.random(n, n, density=0.2, format='csr')
+    R.setdiag(0)
+    R.eliminate_zeros()
+    exit_rates = R.sum(axis=1).A.ravel()
+    d = -exit_rates
+    mu = np.mean(d)
+    op = RdOperator(R.astype(np.float32), (d - mu).astype(np.float32))
+    assert_equal(op.dtype, np.float32)
+    P = Propagator(op, mu)
+    Q = R.A - np.diag(exit_rates)
+    B = np.random.rand(n, 4).astype(np.float32)
+    for t in 0.1, 1.0, 10.0:
+        actual = P._parameterized_matmat(t, B)
+        assert_equal(actual.dtype, np.float32)
+        assert_allclose(actual, expm(Q * t).dot(B), rtol=1e-4, atol=1e-6)
+
+
+def test_single_precision_indicator_array():
+    state_space_shape = (2, 3)
+    observable_nodes = np.array([0, 0])
+    observable_axes = np.array([0, 1])
+    iid_observations = np.array([[0, 1], [-1, 2]])
+    for dtype in np.float32, np.float64:
+        obs = create_indicator_array(0, state_space_shape,
+                observable_nodes, observable_axes, iid_observations, dtype)
+        assert_equal(obs.dtype, dtype)
+        assert_equal(obs.sum(axis=0), [1, 2])
+
+
+def test_single_precision_log_likelihoods():
+    # The smaller state space uses explicit transition matrices,
+    # and the larger state space uses the abstract operator.
+    for n in 4, 120:
+        j_in = _get_json_input(n)
+        desired = process_json_in(j_in)
+        actual = process_json_in(j_in, precision='single')
+        assert_equal(actual['status'], 'feasible')
+        for a, b in zip(actual['responses'], desired['responses']):
+            assert_allclose(a, b, rtol=1e-4)
+
+
+def test_unrecognized_precision():
+    j_in = _get_json_input(4)
+    assert_raises(ValueError, process_json_in, j_in, precision='half')
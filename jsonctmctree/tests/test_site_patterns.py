@@ -0,0 +1,163 @@
+"""
+Test the compression of iid sites with identical observations.
+
+The naive implementation does not compress the sites,
+so its responses are compared to the responses computed
+on the distinct site patterns.
+Within the pruning passes, the columns of the array of each subtree
+are further compressed according to the observations in the subtree.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+from scipy.linalg import expm
+
+from jsonctmctree import impl_naive, impl_v2
+from jsonctmctree.common_likelihood import (
+        get_site_patterns, create_indicator_array,
+        get_subtree_likelihoods, get_conditional_likelihoods)
+from jsonctmctree.common_unpacking_ex import (
+        gen_valid_extended_properties, TopLevel, interpret_tree)
+from jsonctmctree.expm_helpers import PadeExpm, create_dense_rate_matrix
+
+
+def _get_scene():
+    # Most of the sites repeat one of a few patterns,
+    # including a pattern with missing observations.
+    a = 0.2
+    b = 0.3
+    patterns = [
+            [0, 0, 0, 0],
+            [1, 1, 0, 1],
+            [0, -1, 1, 1],
+            [1, 0, 1, 1]]
+    site_to_pattern = [2, 0, 0, 1, 2, 3, 0, 2, 1]
+    return dict(
+            node_count = 4,
+            process_count = 1,
+            state_space_shape = [2, 2],
+            tree = dict(
+                row_nodes = [0, 0, 2],
+                column_nodes = [1, 2, 3],
+                edge_rate_scaling_factors = [1.0, 2.0, 0.5],
+                edge_processes = [0, 0, 0]),
+            root_prior = dict(
+                states = [[0, 0], [0, 1], [1, 0], [1, 1]],
+                probabilities = [0.25, 0.25, 0.4, 0.1]),
+            process_definitions = [dict(
+                row_states = [
+                    [0, 0], [0, 0], [0, 1], [0, 1],
+                    [1, 0], [1, 0], [1, 1], [1, 1]],
+                column_states = [
+                    [0, 1], [1, 0], [0, 0], [1, 1],
+                    [0, 0], [1, 1], [0, 1], [1, 0]],
+                transition_rates = [a, a, a, b, b, a, b, b])],
+            observed_data = dict(
+                nodes = [1, 1, 3, 3],
+                variables = [0, 1, 0, 1],
+                iid_observations = [patterns[i] for i in site_to_pattern]))
+
+
+def test_get_site_patterns():
+    iid_observations = np.array(_get_scene()['observed_data'][
+        'iid_observations'])
+    patterns, site_to_pattern, pattern_counts = get_site_patterns(
+            iid_observations)
+    assert_equal(patterns.shape, (4, 4))
+    assert_equal(patterns[site_to_pattern], iid_observations)
+    assert_equal(sorted(pattern_counts), [1, 2, 3, 3])
+    assert_equal(pattern_counts, np.bincount(site_to_pattern))
+
+    # Without observables, every site has the same pattern.
+    patterns, site_to_pattern, pattern_counts = get_site_patterns(
+            np.zeros((3, 0), dtype=int))
+    assert_equal(patterns.shape, (1, 0))
+    assert_equal(site_to_pattern, [0, 0, 0])
+    assert_equal(pattern_counts, [3])
+
+
+def test_compressed_sites_vs_naive():
+    scene = _get_scene()
+    reductions = dict(
+            observation_reduction = dict(
+                observation_indices = [0, 1, 2, 4, 3, 2, 8],
+                weights = [0.1, 0.1, 0.2, 0.3, 0.5, 0.8, 1.5]),
+            edge_reduction = dict(
+                edges = [0, 2, 1],
+                weights = [0.4, 0.5, 2.0]),
+            state_reduction = dict(
+                states = [[0, 0], [0, 1], [1, 0]],
+                weights = [3, 1, 2]))
+    transition_reduction = dict(
+            row_states = [[0, 0], [0, 1], [1, 0]],
+            column_states = [[1, 0], [1, 1], [0, 0]],
+            weights = [1, 2, 3])
+    names = ('observation_reduction', 'edge_reduction', 'state_reduction')
+    for extended_property in gen_valid_extended_properties():
+        request = dict(property=extended_property)
+        for code, name in zip(extended_property[:3], names):
+            if code == 'w':
+                request[name] = reductions[name]
+        if extended_property[-4:] == 'tran':
+            request['transition_reduction'] = transition_reduction
+        j_in = dict(scene=scene, requests=[request])
+        desired = impl_naive.process_json_in(j_in)
+        actual = impl_v2.process_json_in(j_in)
+        assert_equal(actual['status'], 'feasible')
+        assert_allclose(actual['responses'][0], desired['responses'][0])
+
+
+class _ColumnCountingExpm(object):
+    # Record the number of columns of each matrix exponential product.
+    def __init__(self, obj):
+        self.obj = obj
+        self.ncols = []
+
+    def expm_mul(self, rate_scaling_factor, A):
+        self.ncols.append(A.shape[1])
+        return self.obj.expm_mul(rate_scaling_factor, A)
+
+
+def test_subtree_columns():
+    # Each product acts only on the distinct columns of its subtree.
+    scene = TopLevel(dict(scene=_get_scene(), requests=[])).scene
+    p = scene.process_definitions[0]
+    shape = scene.state_space_shape
+    obs = scene.observed_data
+    common = interpret_tree(scene) + (shape, obs.nodes, obs.variables,
+            obs.iid_observations)
+    nstates = np.prod(shape)
+    P = dict((edge, expm(rate * create_dense_rate_matrix(
+        shape, p.row_states, p.column_states, p.transition_rates)))
+        for edge, rate in common[3])
+    for f in get_subtree_likelihoods, get_conditional_likelihoods:
+        obj = _ColumnCountingExpm(PadeExpm(
+            shape, p.row_states, p.column_states, p.transition_rates))
+        node_to_array = f([obj], True, *common)
+
+        # The nine sites have four distinct patterns,
+        # but only three distinct observations at tip 3,
+        # which is the only tip in the subtree of node 2.
+        assert_equal(sorted(obj.ncols), [3, 3, 4])
+
+        # Compare to a computation with one column per site.
+        def indicator(node):
+            return create_indicator_array(node, shape,
+                    obs.nodes, obs.variables, obs.iid_observations)
+        tip_1, tip_3 = indicator(1), indicator(3)
+        desired = {
+                1 : tip_1,
+                3 : tip_3,
+                2 : indicator(2) * P[2, 3].dot(tip_3)}
+        desired[0] = indicator(0) * P[0, 1].dot(tip_1) * P[0, 2].dot(
+                desired[2])
+        if f is get_conditional_likelihoods:
+            for node in 1, 2, 3:
+                edge = [e for e in common[2] if e[1] == node][0]
+                desired[node] = P[edge].dot(desired[node])
+        for node, arr in node_to_array.items():
+            assert_equal(arr.shape, (nstates, obs.iid_observations.shape[0]))
+            assert_allclose(arr, desired[node])
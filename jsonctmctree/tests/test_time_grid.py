@@ -0,0 +1,153 @@
+"""
+Test state distributions at a grid of time points along edges.
+
+The distributions at interior points of an edge are compared to the
+distributions at degree-2 nodes inserted at the same points.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+
+import scipy.sparse
+from scipy.linalg import expm
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_unpacking_ex import UnpackingError, TopLevel
+from jsonctmctree.pyexp._expm_multiply import (
+        expm_multiply, _expm_multiply_interval)
+from jsonctmctree.pyexp.ctmc_ops import (
+        RdOperator, Propagator, get_multi_matmat, get_adjoint_multi_matmat)
+
+
+def _get_scene(n, edge_rates, split=None):
+    # A root with two children, where the first edge may be split
+    # at a proportion of its length by an inserted degree-2 node.
+    np.random.seed(1234)
+    R = np.exp(np.random.randn(n, n))
+    np.fill_diagonal(R, 0)
+    row, col = np.nonzero(R)
+    iid_observations = np.random.randint(0, n, size=(3, 2)).tolist()
+    a, b = edge_rates
+    tree = dict(
+            row_nodes = [0, 0],
+            column_nodes = [1, 2],
+            edge_rate_scaling_factors = [a, b],
+            edge_processes = [0, 0])
+    node_count = 3
+    if split is not None:
+        tree = dict(
+                row_nodes = [0, 0, 3],
+                column_nodes = [3, 2, 1],
+                edge_rate_scaling_factors = [a * split, b, a * (1 - split)],
+                edge_processes = [0, 0, 0])
+        node_count = 4
+    return dict(
+            node_count = node_count,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[i] for i in range(n)],
+                probabilities = [1 / n] * n),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = R[row, col].tolist())],
+            tree = tree,
+            observed_data = dict(
+                nodes = [1, 2],
+                variables = [0, 0],
+                iid_observations = iid_observations))
+
+
+def test_grid_matches_inserted_nodes():
+    n = 5
+    edge_rates = (0.7, 0.2)
+    time_grid = [0, 0.3, 0.65, 1]
+    scene = _get_scene(n, edge_rates)
+    j_in = dict(scene=scene, requests=[
+        dict(property='dddgrid', time_grid=time_grid),
+        dict(property='dndnode')])
+    for backend in None, 'pade', 'abstract', 'uniformization':
+        j_out = process_json_in(j_in, expm_backend=backend)
+        assert_equal(j_out['status'], 'feasible')
+        grid, node = [np.array(x) for x in j_out['responses']]
+        assert_equal(grid.shape, (3, 2, n, len(time_grid)))
+
+        # The endpoints of the edges are the nodes.
+        assert_allclose(grid[:, 0, :, 0], node[:, :, 0], atol=1e-12)
+        assert_allclose(grid[:, 1, :, 0], node[:, :, 0], atol=1e-12)
+        assert_allclose(grid[:, 0, :, -1], node[:, :, 1], atol=1e-12)
+        assert_allclose(grid[:, 1, :, -1], node[:, :, 2], atol=1e-12)
+
+        # The interior points are like inserted degree-2 nodes.
+        for k in 1, 2:
+            split_scene = _get_scene(n, edge_rates, split=time_grid[k])
+            j_split = dict(scene=split_scene, requests=[
+                dict(property='dndnode')])
+            split_node = np.array(process_json_in(j_split)['responses'][0])
+            assert_allclose(grid[:, 0, :, k], split_node[:, :, 3], atol=1e-12)
+
+
+def test_grid_reductions():
+    n = 5
+    time_grid = [0.1, 0.5, 0.9]
+    scene = _get_scene(n, (0.7, 0.2))
+    j_in = dict(scene=scene, requests=[
+        dict(property='dddgrid', time_grid=time_grid),
+        dict(
+            property='swwgrid',
+            time_grid=time_grid,
+            edge_reduction=dict(edges=[1], weights=[2.0]),
+            state_reduction=dict(states=[[0], [3]], weights=[1.0, 0.5]))])
+    grid, reduced = [np.array(x) for x in process_json_in(j_in)['responses']]
+    desired = 2.0 * (grid[:, 1, 0, :] + 0.5 * grid[:, 1, 3, :]).sum(axis=0)
+    assert_allclose(reduced, desired)
+    # Each distribution sums to one.
+    assert_allclose(grid.sum(axis=2), 1)
+
+
+def test_grid_bad_input():
+    scene = _get_scene(3, (0.7, 0.2))
+    for time_grid in [], [0.5, 1.5], [[0.5]]:
+        j_in = dict(scene=scene, requests=[
+            dict(property='dddgrid', time_grid=time_grid)])
+        assert_raises(UnpackingError, TopLevel, j_in)
+    j_in = dict(scene=scene, requests=[dict(property='dddgrid')])
+    assert_raises(UnpackingError, TopLevel, j_in)
+
+
+def test_Propagator_multi_matmat():
+    # Unsorted and repeated scaling factors are allowed.
+    np.random.seed(1234)
+    n = 30
+    R = scipy.sparse.random(n, n, density=0.3, format='csr') * 5
+    R = scipy.sparse.csr_matrix(R - scipy.sparse.diags(R.diagonal()))
+    exit_rates = R.sum(axis=1).A.ravel()
+    Q = R.A - np.diag(exit_rates)
+    d = -exit_rates
+    mu = np.mean(d)
+    B = np.random.rand(n, 3)
+    ts = [0.5, 0, 3.0, 0.01, 3.0, 1.7]
+    for block_width in None, 2:
+        P = Propagator(RdOperator(R, d - mu), mu, block_width)
+        for f, M in (get_multi_matmat, Q), (get_adjoint_multi_matmat, Q.T):
+            for t, actual in zip(ts, f(P, ts, B)):
+                assert_allclose(actual, expm(M * t).dot(B), atol=1e-12)
+
+
+def test_expm_multiply_interval():
+    # Each of the three cases of the interval algorithm is checked.
+    np.random.seed(1234)
+    n = 6
+    B = np.random.randn(n, 2)
+    for scale, num, status in (0.1, 7, 1), (3, 41, 2), (30, 7, 0):
+        A = scale * np.random.randn(n, n)
+        assert_equal(_expm_multiply_interval(
+            A, B, 0.1, 1.0, num, status_only=True), status)
+        X = expm_multiply(A, B, start=0.1, stop=1.0, num=num)
+        for t, actual in zip(np.linspace(0.1, 1.0, num), X):
+            desired = expm(A * t).dot(B)
+            assert_allclose(actual, desired, rtol=1e-10,
+                    atol=1e-12 * np.abs(desired).max())
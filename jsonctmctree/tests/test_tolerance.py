@@ -0,0 +1,123 @@
+"""
+Test the requested accuracy of matrix exponential products.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import (
+        assert_allclose, assert_equal, assert_array_less, assert_raises)
+
+import scipy.sparse
+from scipy.linalg import expm
+
+from jsonctmctree.interface import process_json_in
+from jsonctmctree.common_unpacking_ex import UnpackingError, TopLevel
+from jsonctmctree.pyexp.constants import (
+        THETA, THETA_SINGLE, get_theta, get_tolerance)
+from jsonctmctree.pyexp.ctmc_ops import RdOperator, Propagator
+
+
+def _sample_sparse_rates(n):
+    R = scipy.sparse.random(n, n, density=0.2, format='csr')
+    R.setdiag(0)
+    R.eliminate_zeros()
+    return R
+
+
+def _get_json_input(n):
+    # The rate matrix is dense and large enough for the abstract operator.
+    np.random.seed(1234)
+    R = np.exp(np.random.randn(n, n))
+    np.fill_diagonal(R, 0)
+    row, col = np.nonzero(R)
+    scene = dict(
+            node_count = 3,
+            process_count = 1,
+            state_space_shape = [n],
+            root_prior = dict(
+                states = [[0]],
+                probabilities = [1]),
+            process_definitions = [dict(
+                row_states = [[i] for i in row],
+                column_states = [[j] for j in col],
+                transition_rates = R[row, col].tolist(),
+                expm_backend = 'abstract')],
+            tree = dict(
+                row_nodes = [0, 0],
+                column_nodes = [1, 2],
+                edge_rate_scaling_factors = [0.01, 0.02],
+                edge_processes = [0, 0]),
+            observed_data = dict(
+                nodes = [1, 2],
+                variables = [0, 0],
+                iid_observations = np.random.randint(
+                    0, n, size=(4, 2)).tolist()))
+    requests = [dict(property = 'snnlogl')]
+    return dict(scene=scene, requests=requests)
+
+
+def test_theta_tables():
+    assert_equal(get_theta(np.float64), THETA)
+    assert_equal(get_theta(np.float32), THETA_SINGLE)
+    assert_equal(get_theta(np.float64, 1e-20), THETA)
+    assert_equal(get_tolerance(np.float64, 1e-20), np.ldexp(1, -53))
+    assert_equal(get_tolerance(np.float64, 1e-6), 1e-6)
+    # Looser tolerances allow larger norms for each Taylor degree.
+    theta = get_theta(np.float64, 1e-10)
+    loose = get_theta(np.float64, 1e-4)
+    for m in THETA_SINGLE:
+        assert_array_less(THETA[m], theta[m])
+        assert_array_less(theta[m], THETA_SINGLE[m])
+        assert_array_less(THETA_SINGLE[m], loose[m])
+
+
+def test_propagator_tolerance():
+    np.random.seed(1234)
+    n = 40
+    R = _sample_sparse_rates(n)
+    exit_rates = R.sum(axis=1).A.ravel()
+    d = -exit_rates
+    mu = np.mean(d)
+    Q = R.A - np.diag(exit_rates)
+    B = np.random.rand(n, 3)
+    t = 5.0
+    desired = expm(Q * t).dot(B)
+    iterations = []
+    for tol in None, 1e-8, 1e-4:
+        P = Propagator(RdOperator(R, d - mu), mu, tol=tol)
+        m, s = P.predict_iterations(t, B.shape[1])
+        iterations.append(m * s)
+        actual = P._parameterized_matmat(t, B)
+        err = np.abs(actual - desired).max() / np.abs(desired).max()
+        assert_array_less(err, max(tol or 0, 1e-12) * 10)
+        assert_array_less(P.error_estimate, max(tol or 0, 1e-15) * 10)
+    assert_equal(sorted(iterations, reverse=True), iterations)
+
+
+def test_error_estimate_in_output():
+    j_in = _get_json_input(120)
+    desired = process_json_in(j_in)
+    assert_equal('error_estimate' in desired, False)
+
+    # A call-level tolerance.
+    actual = process_json_in(j_in, tolerance=1e-6)
+    assert_allclose(actual['responses'], desired['responses'], rtol=1e-5)
+    assert_array_less(actual['error_estimate'], 1e-5)
+
+    # A scene-level tolerance.
+    j_tol = copy.deepcopy(j_in)
+    j_tol['scene']['expm_tolerance'] = 1e-6
+    actual = process_json_in(j_tol)
+    assert_allclose(actual['responses'], desired['responses'], rtol=1e-5)
+    assert_array_less(actual['error_estimate'], 1e-5)
+
+
+def test_bad_tolerance():
+    j_in = _get_json_input(4)
+    j_in['scene']['expm_tolerance'] = 2
+    assert_raises(UnpackingError, TopLevel, j_in)
+    j_in = _get_json_input(4)
+    assert_raises(ValueError, process_json_in, j_in, tolerance=0)
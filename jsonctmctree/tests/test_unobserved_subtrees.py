@@ -0,0 +1,145 @@
+"""
+Test the short-circuiting of unobserved subtrees and zero-rate edges.
+
+The likelihood arrays of subtrees without observations are all ones,
+and edges with zero rate do not change the arrays,
+so no matrix exponential action is needed for either of them.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import copy
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+from scipy.linalg import expm
+
+from jsonctmctree import impl_naive, impl_v2
+from jsonctmctree.common_likelihood import (
+        ObservationEncoding, create_indicator_array, get_unobserved_subtrees,
+        get_subtree_likelihoods, get_conditional_likelihoods)
+from jsonctmctree.common_unpacking_ex import (
+        gen_valid_extended_properties, TopLevel, interpret_tree)
+from jsonctmctree.expm_helpers import PadeExpm, create_dense_rate_matrix
+
+
+def _get_scene(pruned=False):
+    # The subtree of node 4 has no observations,
+    # and the edge from node 2 to node 3 has zero rate.
+    tree = dict(
+            row_nodes = [0, 0, 2, 2, 4],
+            column_nodes = [1, 2, 3, 4, 5],
+            edge_rate_scaling_factors = [1.0, 0.5, 0.0, 0.7, 0.3],
+            edge_processes = [0, 0, 0, 0, 0])
+    node_count = 6
+    if pruned:
+        tree = dict((k, v[:3]) for k, v in tree.items())
+        node_count = 4
+    return dict(
+            node_count = node_count,
+            process_count = 1,
+            state_space_shape = [3],
+            tree = tree,
+            root_prior = dict(
+                states = [[0], [1], [2]],
+                probabilities = [0.2, 0.3, 0.5]),
+            process_definitions = [dict(
+                row_states = [[0], [0], [1], [1], [2], [2]],
+                column_states = [[1], [2], [0], [2], [0], [1]],
+                transition_rates = [1, 2, 3, 1, 2, 3])],
+            observed_data = dict(
+                nodes = [1, 3],
+                variables = [0, 0],
+                iid_observations = [[0, 1], [2, 2], [1, -1], [0, 0]]))
+
+
+class _CountingExpm(object):
+    # Record the rate of each matrix exponential product.
+    def __init__(self, obj):
+        self.obj = obj
+        self.rates = []
+
+    def expm_mul(self, rate_scaling_factor, A):
+        self.rates.append(rate_scaling_factor)
+        return self.obj.expm_mul(rate_scaling_factor, A)
+
+
+def test_unobserved_subtree_arrays():
+    scene = TopLevel(dict(scene=_get_scene(), requests=[])).scene
+    p = scene.process_definitions[0]
+    shape = scene.state_space_shape
+    obs = scene.observed_data
+    common = interpret_tree(scene) + (shape, obs.nodes, obs.variables,
+            obs.iid_observations)
+    T, root = common[:2]
+    encoding = ObservationEncoding(shape, obs.nodes, obs.variables,
+            obs.iid_observations)
+    assert_equal(get_unobserved_subtrees(T, root, encoding), {4, 5})
+
+    Q = create_dense_rate_matrix(
+            shape, p.row_states, p.column_states, p.transition_rates)
+    P = dict((edge, expm(rate * Q)) for edge, rate in common[3])
+    def indicator(node):
+        return create_indicator_array(node, shape,
+                obs.nodes, obs.variables, obs.iid_observations)
+    desired = dict((node, indicator(node)) for node in (1, 3, 5))
+    for head, tail in (4, 5), (2, 4), (2, 3), (0, 1), (0, 2):
+        if head not in desired:
+            desired[head] = indicator(head)
+        desired[head] = desired[head] * P[head, tail].dot(desired[tail])
+    for f in get_subtree_likelihoods, get_conditional_likelihoods:
+        obj = _CountingExpm(PadeExpm(
+            shape, p.row_states, p.column_states, p.transition_rates))
+        node_to_array = f([obj], True, *common)
+
+        # Only the observed edges with nonzero rate are evaluated.
+        assert_equal(sorted(obj.rates), [0.5, 1.0])
+        for node, arr in node_to_array.items():
+            if f is get_conditional_likelihoods and node != root:
+                edge = [e for e in common[2] if e[1] == node][0]
+                assert_allclose(arr, P[edge].dot(desired[node]))
+            else:
+                assert_allclose(arr, desired[node])
+
+
+def test_unobserved_subtree_responses():
+    # Removing the unobserved subtree does not change the responses
+    # at the remaining nodes and edges.
+    properties = list(gen_valid_extended_properties()) + ['ddngrad']
+    for extended_property in properties:
+        if extended_property[-4:] in ('grid', 'ance'):
+            continue
+        request = dict(property=extended_property)
+        if extended_property[-4:] == 'tran':
+            request['transition_reduction'] = dict(
+                    row_states=[[0], [1], [2]],
+                    column_states=[[1], [2], [0]],
+                    weights=[1, 2, 3])
+        if extended_property[1] == 'w':
+            request['edge_reduction'] = dict(edges=[0, 1], weights=[1, 2])
+        if extended_property[2] == 'w':
+            request['state_reduction'] = dict(states=[[0], [2]],
+                    weights=[1, 2])
+        if extended_property[0] == 'w':
+            request['observation_reduction'] = dict(
+                    observation_indices=[1, 3], weights=[0.5, 2])
+        j_in = dict(scene=_get_scene(), requests=[request])
+        j_pruned = dict(scene=_get_scene(pruned=True), requests=[request])
+        actual = impl_v2.process_json_in(copy.deepcopy(j_in))
+        assert_equal(actual['status'], 'feasible')
+        if extended_property[-4:] != 'grad':
+            desired = impl_naive.process_json_in(j_in)
+            assert_allclose(actual['responses'][0], desired['responses'][0])
+
+        # Sums over edges include the edges of the removed subtree.
+        if extended_property[1] == 's':
+            continue
+        pruned = np.array(impl_v2.process_json_in(j_pruned)['responses'][0])
+        actual = np.array(actual['responses'][0])
+        if extended_property[-4:] == 'node':
+            actual = actual[..., :4]
+        elif extended_property[1] == 'd':
+            edge_axis = 1 if extended_property[0] == 'd' else 0
+            actual = np.take(actual, range(3), axis=edge_axis)
+        assert_allclose(actual, pruned, atol=1e-12)
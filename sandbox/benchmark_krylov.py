@@ -0,0 +1,77 @@
+"""
+Compare the Taylor and Krylov propagators on a paralog-like process.
+
+The bivariate process has a random univariate process acting on each
+of two paralogs, with a gene conversion coupling that copies
+the state of one paralog to the other.
+For each number of columns, the wall clock time and the maximum
+absolute difference between the two propagators are reported.
+
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import time
+from itertools import product
+
+import numpy as np
+import scipy.sparse
+
+from jsonctmctree.pyexp.ctmc_ops import (
+        Propagator, KrylovPropagator, KroneckerSumOperator)
+
+
+def create_operators(n, tau):
+    axis_matrices = []
+    for axis in range(2):
+        A = np.exp(np.random.randn(n, n))
+        np.fill_diagonal(A, 0)
+        axis_matrices.append(A / n)
+    row = []
+    col = []
+    for i, j in product(range(n), repeat=2):
+        if i != j:
+            row.extend([i*n + j, i*n + j])
+            col.extend([i*n + i, j*n + j])
+    data = np.full(len(row), tau)
+    C = scipy.sparse.csr_matrix((data, (row, col)), shape=(n*n, n*n))
+    K = KroneckerSumOperator(axis_matrices, C, np.zeros(n*n))
+    d = -K.abs_sum_axis_1()
+    mu = np.mean(d)
+    taylor = Propagator(KroneckerSumOperator(axis_matrices, C, d - mu), mu)
+    krylov = KrylovPropagator(KroneckerSumOperator(axis_matrices, C, d))
+    return taylor, krylov
+
+
+def main(args):
+    np.random.seed(args.seed)
+    taylor, krylov = create_operators(args.n, args.tau)
+    nstates = args.n * args.n
+    print('states:', nstates, 't:', args.t)
+    for ncols in args.ncols:
+        B = np.random.rand(nstates, ncols)
+        tm = time.time()
+        F_taylor = taylor._parameterized_matmat(args.t, B)
+        taylor_time = time.time() - tm
+        tm = time.time()
+        F_krylov = krylov._parameterized_matmat(args.t, B)
+        krylov_time = time.time() - tm
+        print('columns:', ncols,
+                'taylor seconds:', taylor_time,
+                'krylov seconds:', krylov_time,
+                'max abs diff:', np.max(np.abs(F_taylor - F_krylov)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n', type=int, default=61,
+            help='number of states of each paralog')
+    parser.add_argument('--tau', type=float, default=0.5,
+            help='gene conversion rate')
+    parser.add_argument('--t', type=float, default=0.1,
+            help='edge rate scaling factor')
+    parser.add_argument('--ncols', type=int, nargs='+',
+            default=[1, 4, 16, 64],
+            help='numbers of columns to propagate')
+    parser.add_argument('--seed', type=int, default=1234)
+    main(parser.parse_args())